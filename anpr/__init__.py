@@ -4,15 +4,37 @@ import os
 import argparse
 import re
 import functools
+import hashlib
+import collections
+import collections.abc
+import itertools
+import logging
+import multiprocessing
+import concurrent.futures
+import zipfile
+from xml.etree import ElementTree
 
 import openpyxl
 import psycopg2 as psy
+import psycopg2.extras
+import psycopg2.pool
 from psycopg2 import sql
 from fastkml import kml
 
+from anpr import backends
+from anpr import bulk
+from anpr import cache
+from anpr import deferred
 from anpr import filters
 from anpr import groups
+from anpr import metrics
+from anpr import partitions
+from anpr import planner
+from anpr import spatial
+from anpr import spill
 from anpr import stats
+from anpr import summaries
+from anpr import tripindex
 
 
 UNINTERESTING_SHEETS = (
@@ -27,6 +49,13 @@ DATA_END_COL = 6
 
 CHAIN_DIRECTION_REGEX = re.compile("^.*?_(N|E|S|W|IN|OUT)>")
 DESTINATIONS_REGEX = re.compile(r">(.*?)_(N|E|S|W|IN|OUT)\(([\d\.]+)\)")
+DIRECTIONS = frozenset(("N", "E", "S", "W", "IN", "OUT"))
+_MICROSECOND = datetime.timedelta(microseconds=1)
+
+
+JOURNEY_SITES_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS journeys_sites_idx "
+    "ON journeys USING GIN (sites);")
 
 
 def make_journeys_table(dbname, password):
@@ -38,105 +67,345 @@ def make_journeys_table(dbname, password):
     ", total_trip_time interval"+
     ", chain text"+
     ", trip_destinations_and_time text"+
-    ", journey_end_time timestamp);"
+    ", journey_end_time timestamp"+
+    ", sites text[] NOT NULL);"
     )
+    cur.execute(JOURNEY_SITES_INDEX_SQL)
+    cache.bump_data_version(cur)
+    conn.commit()
+
+
+def migrate_site_tables(dbname, password):
+    '''
+    Bring a journeys table from before the sites column up to date.
+    The sites are rebuilt from each journey's chain, after which the old
+    per-site "s<site>" tables are no longer used and can be dropped.
+    '''
+    conn = psy.connect("dbname={} password={}".format(dbname, password))
+    cur = conn.cursor()
+    cur.execute("ALTER TABLE journeys ADD COLUMN IF NOT EXISTS sites text[];")
+    cur.execute(
+        "UPDATE journeys SET sites = string_to_array(chain, '>') "
+        "WHERE sites IS NULL;")
+    cur.execute("ALTER TABLE journeys ALTER COLUMN sites SET NOT NULL;")
+    cur.execute(JOURNEY_SITES_INDEX_SQL)
     conn.commit()
 
 
+def parse_chain(row, camera_name):
+    '''
+    Parse one row of a camera sheet into the vehicle class and the list of
+    (camera, direction, timestamp) captures that make up its trip.
+    Returns None if the row is empty.
+    '''
+    timestamp, veh_class, _tot_mins, chain, details = row
+
+    if timestamp.value is None:
+        print(
+            "Empty row in '{}' cell {}:{}".format(
+            camera_name, timestamp.column, timestamp.row))
+        return None
+
+    if not isinstance(timestamp.value, datetime.datetime):
+        raise ValueError(
+            "Expected a datetime from cell {}:{}, was {}".format(
+                timestamp.column, timestamp.row, type(timestamp.value)))
+    timestamp = timestamp.value
+    veh_class = veh_class.value
+
+    initial_camera = camera_name
+    match = CHAIN_DIRECTION_REGEX.match(chain.value)
+    if not match:
+        raise ValueError(
+            "Could not extract the initial direction from the chain in "
+            "cell {}:{}: {!r}".format(chain.column, chain.row, chain.value))
+    initial_direction = match.group(1)
+    captures = [(initial_camera, initial_direction, timestamp)]
+
+    next_ts = timestamp
+    for match in DESTINATIONS_REGEX.finditer(details.value):
+        next_camera = match.group(1)
+        next_direction = match.group(2)
+        next_duration = float(match.group(3))
+        next_ts = next_ts + datetime.timedelta(minutes=next_duration)
+        captures.append((next_camera, next_direction, next_ts))
+    assert len(captures) > 1, (
+        "No trip details found in cell {}:{}".format(
+        details.column, details.row))
+    return veh_class, captures
+
+
+@functools.lru_cache(maxsize=4096)
+def _duration_microseconds(minutes):
+    '''
+    A duration from the trip details, in (exactly the same) microseconds that
+    timedelta(minutes=...) would give. The spreadsheets only use a few
+    thousand distinct durations, so they are cached.
+    '''
+    return datetime.timedelta(minutes=float(minutes)) // _MICROSECOND
+
+
+def parse_chain_values(values, camera_name, row_number):
+    '''
+    The same as parse_chain(), but from a row of plain cell values, as given
+    by iter_rows(values_only=True), so no Cell objects are made.
+    The details are split up by a single findall() pass, and the capture
+    times are built from a running total of microseconds rather than by
+    adding up timedeltas.
+    '''
+    timestamp, veh_class, _tot_mins, chain, details = values
+
+    if timestamp is None:
+        print("Empty row in '{}' row {}".format(camera_name, row_number))
+        return None
+
+    if not isinstance(timestamp, datetime.datetime):
+        raise ValueError(
+            "Expected a datetime in row {}, was {}".format(
+                row_number, type(timestamp)))
+
+    # The chain almost always starts "<camera>_<direction>>"
+    initial_direction = chain.partition(">")[0].rpartition("_")[2]
+    if initial_direction not in DIRECTIONS or ">" not in chain:
+        match = CHAIN_DIRECTION_REGEX.match(chain)
+        if not match:
+            raise ValueError(
+                "Could not extract the initial direction from the chain in "
+                "row {}: {!r}".format(row_number, chain))
+        initial_direction = match.group(1)
+    captures = [(camera_name, initial_direction, timestamp)]
+
+    offset = 0
+    for next_camera, next_direction, minutes in DESTINATIONS_REGEX.findall(details):
+        offset += _duration_microseconds(minutes)
+        captures.append((
+            next_camera, next_direction,
+            timestamp + datetime.timedelta(0, 0, offset)))
+    assert len(captures) > 1, (
+        "No trip details found in row {}".format(row_number))
+    return veh_class, captures
+
+
+LOAD_MANIFEST_TABLE_SQL = (
+    "CREATE TABLE IF NOT EXISTS load_manifest ("
+    "workbook_hash char(64) NOT NULL, "
+    "sheet_title text NOT NULL, "
+    "workbook_path text NOT NULL, "
+    "n_trips integer NOT NULL, "
+    "loaded_at timestamptz NOT NULL DEFAULT now(), "
+    "PRIMARY KEY (workbook_hash, sheet_title)"
+    ");"
+)
+
+
+def workbook_sheet_titles(spreadsheet_path):
+    '''
+    The titles of a workbook's sheets, in order, read straight from its
+    xl/workbook.xml. Far quicker than opening it with openpyxl, which reads
+    the whole shared strings table.
+    '''
+    with zipfile.ZipFile(spreadsheet_path) as archive:
+        root = ElementTree.fromstring(archive.read("xl/workbook.xml"))
+    return [element.get("name") for element in root.iter()
+            if element.tag.rpartition("}")[2] == "sheet"]
+
+
+def workbook_hash(spreadsheet_path):
+    h = hashlib.sha256()
+    with open(spreadsheet_path, "rb") as infile:
+        for block in iter(lambda: infile.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
 class DataLoader:
-    def __init__(self, spreadsheet_path, db_connection):
-        wb = openpyxl.load_workbook(
-            filename=spreadsheet_path, read_only=True)
-        self.wb = wb
+    def __init__(self, spreadsheet_path, db_connection, bulk_load=False,
+                 batch_size=bulk.BULK_BATCH_SIZE, backend=backends.POSTGRES):
+        '''
+        db_connection is a connection made by the backend (see
+        anpr.backends). Bulk loading needs Postgres; with other backends the
+        trips are inserted row by row.
+        '''
+        self.spreadsheet_path = spreadsheet_path
+        self._wb = None
         self.conn = db_connection
+        self.backend = backend
+        self.bulk_load = bulk_load and not backend.embedded
+        self.batch_size = batch_size
+        self._hash = None
+        self._partitions = None
+        self._trip_index = None
+
+    @property
+    def wb(self):
+        # Only opened when a sheet is read, which the parent process of a
+        # parallel load never does.
+        if self._wb is None:
+            self._wb = openpyxl.load_workbook(
+                filename=self.spreadsheet_path, read_only=True)
+        return self._wb
+
+    def workbook_hash(self):
+        if self._hash is None:
+            self._hash = workbook_hash(self.spreadsheet_path)
+        return self._hash
+
+    def loaded_sheets(self):
+        '''
+        The titles of this workbook's sheets that are already in the db,
+        according to the load manifest
+        '''
+        return self.backend.loaded_sheets(
+            self.conn, self.workbook_hash(), LOAD_MANIFEST_TABLE_SQL)
+
+    def record_sheet(self, sheet_title, n_trips):
+        '''
+        Add a sheet to the load manifest, in the same transaction as its trips
+        '''
+        self.backend.record_sheet(
+            self.conn, self.workbook_hash(), sheet_title,
+            os.path.abspath(self.spreadsheet_path), n_trips)
+
+    def camera_sheets(self):
+        return [sheet for sheet in self.wb.worksheets
+                if sheet.title not in UNINTERESTING_SHEETS]
+
+    def camera_sheet_titles(self):
+        '''
+        The titles of camera_sheets(), without opening the workbook
+        '''
+        return [title for title in workbook_sheet_titles(self.spreadsheet_path)
+                if title not in UNINTERESTING_SHEETS]
 
     def load(self):
-        camera_sheets = [sheet for sheet in self.wb.worksheets
-                         if sheet.title not in UNINTERESTING_SHEETS]
-        for sheet in camera_sheets:
-            # Sanity check -- can be pretty sure we're loading camera data.
-            camera_name = sheet.title
-            check = str(sheet[CAMERA_ID_CELL].value)
-            if camera_name not in (check, "0"+check):
-                raise ValueError(
-                    "Sheet titled {!r} doesn't look like camera data".format(
-                        camera_name))
-
-            print("Loading trips starting at camera {}".format(sheet.title))
-            # In case sheets report an incorrect size.
+        '''
+        Load every camera sheet that isn't already in the db, committing
+        after each one
+        '''
+        loaded = self.loaded_sheets()
+        total_rate = bulk.LoadRate()
+        for sheet in self.camera_sheets():
+            if sheet.title in loaded:
+                print("Skipping camera {}, already loaded".format(
+                    sheet.title))
+                continue
+            rate = self.write_trips(sheet.title, self.parse_sheet(sheet))
+            self.record_sheet(sheet.title, rate.n_rows)
+            self.conn.commit()
+            total_rate.add(rate.n_rows)
+
+        print("Workbook: {}".format(total_rate))
+
+    def check_sheet(self, sheet):
+        '''
+        Check that the sheet holds camera data, and get it ready for reading
+        '''
+        # Sanity check -- can be pretty sure we're loading camera data.
+        camera_name = sheet.title
+        check = str(sheet[CAMERA_ID_CELL].value)
+        if camera_name not in (check, "0"+check):
+            raise ValueError(
+                "Sheet titled {!r} doesn't look like camera data".format(
+                    camera_name))
+
+        print("Loading trips starting at camera {}".format(sheet.title))
+        metrics.metrics.count("load.sheets_parsed")
+        # In case sheets report an incorrect size.
+        if hasattr(sheet, "reset_dimensions"):
+            sheet.reset_dimensions()
+        else:
+            #openpyxl < 3
             sheet.max_row = None
             sheet.max_column = None
-            cursor = self.conn.cursor()
-            for row in sheet.iter_rows(
-                    min_row=DATA_START_ROW,
-                    min_col=DATA_START_COL, max_col=DATA_END_COL):
-                self.load_chain(row, camera_name, cursor)
 
-        self.conn.commit()
+    def parse_sheet(self, sheet):
+        '''
+        Check that the sheet holds camera data, then yield a
+        (vehicle class, captures) trip for each of its rows
+        '''
+        self.check_sheet(sheet)
+        camera_name = sheet.title
+        rows = sheet.iter_rows(
+            min_row=DATA_START_ROW,
+            min_col=DATA_START_COL, max_col=DATA_END_COL, values_only=True)
+        for row_number, values in enumerate(rows, DATA_START_ROW):
+            trip = parse_chain_values(values, camera_name, row_number)
+            if trip is not None:
+                metrics.metrics.count("load.rows_parsed")
+                yield trip
 
-    def load_chain(self, row, camera_name, cursor):
-        timestamp, veh_class, _tot_mins, chain, details = row
+    def parse_sheet_cells(self, sheet):
+        '''
+        The same as parse_sheet(), but going through each row's Cell objects
+        and parse_chain(). Slower, kept for comparison.
+        '''
+        self.check_sheet(sheet)
+        camera_name = sheet.title
+        for row in sheet.iter_rows(
+                min_row=DATA_START_ROW,
+                min_col=DATA_START_COL, max_col=DATA_END_COL):
+            trip = parse_chain(row, camera_name)
+            if trip is not None:
+                metrics.metrics.count("load.rows_parsed")
+                yield trip
 
-        if timestamp.value is None:
-            print(
-                "Empty row in '{}' cell {}:{}".format(
-                camera_name, timestamp.column, timestamp.row))
-            return
+    def write_trips(self, camera_name, trips):
+        '''
+        Write the trips starting at the given camera to the db, without
+        committing. Returns the LoadRate for the sheet.
+        '''
+        if self._partitions is None:
+            self._partitions = (
+                self.backend.partition_router(self.conn) or False)
+        if self._trip_index is None:
+            self._trip_index = self.backend.trip_index(self.conn) or False
+        rate = bulk.LoadRate()
+        if self.bulk_load:
+            writer = bulk.CopyWriter(self.conn, batch_size=self.batch_size)
+            for veh_class, captures in trips:
+                if self._partitions:
+                    self._partitions.ensure_trip(captures)
+                vehicle_id = writer.add_trip(veh_class, captures)
+                if self._trip_index:
+                    self._trip_index.add_trip(vehicle_id, captures)
+                rate.add(1)
+            writer.flush()
+        else:
+            cursor = self.conn.cursor()
+            for veh_class, captures in trips:
+                if self._partitions:
+                    self._partitions.ensure_trip(captures)
+                vehicle_id = self.insert_trip(cursor, veh_class, captures)
+                if self._trip_index:
+                    self._trip_index.add_trip(vehicle_id, captures)
+                rate.add(1)
+        if self._trip_index:
+            with metrics.metrics.timer("load.trip_index"):
+                self._trip_index.flush()
+        # Includes the parsing when trips is parse_sheet()'s generator.
+        metrics.metrics.add_time("load.sheet", rate.elapsed())
+        metrics.metrics.count("load.sheets_written")
+        metrics.metrics.count("load.trips_written", rate.n_rows)
+        print("Camera {}: {}".format(camera_name, rate))
+        return rate
 
-        if not isinstance(timestamp.value, datetime.datetime):
-            raise ValueError(
-                "Expected a datetime from cell {}:{}, was {}".format(
-                    timestamp.column, timestamp.row, type(timestamp.value)))
-        timestamp = timestamp.value
-        veh_class = veh_class.value
-
-        cursor.execute(
-            "INSERT INTO vehicles (class) VALUES (%s)"
-            "RETURNING id;",
-            (veh_class,)
-        )
-        vehicle_id = cursor.fetchone()
-
-        initial_camera = camera_name
-        match = CHAIN_DIRECTION_REGEX.match(chain.value)
-        if not match:
-            raise ValueError(
-                "Could not extract the initial direction from the chain in "
-                "cell {}:{}: {!r}".format(chain.column, chain.row, chain.value))
-        initial_direction = match.group(1)
-        cursor.execute(
-            "INSERT INTO captures (camera, vehicle, direction, ts)"
-            "VALUES (%s, %s, %s, %s);",
-            (initial_camera, vehicle_id, initial_direction, timestamp)
-        )
-
-        found_one = False
-        next_ts = timestamp
-        for match in DESTINATIONS_REGEX.finditer(details.value):
-            found_one = True
-            next_camera = match.group(1)
-            next_direction = match.group(2)
-            next_duration = float(match.group(3))
-            next_ts = next_ts + datetime.timedelta(minutes=next_duration)
-            cursor.execute(
-                "INSERT INTO captures (camera, vehicle, direction, ts)"
-                "VALUES (%s, %s, %s, %s);",
-                (next_camera, vehicle_id, next_direction, next_ts)
-            )
-        assert found_one, (
-            "No trip details found in cell {}:{}".format(
-            details.column, details.row))
+    def load_chain(self, row, camera_name, cursor):
+        trip = parse_chain(row, camera_name)
+        if trip is None:
+            return False
+        self.insert_trip(cursor, *trip)
+        return True
+
+    def insert_trip(self, cursor, veh_class, captures):
+        metrics.metrics.count("db.round_trips", 1 + len(captures))
+        return self.backend.insert_trip(cursor, veh_class, captures)
 
     def load_journey(self, row):
         '''
         load the given journey entry into the database
         '''
         if row[0].value is not None:
-            journey_id = self.add_journey_entry(row)
-            for site in set(row[3].value.split(">")):
-                if not self.table_exists("s"+site):
-                    self.create_site_set_table("s"+site)
-                self.add_to_site_set("s"+site, journey_id)
+            self.add_journey_entry(row)
 
     def add_journey_entry(self, row):
         cur = self.conn.cursor()
@@ -145,36 +414,111 @@ class DataLoader:
             end_time = datetime.datetime.strptime(row[0].value,"%d/%m/%Y %H:%M:%S") + trip_time
         else:
             end_time = row[0].value + trip_time
-        cur.execute("INSERT INTO journeys (timestamp, class, total_trip_time, chain, trip_destinations_and_time, journey_end_time)" +
-        "VALUES (%s, %s, %s, %s, %s, %s) RETURNING journey_id;", [row[0].value,
-        row[1].value, trip_time, row[3].value, row[4].value, end_time])
+        #the set of sites visited, so journeys can be found by site through
+        #the GIN index on sites
+        sites = sorted(set(row[3].value.split(">")))
+        cur.execute("INSERT INTO journeys (timestamp, class, total_trip_time, chain, trip_destinations_and_time, journey_end_time, sites)" +
+        "VALUES (%s, %s, %s, %s, %s, %s, %s) RETURNING journey_id;", [row[0].value,
+        row[1].value, trip_time, row[3].value, row[4].value, end_time, sites])
         journey_id = cur.fetchone()
+        cache.bump_data_version(cur)
 
         self.conn.commit()
         return journey_id
 
-    def table_exists(self, table_name):
-        cur = self.conn.cursor()
-        cur.execute("select relname from pg_class where relname = %s;", [table_name])
-        if cur.fetchone():
-            return True
-        else:
-            return False
+# The workbook a worker process last opened. Opening one is far slower than
+# parsing a sheet, and a workbook's sheets are handed out one after another,
+# so each worker opens each workbook about once.
+_worker_loader = None
 
-    def create_site_set_table(self, site):
-        cur = self.conn.cursor()
-        s = sql.SQL("CREATE TABLE {} (journey_id serial UNIQUE REFERENCES"+
-        " journeys);").format(
-            sql.Identifier(site))
-        cur.execute(s)
-        self.conn.commit()
+def _init_parse_worker(metrics_enabled):
+    '''
+    Worker process set up for load_parallel()
+    '''
+    metrics.metrics.enabled = metrics_enabled
 
-    def add_to_site_set(self, site, journey_id):
-        cur = self.conn.cursor()
-        s = sql.SQL("INSERT INTO {} (journey_id) VALUES (%s);").format(sql.Identifier(site))
-        cur.execute(s, [journey_id])
+def _parse_sheet_job(spreadsheet_path, sheet_title):
+    '''
+    Worker process entry point: parse one camera sheet into a list of trips.
+    Returns the trips and the counts made while parsing, for the parent's
+    metrics (the worker's own are never reported).
+    '''
+    global _worker_loader
+    if _worker_loader is None or _worker_loader.spreadsheet_path != spreadsheet_path:
+        _worker_loader = DataLoader(spreadsheet_path, db_connection=None)
+    metrics.metrics.reset()
+    trips = list(_worker_loader.parse_sheet(_worker_loader.wb[sheet_title]))
+    return trips, dict(metrics.metrics.counters)
 
-        self.conn.commit()
+
+def load_parallel(spreadsheet_paths, db_connection, jobs,
+                  bulk_load=False, batch_size=bulk.BULK_BATCH_SIZE,
+                  backend=backends.POSTGRES):
+    """Load several workbooks, parsing their sheets in a pool of processes.
+
+    The worker processes only parse the spreadsheets; everything is written
+    to the db by this process over the one connection. Each sheet is loaded
+    in its own transaction along with its load manifest entry, so sheets
+    that are already loaded are skipped. If a sheet fails it is rolled back
+    and the rest of its workbook is skipped, to be picked up by a later
+    run. A failed workbook doesn't stop the others from loading.
+
+    Returns the list of (spreadsheet path, exception) for workbooks that
+    failed to load.
+    """
+    def sheets_to_load():
+        # Each workbook is only hashed and checked against the load manifest
+        # once its sheets are about to be queued, and its loader (holding
+        # nothing but the path and hash) goes once they have been written.
+        for spreadsheet_path in spreadsheet_paths:
+            loader = DataLoader(
+                spreadsheet_path, db_connection, bulk_load=bulk_load,
+                batch_size=batch_size, backend=backend)
+            loaded = loader.loaded_sheets()
+            titles = [title for title in loader.camera_sheet_titles()
+                      if title not in loaded]
+            for i, title in enumerate(titles, 1):
+                yield loader, title, i == len(titles)
+
+    failed = []
+    failed_paths = set()
+    with multiprocessing.Pool(
+            jobs, initializer=_init_parse_worker,
+            initargs=(metrics.metrics.enabled,)) as pool:
+        # Only keep a few sheets queued up ahead of the writer, parsed trips
+        # can take up a lot of memory.
+        pending = collections.deque()
+        todo = sheets_to_load()
+        for loader, title, last in itertools.islice(todo, 2 * jobs):
+            pending.append((loader, title, last, pool.apply_async(
+                _parse_sheet_job, (loader.spreadsheet_path, title))))
+
+        while pending:
+            loader, title, last, result = pending.popleft()
+            spreadsheet_path = loader.spreadsheet_path
+            # The rest of a failed workbook is parsed, but not written.
+            if spreadsheet_path not in failed_paths:
+                try:
+                    trips, parse_counts = result.get()
+                    metrics.metrics.add_counts(parse_counts)
+                    rate = loader.write_trips(title, trips)
+                    loader.record_sheet(title, rate.n_rows)
+                    db_connection.commit()
+                except Exception as e:
+                    db_connection.rollback()
+                    print("failed to load {!r}: {}".format(spreadsheet_path, e))
+                    failed.append((spreadsheet_path, e))
+                    failed_paths.add(spreadsheet_path)
+                else:
+                    if last:
+                        print("loaded {!r}".format(spreadsheet_path))
+            del loader, result
+            # Queued after the write, so that checking the next workbook's
+            # load manifest happens between transactions.
+            for next_loader, next_title, next_last in itertools.islice(todo, 1):
+                pending.append((next_loader, next_title, next_last, pool.apply_async(
+                    _parse_sheet_job, (next_loader.spreadsheet_path, next_title))))
+    return failed
 
 CHAIN_COLUMN_INDEX = 4
 CHAIN_TIME_COLUMN_INDEX = 5
@@ -185,44 +529,535 @@ TOTAL_TIME_COLUMN_INDEX = 3
 def compose(functions):
     return functools.reduce(lambda f, g: lambda x: f(g(x)), functions, lambda x: x)
 
+def pipeline(functions):
+    '''
+    Like compose(), but the first function is applied first
+    '''
+    return compose(list(reversed(functions)))
+
+def fine_pass_pipeline(filter_lst, columnar=False):
+    '''
+    The fine passes of the filters that need one, applied in list order.
+    With columnar, those that need one after their column_mask() instead
+    '''
+    return pipeline([counted_fine_pass(fil) for fil in filter_lst
+                     if filters.needs_fine_pass(fil, columnar)])
+
+def counted_fine_pass(fil):
+    '''
+    The filter's fine pass, counting the rows that go into and come out of it
+    when metrics are enabled
+    '''
+    name = "search.fine_pass.{}".format(type(fil).__name__)
+    def fine_pass(rows):
+        rows = metrics.metrics.counted(rows, name + ".rows_in")
+        return metrics.metrics.counted(fil.fine_pass(rows), name + ".rows_out")
+    return fine_pass
+
+def aggregate(stats_lst, group_or_rows):
+    '''
+    See DataSearcher.aggregate()
+    '''
+    if isinstance(group_or_rows, dict):
+        return {key: aggregate(stats_lst, value) for key, value in group_or_rows.items()}
+    elif isinstance(group_or_rows, collections.abc.Iterable):
+        aggregators = [stat.aggregator() for stat in stats_lst]
+        for row in group_or_rows:
+            for agg in aggregators:
+                agg.update(row)
+        return aggregators
+    else:
+        raise Exception("Unknown group type:{}".format(type(group_or_rows)))
+
+_search_worker = None
+
+def _init_search_worker(filter_lst, group_lst, stats_lst, columnar=False):
+    '''
+    Worker process set up for DataSearcher.combined_parallel()
+    '''
+    global _search_worker
+    _search_worker = (
+        fine_pass_pipeline(filter_lst, columnar),
+        compose([group.group for group in group_lst]),
+        stats_lst)
+
+def _search_worker_chunk(rows):
+    '''
+    Worker process entry point: the partial aggregates for a chunk of rows
+    '''
+    fine_pass, group, stats_lst = _search_worker
+    return aggregate(stats_lst, group(fine_pass(rows)))
+
+DEFAULT_ITERSIZE = 10000
+
+_stream_cursor_ids = itertools.count()
+
+def make_pool(dbname, db_password, user=None, minconn=1, maxconn=8):
+    '''
+    A pool of connections that can be shared by DataSearchers, including
+    ones running in different threads
+    '''
+    return psycopg2.pool.ThreadedConnectionPool(
+        minconn, maxconn, dbname=dbname, user=user, password=db_password)
+
+def search_many(specs, connection_pool, dbname, max_workers=None, **searcher_kwargs):
+    '''
+    Run many searches at once, each on its own connection from the pool.
+    specs is a sequence of (filter_lst, group_lst, stats_lst), and any other
+    DataSearcher arguments are passed on to every search.
+    Returns the combined() result of each search, in the order of specs.
+    '''
+    def search(spec):
+        filter_lst, group_lst, stats_lst = spec
+        with DataSearcher(dbname, None, filter_lst, group_lst, stats_lst,
+                          connection_pool=connection_pool,
+                          **searcher_kwargs) as searcher:
+            return searcher.combined()
+
+    #the pool raises an error rather than wait when it runs out of connections
+    if max_workers is None or max_workers > connection_pool.maxconn:
+        max_workers = connection_pool.maxconn
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        return list(executor.map(search, specs))
+
 class DataSearcher(object):
-    def __init__(self, dbname, db_password, filter_lst=[], group_lst=[], stats_lst=[]):
-        self.conn = psy.connect("dbname={} password={}".format(dbname, db_password))
+    #whether the coarse passes are column_mask()s, see FileSearcher
+    columnar = False
+
+    def __init__(self, dbname, db_password, filter_lst=[], group_lst=[], stats_lst=[],
+                 stream=False, itersize=DEFAULT_ITERSIZE, push_down=True,
+                 result_cache=None, connection_pool=None,
+                 backend=backends.POSTGRES, memory_budget=None, jobs=1):
+        '''
+        If stream is True, rows are fetched through a server-side cursor
+        itersize rows at a time and passed through the filters and groups
+        as they arrive, rather than pulling the whole result set into memory
+        first.
+        If push_down is True and none of the filters need a fine pass, the
+        grouping and stats are done by the db in a single aggregate query
+        wherever they can be expressed in SQL.
+        If a cache.ResultCache is given, combined() results are looked up in
+        and stored to it.
+        If a connection_pool (see make_pool()) is given, a connection is
+        borrowed from it rather than opening a new one; close() gives it back.
+        With the embedded backends.SQLITE backend, dbname is the path to the
+        database file, and there is no pushdown.
+        If a memory_budget (a number of rows) is given, grouping holds no
+        more rows than that in memory, spilling the rest to temporary files
+        (see anpr.spill). Best used with stream=True.
+        If jobs is more than 1, and the search isn't pushed down, the fine
+        passes, grouping and stats are done by that many processes (see
+        combined_parallel()); there is then no need for a memory_budget.
+        '''
+        self.backend = backend
+        self.connection_pool = connection_pool
+        if connection_pool is not None:
+            self.conn = connection_pool.getconn()
+        else:
+            self.conn = backend.connect(dbname, db_password)
+        self.init_search(dbname, filter_lst, group_lst, stats_lst, stream,
+                         itersize, push_down, result_cache, memory_budget, jobs)
+
+    def init_search(self, dbname, filter_lst, group_lst, stats_lst, stream,
+                    itersize, push_down, result_cache, memory_budget, jobs):
+        '''
+        Everything but the db connection, shared with FileSearcher
+        '''
+        self.dbname = dbname
+        self.result_cache = result_cache
+        self.stream = stream
+        self.itersize = itersize
+        self.push_down = push_down
+        self.memory_budget = memory_budget
+        self.jobs = jobs
         for fil in filter_lst:
             assert(isinstance(fil, filters.FilterBase))
         self.filters = filter_lst
-        #compose all the fine pass filters into one function
-        #TODO check that the order is preserved
-        self.fine_pass = compose([fil.fine_pass for fil in filter_lst])
+        self._plan = None
+        #chain the fine passes that do anything into one function
+        self.fine_pass = fine_pass_pipeline(filter_lst, self.columnar)
 
         for group in group_lst:
             assert(isinstance(group, groups.GroupBase))
+        self.groups = group_lst
         self.group = compose([group.group for group in group_lst])
 
         for stat in stats_lst:
             assert(isinstance(stat, stats.BaseStats))
         self.stats = stats_lst
 
+    def close(self):
+        if self.connection_pool is not None:
+            self.connection_pool.putconn(self.conn)
+        else:
+            self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def get_and_filter(self):
         '''
         Go to the DB and apply the filters
         '''
-        cur = self.conn.cursor()
-        sql_filters = sql.SQL(" AND ").join([fil.coarse_pass() for fil in self.filters])
-        if self.filters:
-            cur.execute(sql.SQL("SELECT * from journeys where {};").format(sql_filters))
+        return self.fine_pass(self.coarse_rows())
+
+    def coarse_rows(self):
+        '''
+        The journeys from the db that pass the coarse passes
+        '''
+        query = sql.SQL("SELECT * from journeys{};").format(self.where_clause())
+        if self.stream:
+            rows = self.stream_rows(query)
         else:
-            #no filter means no WHERE
-            cur.execute("SELECT * from journeys;")
-        return self.fine_pass(cur)
+            metrics.metrics.count("db.round_trips")
+            rows = self.conn.cursor()
+            with metrics.metrics.timer("search.query"):
+                self.backend.execute(rows, query)
+        return metrics.metrics.counted(rows, "search.coarse_pass.rows_out")
+
+    def where_clause(self):
+        return self.query_plan().where_clause()
+
+    def query_plan(self):
+        '''
+        The planner.QueryPlan for the filters, made on first use
+        '''
+        if self._plan is None:
+            self._plan = planner.QueryPlan(self.filters, self.backend)
+        return self._plan
+
+    def explain(self, analyze=False):
+        '''
+        How the search will be run, as text: the coarse passes with their
+        estimated rows, the fine passes, whether the grouping and stats are
+        pushed down to the db, and the db's own plan for its query.
+        With analyze the query is run, giving the actual rows and times
+        (Postgres only)
+        '''
+        plan = self.query_plan()
+        plan.estimate(self.conn)
+        lines = plan.describe(
+            lambda query: self.backend.as_string(self.conn, query))
+        if self.can_push_down():
+            lines.append("Groups and stats: pushed down to the db")
+            query, _stat_slices = self.aggregate_query()
+        else:
+            lines.append("Groups and stats: in Python{}".format(
+                ", spilling past {} rows".format(self.memory_budget)
+                if self.memory_budget is not None and self.groups else ""))
+            query = sql.SQL("SELECT * from journeys{}").format(self.where_clause())
+        lines.append("Database plan:")
+        lines += ["  " + line
+                  for line in self.backend.explain(self.conn, query, analyze)]
+        return "\n".join(lines)
+
+    def stream_rows(self, query):
+        '''
+        Run the query on a named (server-side) cursor, yielding the rows
+        as they are fetched
+        '''
+        if self.backend.embedded:
+            #an embedded db's cursor already steps through the rows lazily
+            cur = self.conn.cursor()
+            self.backend.execute(cur, query)
+            for row in cur:
+                yield row
+            return
+        name = "anpr_search_{}".format(next(_stream_cursor_ids))
+        with self.conn.cursor(name=name) as cur:
+            cur.itersize = self.itersize
+            cur.execute(query)
+            n_rows = 0
+            for n_rows, row in enumerate(cur, 1):
+                yield row
+            # The DECLARE, one fetch per itersize rows and the one that found
+            # the end.
+            metrics.metrics.count(
+                "db.round_trips", n_rows // self.itersize + 2)
 
     def combined(self):
         '''
         get the results from the db, apply the filters,
         group then get the statistics for each group of rows
         '''
-        groups = self.group(list(self.get_and_filter()))
-        return self.apply_stats(groups)
+        if self.result_cache is not None:
+            return self.result_cache.get_or_compute(
+                self.dbname, self.spec(), self.backend.data_version(self.conn),
+                self.compute_combined)
+        return self.compute_combined()
+
+    def spec(self):
+        '''
+        A canonical description of the search, for caching results
+        '''
+        return tuple(tuple(cache.spec_key(item) for item in items)
+                     for items in (self.filters, self.groups, self.stats))
+
+    def compute_combined(self):
+        if self.can_push_down():
+            with metrics.metrics.timer("search.sql_aggregate"):
+                return self.combined_sql()
+        if self.jobs > 1:
+            with metrics.metrics.timer("search.parallel"):
+                return self.combined_parallel()
+        rows = self.get_and_filter()
+        if self.memory_budget is not None and self.groups:
+            # The grouping and stats are done together, a partition at a time.
+            grouper = spill.SpillingGrouper(self.groups, self.memory_budget)
+            with metrics.metrics.timer("search.group"):
+                return grouper.aggregate(
+                    rows, self.new_aggregators, self.finalize_stats)
+        if not self.stream:
+            with metrics.metrics.timer("search.fetch_and_filter"):
+                rows = list(rows)
+        # When streaming, the rows are pulled from the db and through the fine
+        # passes by the grouping (or by the stats, if there are no groups), so
+        # the time for that is counted there.
+        with metrics.metrics.timer("search.group"):
+            grouped = self.group(rows)
+        with metrics.metrics.timer("search.stats"):
+            return self.apply_stats(grouped)
+
+    def combined_parallel(self):
+        '''
+        The same as combined(), but with the fine passes, grouping and stats
+        done by a pool of jobs processes. The rows from the db are split into
+        chunks of itersize rows, each of which is made into partial
+        aggregates (see aggregate()) by a worker; these are merged as they
+        come back. Only a few chunks are queued ahead of the workers, so with
+        stream=True the rows are never all in memory at once.
+        '''
+        rows = iter(self.coarse_rows())
+        chunks = iter(lambda: list(itertools.islice(rows, self.itersize)), [])
+        result = None
+        with multiprocessing.Pool(
+                self.jobs, initializer=_init_search_worker,
+                initargs=(self.filters, self.groups, self.stats,
+                          self.columnar)) as pool:
+            pending = collections.deque(
+                pool.apply_async(_search_worker_chunk, (chunk,))
+                for chunk in itertools.islice(chunks, 2 * self.jobs))
+            while pending:
+                partial = pending.popleft().get()
+                for chunk in itertools.islice(chunks, 1):
+                    pending.append(pool.apply_async(_search_worker_chunk, (chunk,)))
+                metrics.metrics.count("search.parallel.chunks")
+                if result is None:
+                    result = partial
+                else:
+                    result = stats.merge_aggregates(result, partial)
+        if result is None:
+            result = self.aggregate(self.group([]))
+        return self.finalize_stats(result)
+
+    def combined_columnar(self):
+        '''
+        The same as combined(), but with the grouping and stats done on
+        NumPy arrays. Needs numpy installed.
+        '''
+        from anpr import columnar
+        if self.backend.embedded or any(fil.needs_fine_pass() for fil in self.filters):
+            columns = columnar.JourneyColumns.from_rows(self.get_and_filter())
+        else:
+            columns = columnar.JourneyColumns.fetch(self.conn, self.where_clause())
+        return columnar.group_and_stat(columns, self.groups, self.stats)
+
+    def can_push_down(self):
+        '''
+        Whether the whole query can be answered by one SQL aggregate query
+        '''
+        return bool(
+            self.push_down and self.stats and not self.backend.embedded
+            and not any(fil.needs_fine_pass() for fil in self.filters)
+            and all(group.sql_key() is not None for group in self.groups)
+            and all(stat.sql_aggregates() is not None for stat in self.stats))
+
+    def aggregate_query(self):
+        '''
+        Build the aggregate query used by combined_sql().
+        The selected columns are the group keys (outermost group first),
+        then for each stat its own extra keys followed by its aggregates.
+        Returns the query and the (start, end) column slice of each stat.
+        '''
+        #compose() applies the last grouper first, so it is the outermost key
+        group_keys = [group.sql_key() for group in reversed(self.groups)]
+        columns = list(group_keys)
+        key_positions = list(range(1, len(group_keys) + 1))
+        stat_slices = []
+        for stat in self.stats:
+            start = len(columns)
+            stat_keys = stat.sql_group_keys()
+            key_positions += range(start + 1, start + len(stat_keys) + 1)
+            columns += stat_keys + stat.sql_aggregates()
+            stat_slices.append((start, len(columns)))
+
+        group_by = sql.SQL("")
+        if key_positions:
+            group_by = sql.SQL(" GROUP BY {}").format(sql.SQL(", ").join(
+                [sql.SQL(str(pos)) for pos in key_positions]))
+        query = sql.SQL("SELECT {} from journeys{}{};").format(
+            sql.SQL(", ").join(columns), self.where_clause(), group_by)
+        return query, stat_slices
+
+    def combined_sql(self):
+        '''
+        The same as combined(), but with the grouping and stats done by the db.
+        Each result row holds partial aggregates, which are merged into the
+        group they belong to.
+        '''
+        query, stat_slices = self.aggregate_query()
+        n_keys = len(self.groups)
+        metrics.metrics.count("db.round_trips")
+        cur = self.conn.cursor()
+        cur.execute(query)
+        if n_keys:
+            result = {}
+        else:
+            result = [stat.aggregator() for stat in self.stats]
+        for row in cur:
+            aggs = [stat.aggregator_from_sql(row[start:end])
+                    for stat, (start, end) in zip(self.stats, stat_slices)]
+            if not n_keys:
+                result = stats.merge_aggregates(result, aggs)
+                continue
+            node = result
+            for key in row[:n_keys - 1]:
+                node = node.setdefault(key, {})
+            key = row[n_keys - 1]
+            if key in node:
+                node[key] = stats.merge_aggregates(node[key], aggs)
+            else:
+                node[key] = aggs
+        return self.finalize_stats(result)
+
+    def export(self, directory, chunk_rows=None):
+        '''
+        Write the filtered journeys (after the fine passes) to a columnar
+        export directory, for offline analysis with FileSearcher. Best done
+        with stream=True, so the rows are never all in memory at once.
+        Returns the number of rows written. Needs numpy installed.
+        '''
+        from anpr import export
+        return export.write_journeys(
+            self.get_and_filter(), directory,
+            chunk_rows or export.DEFAULT_CHUNK_ROWS)
+
+    def captures(self, start, end, cameras=None):
+        '''
+        Stream the (camera, vehicle, direction, ts) captures made from start
+        up to end, optionally only at the given cameras. If captures is
+        partitioned only the partitions covering the time range are read.
+        '''
+        query = sql.SQL(
+            "SELECT camera, vehicle, direction, ts FROM captures "
+            "WHERE ts >= {} AND ts < {}{} ORDER BY ts;").format(
+            sql.Literal(start), sql.Literal(end),
+            sql.SQL(" AND camera IN {}").format(sql.Literal(tuple(cameras)))
+            if cameras is not None else sql.SQL(""))
+        return self.stream_rows(query)
+
+    def segment_times(self, from_cameras=None, to_cameras=None, classes=None,
+                      by_hour=True):
+        '''
+        Travel times between cameras that vehicles were seen at one after the
+        other, from the segment_times summary.
+        Gives {(from camera, to camera): {hour: [min, max, avg, n]}}, with
+        the times in seconds (or without the hours level if not by_hour)
+        '''
+        return self.query_summary(
+            "segment_times", ("from_camera", "to_camera"),
+            [("from_camera", from_cameras), ("to_camera", to_cameras)],
+            classes, by_hour)
+
+    def od_matrix(self, origins=None, destinations=None, classes=None,
+                  by_hour=False):
+        '''
+        Trips by origin and destination camera, from the od_counts summary.
+        Gives {(origin, destination): [min, max, avg, n]}, with the trip
+        times in seconds (or {(origin, destination): {hour: [...]}} if by_hour,
+        the hour being when the trip started)
+        '''
+        return self.query_summary(
+            "od_counts", ("origin", "destination"),
+            [("origin", origins), ("destination", destinations)],
+            classes, by_hour)
+
+    def cameras_within(self, longitude, latitude, metres):
+        '''
+        The cameras within the given distance of a point, nearest first
+        (see anpr.spatial)
+        '''
+        return spatial.cameras_within(self.conn, longitude, latitude, metres)
+
+    def cameras_along(self, path, metres):
+        '''
+        The cameras within the given distance of a path of (longitude,
+        latitude) points, in the order they come along it
+        '''
+        return spatial.cameras_along(self.conn, path, metres)
+
+    def vehicles_between(self, from_camera, to_camera, within=None):
+        '''
+        The vehicles seen at from_camera and later at to_camera, within the
+        given timedelta if any, from the trip index (see anpr.tripindex).
+        Gives {vehicle: shortest time between them in seconds}
+        '''
+        return tripindex.vehicles_between(
+            self.conn, from_camera, to_camera, within)
+
+    def vehicles_passing(self, cameras, within=None):
+        '''
+        The sorted list of vehicles seen at each of the cameras in turn
+        (with any others in between), the lot within the given timedelta if
+        any, from the trip index
+        '''
+        return tripindex.vehicles_passing(self.conn, cameras, within)
+
+    def trip(self, vehicle):
+        '''
+        A vehicle's [(camera, direction, ts)] captures in order, from the
+        trip index, or None if it isn't there
+        '''
+        return tripindex.get_trip(self.conn, vehicle)
+
+    def query_summary(self, view, key_columns, conditions, classes=None,
+                      by_hour=False):
+        '''
+        Query one of the summary views (see anpr.summaries), combining the
+        counts and times over everything except the key columns (and hour of
+        day if by_hour). conditions are (column, allowed values) pairs, where
+        None allows anything.
+        '''
+        where = [sql.SQL("{} IN {}").format(sql.Identifier(column), sql.Literal(tuple(values)))
+                 for column, values in conditions if values is not None]
+        if classes is not None:
+            where.append(sql.SQL("class IN {}").format(sql.Literal(tuple(classes))))
+        keys = [sql.Identifier(column) for column in key_columns]
+        if by_hour:
+            keys.append(sql.SQL("CAST(EXTRACT(HOUR FROM hour) AS integer)"))
+        query = sql.SQL(
+            "SELECT {keys}, sum(n), sum(total_seconds), min(min_seconds), "
+            "max(max_seconds) FROM {view}{where} GROUP BY {positions};").format(
+            keys=sql.SQL(", ").join(keys), view=sql.Identifier(view),
+            where=sql.SQL(" WHERE {}").format(sql.SQL(" AND ").join(where)) if where else sql.SQL(""),
+            positions=sql.SQL(", ").join([sql.SQL(str(i + 1)) for i in range(len(keys))]))
+
+        result = {}
+        cur = self.conn.cursor()
+        cur.execute(query)
+        n_keys = len(key_columns)
+        for row in cur:
+            n, total, min_seconds, max_seconds = row[len(keys):]
+            times = [int(min_seconds), int(max_seconds), int(float(total) / n), int(n)]
+            key = tuple(row[:n_keys])
+            if by_hour:
+                result.setdefault(key, {})[row[n_keys]] = times
+            else:
+                result[key] = times
+        return result
 
     def stat_headers(self):
         out = []
@@ -231,54 +1066,368 @@ class DataSearcher(object):
         return out
 
     def apply_stats(self, group_or_rows):
-        if isinstance(group_or_rows, list):
-            stat_lists = [stats.make_stats(group_or_rows) for stats in self.stats]
-            return [stat for sublist in stat_lists for stat in sublist]
-        elif isinstance(group_or_rows, dict):
-            return {key: self.apply_stats(value) for key, value in group_or_rows.items()}
+        return self.finalize_stats(self.aggregate(group_or_rows))
+
+    def new_aggregators(self):
+        return [stat.aggregator() for stat in self.stats]
+
+    def aggregate(self, group_or_rows):
+        '''
+        Feed the rows (or each group of rows) through a fresh aggregator per
+        stat, in a single pass. The partial results can be combined with
+        stats.merge_aggregates() before being passed to finalize_stats()
+        '''
+        return aggregate(self.stats, group_or_rows)
+
+    def finalize_stats(self, aggregates):
+        if isinstance(aggregates, dict):
+            return {key: self.finalize_stats(value) for key, value in aggregates.items()}
+        stat_lists = [agg.finalize() for agg in aggregates]
+        return [stat for sublist in stat_lists for stat in sublist]
+
+class FileSearcher(DataSearcher):
+    '''
+    A DataSearcher over a journeys export (see anpr.export) rather than the db.
+    The coarse passes are done with each filter's column_mask() over the
+    memory mapped columns; if no filter needs a fine pass, and every group
+    and stat has a vectorized version, the grouping and stats are done on
+    the columns too, otherwise the selected journeys are read back as rows.
+    Needs numpy installed. There is no db, so the db-only searches
+    (captures(), segment_times() and so on) raise a RuntimeError.
+    '''
+    columnar = True
+
+    def __init__(self, directory, filter_lst=[], group_lst=[], stats_lst=[],
+                 memory_budget=None, jobs=1, itersize=DEFAULT_ITERSIZE):
+        from anpr import export
+        self.file = export.JourneyFile(directory)
+        self.connection_pool = None
+        self.init_search(os.path.abspath(directory), filter_lst, group_lst,
+                         stats_lst, stream=True, itersize=itersize,
+                         push_down=False, result_cache=None,
+                         memory_budget=memory_budget, jobs=jobs)
+
+    def _no_db(self):
+        raise RuntimeError("A FileSearcher has no db, it searches {}".format(
+            self.dbname))
+
+    conn = property(_no_db)
+    backend = property(_no_db)
+
+    def close(self):
+        pass
+
+    def selected(self):
+        '''
+        The indices of the journeys that pass every filter's column_mask()
+        '''
+        import numpy as np
+        columns = self.file.journey_columns()
+        mask = np.ones(len(columns), dtype=bool)
+        for fil in self.filters:
+            fil_mask = fil.column_mask(columns)
+            if fil_mask is not None:
+                mask &= fil_mask
+        return np.flatnonzero(mask)
+
+    def coarse_rows(self):
+        return self.file.rows(self.selected())
+
+    def query_plan(self):
+        if self._plan is None:
+            self._plan = planner.QueryPlan(
+                self.filters, backends.POSTGRES, columnar=True)
+        return self._plan
+
+    def explain(self, analyze=False):
+        '''
+        How the search will be run: there is no db, the coarse passes are
+        each filter's column_mask()
+        '''
+        return "\n".join(self.query_plan().describe_fine_passes() + [
+            "Groups and stats: {}".format(
+                "on the columns" if self.on_columns() else "in Python")])
+
+    def on_columns(self):
+        '''
+        Whether the grouping and stats can be done on the columns
+        '''
+        from anpr import columnar
+        return (not any(fil.needs_column_fine_pass() for fil in self.filters)
+                and columnar.can_group_and_stat(self.groups, self.stats))
+
+    def compute_combined(self):
+        if self.on_columns():
+            return self.combined_columnar()
+        return super().compute_combined()
+
+    def combined_columnar(self):
+        from anpr import columnar
+        if any(fil.needs_column_fine_pass() for fil in self.filters):
+            columns = columnar.JourneyColumns.from_rows(self.get_and_filter())
         else:
-            raise Exception("Unknown group type:{}".format(type(group_or_rows)))
+            columns = self.file.journey_columns().take(self.selected())
+        return columnar.group_and_stat(columns, self.groups, self.stats)
 
 
 def main():
     args = parse_args()
-    if args.command_name == "load":
-        do_load_command(args)
-    elif args.command_name == "create":
-        do_create_command(args)
+    configure_metrics(args)
+    try:
+        with metrics.profiling(args.profile, args.profile_file):
+            if args.command_name == "load":
+                do_load_command(args)
+            elif args.command_name == "create":
+                do_create_command(args)
+            elif args.command_name == "summarise":
+                do_summarise_command(args)
+            elif args.command_name == "detach":
+                do_detach_command(args)
+            elif args.command_name == "export":
+                do_export_command(args)
+            elif args.command_name == "index":
+                do_index_command(args)
+            elif args.command_name == "serve":
+                do_serve_command(args)
+    finally:
+        metrics.metrics.report()
+
+def configure_metrics(args):
+    if args.metrics is None:
+        return
+    if args.metrics != "log" and args.metrics_file is None:
+        raise ValueError("--metrics {} needs --metrics-file".format(args.metrics))
+    if args.metrics == "log":
+        logging.basicConfig(level=logging.INFO)
+    metrics.metrics.enabled = True
+    metrics.metrics.sinks.append(metrics.SINKS[args.metrics](args.metrics_file))
 
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Script for loading data from anpr spreadsheets into a db")
     parser.add_argument(
-        "--dbname", required=True, help="name of the db to create")
+        "--dbname", required=True,
+        help="name of the db to create (the path to the file for sqlite)")
+    parser.add_argument(
+        "--password", help="password to the database")
+    parser.add_argument(
+        "--user", help="the username used to access the database")
+    parser.add_argument(
+        "--backend", default=backends.POSTGRES.name,
+        choices=sorted(backends.BACKENDS),
+        help="where to keep the data: a postgres server, or a local sqlite "
+        "file (no bulk loads, partitions, summaries or exports)")
     parser.add_argument(
-        "--password", required=True, help="password to the database")
+        "--metrics", choices=sorted(metrics.SINKS),
+        help="record stage timings and counters, and write them to the log, "
+        "a JSON lines file or a Prometheus textfile when done")
     parser.add_argument(
-        "--user", required=True,
-        help="the username used to access the database")
+        "--metrics-file", help="file to write the metrics to")
+    parser.add_argument(
+        "--profile", choices=metrics.PROFILE_MODES,
+        help="profile the command with cProfile, or trace its memory "
+        "allocations with tracemalloc")
+    parser.add_argument(
+        "--profile-file", default="anpr.prof",
+        help="file to write the profile to")
     subparsers = parser.add_subparsers(dest="command_name")
 
     load = subparsers.add_parser(
         "load", help="Load data into an existing database")
     load.add_argument(
         "xlsx_dir", help="path to the directory where the spreadsheets are")
+    load.add_argument(
+        "--bulk", action="store_true",
+        help="buffer trips and write them with COPY instead of row by row")
+    load.add_argument(
+        "--defer-constraints", action="store_true",
+        help="drop the captures and trip index indexes, and the captures "
+        "foreign keys, for the load, and rebuild and validate them once at "
+        "the end")
+    load.add_argument(
+        "--jobs", type=int, default=1,
+        help="number of processes to parse the spreadsheets with")
+    load.add_argument(
+        "--batch-size", type=int, default=bulk.BULK_BATCH_SIZE,
+        help="captures to buffer per COPY batch when using --bulk")
+
+    subparsers.add_parser(
+        "summarise",
+        help="Build, or refresh, the travel time summaries used by "
+        "DataSearcher.segment_times() and od_matrix()")
 
     create = subparsers.add_parser(
         "create", help="Create the database")
     create.add_argument(
         "cameras", help="Path to the file that defines the cameras")
+    create.add_argument(
+        "--partition", default=partitions.DEFAULT_GRANULARITY,
+        choices=partitions.GRANULARITIES + ("none",),
+        help="partition captures by the day or month of their timestamp")
+    create.add_argument(
+        "--trip-index", action="store_true",
+        help="also make the trip index (see anpr index), kept up to date "
+        "by every load. It costs a row per pair of cameras in each trip, "
+        "so slows loads down")
+
+    detach = subparsers.add_parser(
+        "detach",
+        help="Detach old captures partitions, leaving them as separate tables")
+    detach.add_argument(
+        "before", type=lambda s: datetime.datetime.strptime(s, "%Y-%m-%d"),
+        help="detach partitions ending on or before this date (YYYY-MM-DD)")
+
+    subparsers.add_parser(
+        "index",
+        help="Build, or rebuild, the trip index used by "
+        "DataSearcher.vehicles_between() and vehicles_passing() from "
+        "captures; later loads then keep it up to date")
+
+    serve = subparsers.add_parser(
+        "serve",
+        help="Serve searches as JSON over HTTP, keeping connections, "
+        "compiled filters and results between requests")
+    serve.add_argument(
+        "--host", default="127.0.0.1", help="address to listen on")
+    serve.add_argument(
+        "--port", type=int, default=8080, help="port to listen on")
+    serve.add_argument(
+        "--socket", help="listen on this Unix socket instead of a port")
+    serve.add_argument(
+        "--pool-size", type=int, default=8,
+        help="db connections to keep, and searches to run at once")
+    serve.add_argument(
+        "--cache-entries", type=int, default=cache.DEFAULT_MAX_ENTRIES,
+        help="search results to keep in memory")
+    serve.add_argument(
+        "--cache-dir", help="also keep search results in this directory")
+    serve.add_argument(
+        "--stream", action="store_true",
+        help="fetch search rows through server-side cursors")
+
+    export = subparsers.add_parser(
+        "export",
+        help="Write a table to a columnar directory for offline analysis "
+        "(needs numpy)")
+    export.add_argument("table", choices=("journeys", "captures"))
+    export.add_argument("output", help="directory to write the export to")
+    export.add_argument(
+        "--chunk-rows", type=int, default=100000,
+        help="rows to fetch and write at a time")
 
     args = parser.parse_args()
     return args
 
 def do_load_command(args):
-    for spreadsheet_path in glob.glob(
-            os.path.join(os.path.abspath(args.xlsx_dir), "*.xlsx")):
-        print("loading {!r}...".format(spreadsheet_path))
-        DataLoader(
-            spreadsheet_path, db_connection=make_connection(args)).load()
-        print("loaded")
+    spreadsheet_paths = glob.glob(
+        os.path.join(os.path.abspath(args.xlsx_dir), "*.xlsx"))
+    backend = backends.BACKENDS[args.backend]
+    if args.defer_constraints:
+        require_postgres(args)
+        deferred.defer(make_connection(args))
+    failed = []
+    rate = bulk.LoadRate()
+    if args.jobs > 1:
+        failed = load_parallel(
+            spreadsheet_paths, make_connection(args), args.jobs,
+            bulk_load=args.bulk, batch_size=args.batch_size, backend=backend)
+    else:
+        for spreadsheet_path in spreadsheet_paths:
+            print("loading {!r}...".format(spreadsheet_path))
+            DataLoader(
+                spreadsheet_path, db_connection=make_connection(args),
+                bulk_load=args.bulk, batch_size=args.batch_size,
+                backend=backend).load()
+            print("loaded")
+    metrics.metrics.add_time("load.workbooks", rate.elapsed())
+    metrics.metrics.set_rates(
+        rate.elapsed(), ["load.sheets_parsed", "load.rows_parsed",
+                         "load.sheets_written", "load.trips_written"])
+
+    problems = []
+    if not backend.embedded:
+        conn = make_connection(args)
+        # Also picks up after an earlier deferred load that didn't finish.
+        if deferred.pending(conn):
+            with metrics.metrics.timer("load.restore_constraints"):
+                problems = deferred.restore(conn)
+
+        # Only refresh the summaries if they've been asked for, the first
+        # build is left to the summarise command.
+        if summaries.summaries_exist(conn):
+            print("refreshing summaries...")
+            with metrics.metrics.timer("load.refresh_summaries"):
+                summaries.refresh_summaries(conn)
+
+    if failed:
+        raise RuntimeError("{} workbook(s) failed to load: {}".format(
+            len(failed), ", ".join(path for path, _e in failed)))
+    if problems:
+        raise RuntimeError("Loaded, but with broken constraints: {}".format(
+            "; ".join(problems)))
+
+def do_summarise_command(args):
+    require_postgres(args)
+    conn = make_connection(args)
+    if summaries.summaries_exist(conn):
+        print("refreshing summaries...")
+        summaries.refresh_summaries(conn)
+    else:
+        print("creating summaries...")
+        summaries.create_summaries(conn)
+    print("done")
+
+def do_detach_command(args):
+    require_postgres(args)
+    conn = make_connection(args)
+    if partitions.get_granularity(conn) is None:
+        raise RuntimeError("captures is not partitioned")
+    for name in partitions.detach_partitions_before(conn, args.before):
+        print("detached {}".format(name))
+
+def do_index_command(args):
+    require_postgres(args)
+    conn = make_connection(args)
+    print("building trip index...")
+    with metrics.metrics.timer("index.rebuild"):
+        tripindex.rebuild(conn)
+    print("done")
+
+def do_serve_command(args):
+    from anpr import serve
+    backend = backends.BACKENDS[args.backend]
+    connection_pool = None
+    if not backend.embedded:
+        connection_pool = make_pool(
+            args.dbname, args.password, user=args.user, maxconn=args.pool_size)
+    # Cheap, and what GET /metrics reports.
+    metrics.metrics.enabled = True
+    service = serve.SearchService(
+        DataSearcher, args.dbname, backend, password=args.password,
+        connection_pool=connection_pool, pool_size=args.pool_size,
+        result_cache=cache.ResultCache(args.cache_entries, args.cache_dir),
+        stream=args.stream)
+    server = serve.make_server(service, args.host, args.port, args.socket)
+    print("serving on {}".format(
+        args.socket or "http://{}:{}".format(args.host, args.port)))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+def do_export_command(args):
+    from anpr import export
+    require_postgres(args)
+    conn = make_connection(args)
+    if args.table == "captures":
+        n_rows = export.export_captures(conn, args.output, args.chunk_rows)
+    else:
+        n_rows = export.export_journeys(
+            conn, args.output, chunk_rows=args.chunk_rows)
+    print("exported {} rows to {}".format(n_rows, args.output))
 
 def do_create_command(args):
     """Create the initial database tables.
@@ -330,6 +1479,12 @@ def do_create_command(args):
                        if e.name == "Description"][0]
         cameras.append((name, description, x, y))
 
+    backend = backends.BACKENDS[args.backend]
+    if backend.embedded:
+        with make_connection(args) as conn:
+            backend.create_schema(conn, cameras)
+        return
+
     with make_connection(args) as conn:
         with conn.cursor() as cur:
             cur.execute("SELECT postgis_full_version();")
@@ -349,14 +1504,16 @@ def do_create_command(args):
                 "location geometry NOT NULL"
                 ");"
             )
-            # And populate it.
-            for name, description, x, y in cameras:
-                ewkt = "SRID=4326;POINT({:.6f} {:.6f})".format(x, y)
-                cur.execute(
-                    "INSERT INTO cameras (id, description, location) "
-                    "VALUES (%s, %s, ST_GeomFromEWKT(%s));",
-                    (name, description, ewkt)
-                )
+            # And populate it, in one statement.
+            psycopg2.extras.execute_values(
+                cur,
+                "INSERT INTO cameras (id, description, location) VALUES %s;",
+                [(name, description, spatial.point_ewkt(x, y))
+                 for name, description, x, y in cameras],
+                template="(%s, %s, ST_GeomFromEWKT(%s))",
+                page_size=max(len(cameras), 1)
+            )
+            spatial.create_indexes(cur)
 
         with conn.cursor() as cur:
             # (Re)make the vehicle class enum type.
@@ -406,20 +1563,52 @@ def do_create_command(args):
                 "DROP TABLE IF EXISTS captures CASCADE;"
             )
             cur.execute(
-                "CREATE TABLE captures ("
-                "id integer PRIMARY KEY GENERATED ALWAYS AS IDENTITY, "
-                "camera varchar(10) NOT NULL REFERENCES cameras (id), "
-                "vehicle integer NOT NULL REFERENCES vehicles (id), "
-                "direction direction NOT NULL, "
-                "ts timestamptz NOT NULL"
-                ");"
+                "DROP TABLE IF EXISTS captures_partitioning;"
+            )
+            if args.partition == "none":
+                cur.execute(
+                    "CREATE TABLE captures ("
+                    "id integer PRIMARY KEY GENERATED ALWAYS AS IDENTITY, "
+                    "camera varchar(10) NOT NULL REFERENCES cameras (id), "
+                    "vehicle integer NOT NULL REFERENCES vehicles (id), "
+                    "direction direction NOT NULL, "
+                    "ts timestamptz NOT NULL"
+                    ");"
+                )
+            else:
+                partitions.create_partitioned_captures(cur, args.partition)
+            # And the trip index, if asked for, filled in as trips are
+            # loaded.
+            cur.execute(
+                "DROP TABLE IF EXISTS trips, camera_pairs;"
             )
+            if args.trip_index:
+                tripindex.create_tables(cur)
+
+        with conn.cursor() as cur:
+            # The trip data has just been thrown away, so has the record of
+            # which sheets were loaded.
+            cur.execute(
+                "DROP TABLE IF EXISTS load_manifest;"
+            )
+            cur.execute(LOAD_MANIFEST_TABLE_SQL)
+            # So has any record of indexes deferred by an unfinished load;
+            # the new tables come with their own.
+            cur.execute(
+                "DROP TABLE IF EXISTS deferred_ddl;"
+            )
+            cache.bump_data_version(cur)
 
 def make_connection(args):
-    conn = psy.connect(
-        dbname=args.dbname, user=args.user, password=args.password)
+    conn = backends.BACKENDS[args.backend].connect(
+        args.dbname, password=args.password, user=args.user)
     return conn
 
+def require_postgres(args):
+    if backends.BACKENDS[args.backend].embedded:
+        raise RuntimeError("{} needs the postgres backend".format(
+            args.command_name))
+
 
 if __name__=="__main__":
     main()
@@ -0,0 +1,340 @@
+"""Storage backends: where the trip data lives.
+
+Postgres (with PostGIS) is the main backend, and the only one with bulk COPY
+loads, partitioning, summaries, the trip index and SQL pushdown of groups and stats. The
+embedded SQLite backend keeps everything in a single local file, with the
+same tables, load manifest and coarse-pass filtering, so small analyses and
+benchmarks can be run without a database server.
+
+Queries are built with psycopg2.sql as usual; the SQLite backend renders
+them into SQLite's dialect and parameters itself. Filters can give a
+different coarse pass for SQLite with sqlite_coarse_pass().
+"""
+import datetime
+import sqlite3
+
+import psycopg2 as psy
+from psycopg2 import sql
+
+from anpr import cache
+from anpr import partitions
+from anpr import tripindex
+
+VEHICLE_CLASSES = (
+    "Bus_Coach", "Car", "LGV<3.5T", "Motorcycle", "OGV1", "OGV2", "Other",
+    "Taxi")
+DIRECTIONS = ("N", "S", "E", "W", "IN", "OUT")
+
+
+class PostgresBackend(object):
+    name = "postgres"
+    embedded = False
+
+    def connect(self, dbname, password=None, user=None):
+        return psy.connect(dbname=dbname, user=user, password=password)
+
+    def execute(self, cursor, query, params=None):
+        cursor.execute(query, params)
+
+    def coarse_pass(self, fil):
+        return fil.coarse_pass()
+
+    def as_string(self, conn, query):
+        return query.as_string(conn)
+
+    def explain(self, conn, query, analyze=False):
+        '''
+        The db's plan for the query, as lines of text
+        '''
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("EXPLAIN {}{}").format(
+                sql.SQL("ANALYZE ") if analyze else sql.SQL(""), query))
+            return [line for line, in cur.fetchall()]
+
+    def data_version(self, conn):
+        return cache.get_data_version(conn)
+
+    def partition_router(self, conn):
+        return partitions.PartitionRouter.for_connection(conn)
+
+    def trip_index(self, conn):
+        return tripindex.TripIndexWriter.for_connection(conn)
+
+    def loaded_sheets(self, conn, workbook_hash, manifest_table_sql):
+        with conn.cursor() as cur:
+            cur.execute(manifest_table_sql)
+            cur.execute(
+                "SELECT sheet_title FROM load_manifest "
+                "WHERE workbook_hash = %s;",
+                (workbook_hash,))
+            loaded = {title for title, in cur.fetchall()}
+        conn.commit()
+        return loaded
+
+    def record_sheet(self, conn, workbook_hash, sheet_title, workbook_path,
+                     n_trips):
+        with conn.cursor() as cur:
+            cur.execute(
+                "INSERT INTO load_manifest "
+                "(workbook_hash, sheet_title, workbook_path, n_trips) "
+                "VALUES (%s, %s, %s, %s);",
+                (workbook_hash, sheet_title, workbook_path, n_trips))
+            cache.bump_data_version(cur)
+
+    def insert_trip(self, cursor, veh_class, captures):
+        cursor.execute(
+            "INSERT INTO vehicles (class) VALUES (%s)"
+            "RETURNING id;",
+            (veh_class,)
+        )
+        vehicle_id, = cursor.fetchone()
+
+        for camera, direction, ts in captures:
+            cursor.execute(
+                "INSERT INTO captures (camera, vehicle, direction, ts)"
+                "VALUES (%s, %s, %s, %s);",
+                (camera, vehicle_id, direction, ts)
+            )
+        return vehicle_id
+
+
+def sqlite_value(value):
+    '''
+    A query parameter as the SQLite backend stores it. Done here rather
+    than with sqlite3.register_adapter(), which would change how every
+    other sqlite3 user in the process stores datetimes.
+    '''
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(" ")
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return value
+
+
+def _convert_timestamp(value):
+    text = value.decode("utf-8")
+    if "." in text:
+        return datetime.datetime.strptime(text, "%Y-%m-%d %H:%M:%S.%f")
+    return datetime.datetime.strptime(text, "%Y-%m-%d %H:%M:%S")
+
+
+def _convert_interval(value):
+    return datetime.timedelta(seconds=float(value))
+
+
+def _convert_sites(value):
+    return value.decode("utf-8").strip(">").split(">")
+
+
+def sqlite_sites(sites):
+    '''
+    How a journey's list of sites is kept by the SQLite backend: ">" before
+    and after each, so any one can be found with instr()
+    '''
+    return ">" + ">".join(sites) + ">"
+
+
+# Timestamps are kept as ISO 8601 text, which sorts in time order, and
+# intervals as seconds (see sqlite_value()). Columns are declared with these
+# type names so that they are converted back when read; converters are
+# global to sqlite3, so the names are anpr's own, leaving the stdlib's
+# "timestamp" converter alone.
+SQLITE_CONVERTERS = {
+    "anpr_timestamp": _convert_timestamp,
+    "anpr_interval": _convert_interval,
+    "anpr_sites": _convert_sites,
+}
+for _type_name, _converter in SQLITE_CONVERTERS.items():
+    sqlite3.register_converter(_type_name, _converter)
+
+
+def _sqlite_in(values):
+    return "({})".format(", ".join("'{}'".format(v) for v in values))
+
+
+SQLITE_SCHEMA_SQL = [
+    "CREATE TABLE IF NOT EXISTS cameras ("
+    "id text PRIMARY KEY, "
+    "description text, "
+    "longitude real NOT NULL, "
+    "latitude real NOT NULL"
+    ");",
+    "CREATE TABLE IF NOT EXISTS vehicles ("
+    "id INTEGER PRIMARY KEY, "
+    "class text NOT NULL CHECK (class IN {})"
+    ");".format(_sqlite_in(VEHICLE_CLASSES)),
+    "CREATE TABLE IF NOT EXISTS captures ("
+    "id INTEGER PRIMARY KEY, "
+    "camera text NOT NULL REFERENCES cameras (id), "
+    "vehicle integer NOT NULL REFERENCES vehicles (id), "
+    "direction text NOT NULL CHECK (direction IN {}), "
+    "ts anpr_timestamp NOT NULL"
+    ");".format(_sqlite_in(DIRECTIONS)),
+    "CREATE INDEX IF NOT EXISTS captures_camera_ts ON captures (camera, ts);",
+    "CREATE INDEX IF NOT EXISTS captures_vehicle ON captures (vehicle);",
+    "CREATE TABLE IF NOT EXISTS journeys ("
+    "journey_id INTEGER PRIMARY KEY, "
+    "timestamp anpr_timestamp, "
+    "class text, "
+    "total_trip_time anpr_interval, "
+    "chain text, "
+    "trip_destinations_and_time text, "
+    "journey_end_time anpr_timestamp, "
+    "sites anpr_sites NOT NULL"
+    ");",
+    "CREATE INDEX IF NOT EXISTS journeys_class ON journeys (class);",
+    "CREATE INDEX IF NOT EXISTS journeys_timestamp ON journeys (timestamp);",
+    "CREATE TABLE IF NOT EXISTS load_manifest ("
+    "workbook_hash text NOT NULL, "
+    "sheet_title text NOT NULL, "
+    "workbook_path text NOT NULL, "
+    "n_trips integer NOT NULL, "
+    "loaded_at anpr_timestamp NOT NULL DEFAULT CURRENT_TIMESTAMP, "
+    "PRIMARY KEY (workbook_hash, sheet_title)"
+    ");",
+    "CREATE TABLE IF NOT EXISTS data_version ("
+    "id integer PRIMARY KEY CHECK (id = 1), "
+    "version integer NOT NULL"
+    ");",
+]
+
+
+class SQLiteBackend(object):
+    name = "sqlite"
+    embedded = True
+
+    def connect(self, dbname, password=None, user=None):
+        '''
+        Open (or create) the database file dbname; there are no users or
+        passwords
+        '''
+        conn = sqlite3.connect(dbname, detect_types=sqlite3.PARSE_DECLTYPES)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        return conn
+
+    def render(self, query):
+        '''
+        Turn a psycopg2.sql query into SQLite's dialect: the query string,
+        with a ? for each literal, and the list of their values
+        '''
+        params = []
+
+        def render_part(part):
+            if isinstance(part, sql.Composed):
+                return "".join(render_part(p) for p in part.seq)
+            if isinstance(part, sql.SQL):
+                return part.string
+            if isinstance(part, sql.Identifier):
+                strings = getattr(part, "strings", None) or (part.string,)
+                return ".".join(
+                    '"{}"'.format(s.replace('"', '""')) for s in strings)
+            if isinstance(part, sql.Literal):
+                value = part.wrapped
+                if isinstance(value, tuple):
+                    # psycopg2 renders a tuple as a parenthesised list.
+                    params.extend(sqlite_value(v) for v in value)
+                    return "({})".format(", ".join("?" * len(value)))
+                params.append(sqlite_value(value))
+                return "?"
+            raise TypeError("Can't render {!r} for SQLite".format(part))
+
+        return render_part(query), params
+
+    def execute(self, cursor, query, params=None):
+        if isinstance(query, sql.Composable):
+            query, params = self.render(query)
+        else:
+            params = [sqlite_value(value) for value in params or ()]
+        cursor.execute(query, params)
+
+    def coarse_pass(self, fil):
+        return fil.sqlite_coarse_pass()
+
+    def as_string(self, conn, query):
+        text, params = self.render(query)
+        return "{} {}".format(text, params) if params else text
+
+    def explain(self, conn, query, analyze=False):
+        '''
+        SQLite's query plan, which has no row estimates or ANALYZE
+        '''
+        text, params = self.render(query)
+        rows = conn.execute("EXPLAIN QUERY PLAN " + text, params).fetchall()
+        return [detail for _id, _parent, _unused, detail in rows]
+
+    def create_schema(self, conn, cameras=()):
+        '''
+        (Re)make the tables for the cameras and trip data, with the given
+        (name, description, longitude, latitude) cameras, as `anpr create`
+        does. An existing journeys table is kept.
+        '''
+        for table in ("captures", "vehicles", "cameras", "load_manifest"):
+            conn.execute("DROP TABLE IF EXISTS {};".format(table))
+        for statement in SQLITE_SCHEMA_SQL:
+            conn.execute(statement)
+        conn.executemany(
+            "INSERT OR REPLACE INTO cameras (id, description, longitude, latitude) "
+            "VALUES (?, ?, ?, ?);", cameras)
+        self.bump_data_version(conn.cursor())
+        conn.commit()
+
+    def bump_data_version(self, cursor):
+        cursor.execute(
+            "INSERT INTO data_version (id, version) VALUES (1, 1) "
+            "ON CONFLICT (id) DO UPDATE SET version = version + 1;")
+
+    def data_version(self, conn):
+        row = conn.execute("SELECT version FROM data_version;").fetchone()
+        return row[0] if row else 0
+
+    def partition_router(self, conn):
+        return None
+
+    def trip_index(self, conn):
+        return None
+
+    def loaded_sheets(self, conn, workbook_hash, manifest_table_sql):
+        rows = conn.execute(
+            "SELECT sheet_title FROM load_manifest WHERE workbook_hash = ?;",
+            (workbook_hash,)).fetchall()
+        return {title for title, in rows}
+
+    def record_sheet(self, conn, workbook_hash, sheet_title, workbook_path,
+                     n_trips):
+        cur = conn.cursor()
+        cur.execute(
+            "INSERT INTO load_manifest "
+            "(workbook_hash, sheet_title, workbook_path, n_trips) "
+            "VALUES (?, ?, ?, ?);",
+            (workbook_hash, sheet_title, workbook_path, n_trips))
+        self.bump_data_version(cur)
+
+    def insert_trip(self, cursor, veh_class, captures):
+        cursor.execute("INSERT INTO vehicles (class) VALUES (?);", (veh_class,))
+        vehicle_id = cursor.lastrowid
+        cursor.executemany(
+            "INSERT INTO captures (camera, vehicle, direction, ts) "
+            "VALUES (?, ?, ?, ?);",
+            [(camera, vehicle_id, direction, sqlite_value(ts))
+             for camera, direction, ts in captures])
+        return vehicle_id
+
+    def insert_journeys(self, conn, rows):
+        '''
+        Add (timestamp, class, total_trip_time, chain, details, end time,
+        sites) journeys rows
+        '''
+        cur = conn.cursor()
+        cur.executemany(
+            "INSERT INTO journeys (timestamp, class, total_trip_time, chain, "
+            "trip_destinations_and_time, journey_end_time, sites) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?);",
+            (tuple(sqlite_value(v) for v in row[:6]) + (sqlite_sites(row[6]),)
+             for row in rows))
+        self.bump_data_version(cur)
+        conn.commit()
+
+
+POSTGRES = PostgresBackend()
+SQLITE = SQLiteBackend()
+BACKENDS = {backend.name: backend for backend in (POSTGRES, SQLITE)}
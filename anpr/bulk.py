@@ -0,0 +1,133 @@
+"""Bulk loading of trip data into the vehicles/captures tables.
+
+Rather than one INSERT per vehicle and per capture, parsed trips are buffered
+in memory and written with COPY FROM STDIN a batch at a time. Vehicle ids are
+reserved from the table's identity sequence in blocks, so no RETURNING round
+trip is needed to link captures to their vehicle.
+"""
+import io
+import time
+
+from anpr.metrics import metrics
+
+
+BULK_BATCH_SIZE = 50000
+VEHICLE_ID_BLOCK_SIZE = 10000
+
+_COPY_ESCAPES = str.maketrans({
+    "\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+
+def copy_text(value):
+    '''
+    Format a value as a field of COPY's text format
+    '''
+    if value is None:
+        return "\\N"
+    return str(value).translate(_COPY_ESCAPES)
+
+
+class IdBlockAllocator(object):
+    '''
+    Hands out ids for a table's identity column, reserving them from the
+    column's sequence a block at a time.
+    '''
+    def __init__(self, conn, table="vehicles", column="id",
+                 block_size=VEHICLE_ID_BLOCK_SIZE):
+        self.conn = conn
+        self.table = table
+        self.column = column
+        self.block_size = block_size
+        self._ids = iter(())
+
+    def next_id(self):
+        try:
+            return next(self._ids)
+        except StopIteration:
+            self._ids = iter(self.reserve(self.block_size))
+            return next(self._ids)
+
+    def reserve(self, n):
+        metrics.count("db.round_trips")
+        with self.conn.cursor() as cur:
+            cur.execute(
+                "SELECT nextval(pg_get_serial_sequence(%s, %s)) "
+                "FROM generate_series(1, %s);",
+                (self.table, self.column, n))
+            return [id_ for id_, in cur.fetchall()]
+
+
+class CopyWriter(object):
+    '''
+    Buffers vehicles and their captures, and writes them to the db with COPY
+    whenever batch_size captures are pending (and on flush()).
+
+    Nothing is committed; that is left to the caller.
+    '''
+    def __init__(self, conn, batch_size=BULK_BATCH_SIZE,
+                 id_block_size=VEHICLE_ID_BLOCK_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self.ids = IdBlockAllocator(conn, block_size=id_block_size)
+        self.n_vehicles = 0
+        self.n_captures = 0
+        self._reset()
+
+    def _reset(self):
+        self._vehicles = io.StringIO()
+        self._captures = io.StringIO()
+        self._pending = 0
+
+    def add_trip(self, veh_class, captures):
+        '''
+        Queue one vehicle and its list of (camera, direction, ts) captures
+        '''
+        vehicle_id = self.ids.next_id()
+        self._vehicles.write(
+            "{}\t{}\n".format(vehicle_id, copy_text(veh_class)))
+        for camera, direction, ts in captures:
+            self._captures.write("{}\t{}\t{}\t{}\n".format(
+                copy_text(camera), vehicle_id, copy_text(direction),
+                copy_text(ts)))
+        self.n_vehicles += 1
+        self.n_captures += len(captures)
+        self._pending += len(captures)
+        if self._pending >= self.batch_size:
+            self.flush()
+        return vehicle_id
+
+    def flush(self):
+        if not self._vehicles.tell():
+            return
+        self._vehicles.seek(0)
+        self._captures.seek(0)
+        metrics.count("db.round_trips", 2)
+        with metrics.timer("load.copy"), self.conn.cursor() as cur:
+            # Vehicles first, the captures reference them.
+            cur.copy_expert(
+                "COPY vehicles (id, class) FROM STDIN;", self._vehicles)
+            cur.copy_expert(
+                "COPY captures (camera, vehicle, direction, ts) FROM STDIN;",
+                self._captures)
+        self._reset()
+
+
+class LoadRate(object):
+    '''
+    Keeps track of how many rows have been loaded and how quickly
+    '''
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.n_rows = 0
+
+    def add(self, n_rows):
+        self.n_rows += n_rows
+
+    def elapsed(self):
+        return time.perf_counter() - self.start
+
+    def __str__(self):
+        elapsed = self.elapsed()
+        rate = self.n_rows / elapsed if elapsed else 0.0
+        return "{} rows in {:.1f}s ({:.0f} rows/s)".format(
+            self.n_rows, elapsed, rate)
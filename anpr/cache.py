@@ -0,0 +1,217 @@
+"""Caching of DataSearcher results.
+
+Results are keyed by a fingerprint of the database, the filter, group and
+stats chain, and the data version. The data version is a counter in the
+database that is bumped whenever trip data is loaded, so a cached result is
+never served once the data it was computed from has changed.
+
+There are two tiers: an in-process LRU, and optionally a directory on disk,
+evicted oldest-first when it grows over a size limit.
+"""
+import collections
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+
+from anpr.metrics import metrics
+
+DEFAULT_MAX_ENTRIES = 128
+DEFAULT_MAX_DISK_BYTES = 256 * 1024 * 1024
+
+DATA_VERSION_TABLE_SQL = (
+    "CREATE TABLE IF NOT EXISTS data_version ("
+    "id boolean PRIMARY KEY DEFAULT true CHECK (id), "
+    "version bigint NOT NULL"
+    ");"
+)
+
+
+def bump_data_version(cursor):
+    '''
+    Mark the trip data as changed, in the same transaction as the change
+    '''
+    cursor.execute(DATA_VERSION_TABLE_SQL)
+    cursor.execute(
+        "INSERT INTO data_version (version) VALUES (1) "
+        "ON CONFLICT (id) DO UPDATE SET version = data_version.version + 1;")
+
+
+def get_data_version(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('data_version') IS NOT NULL;")
+        exists, = cur.fetchone()
+        if not exists:
+            return 0
+        cur.execute("SELECT version FROM data_version;")
+        row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def spec_key(obj):
+    '''
+    A canonical description of a filter, grouper or stat: its type and
+    public attributes
+    '''
+    cls = type(obj)
+    attrs = sorted((name, repr(value)) for name, value in vars(obj).items()
+                   if not name.startswith("_"))
+    return (cls.__module__, cls.__qualname__, tuple(attrs))
+
+
+def fingerprint(*parts):
+    return hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+
+
+class LRUCache(object):
+    '''
+    Safe to share between threads (e.g. the request threads of anpr serve)
+    '''
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        '''
+        The cached value, or None if there isn't one
+        '''
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                return None
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class DiskCache(object):
+    '''
+    Pickled results in a directory, one file per key. Reading an entry marks
+    it as recently used; the least recently used are deleted once the
+    directory holds more than max_bytes.
+    '''
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".pickle")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, "rb") as infile:
+                value = pickle.load(infile)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as outfile:
+                pickle.dump(value, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pickle"):
+                # Another process or thread may have removed it already.
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _mtime, size, _path in entries)
+        for _mtime, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".pickle"):
+                try:
+                    os.unlink(entry.path)
+                except OSError:
+                    pass
+
+
+class ResultCache(object):
+    '''
+    The cache for DataSearcher results. Share one between searchers for them
+    to benefit from each other's results, including searchers in different
+    threads. Two threads missing on the same search both compute it.
+    '''
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, directory=None,
+                 max_disk_bytes=DEFAULT_MAX_DISK_BYTES):
+        self.memory = LRUCache(max_entries)
+        self.disk = None
+        if directory is not None:
+            self.disk = DiskCache(directory, max_disk_bytes)
+        self._data_versions = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, db_key, spec, data_version, compute):
+        '''
+        The cached result for this db, search spec and data version, or the
+        result of compute() (which is then cached)
+        '''
+        with self._lock:
+            if self._data_versions.get(db_key, data_version) != data_version:
+                # The data has changed, so free up the memory tier rather
+                # than wait for stale entries to age out. (The disk tier may
+                # be shared with other processes, so its entries are left to
+                # age out.)
+                self.memory.clear()
+            self._data_versions[db_key] = data_version
+
+        key = fingerprint(db_key, spec, data_version)
+        result = self.memory.get(key)
+        if result is not None:
+            metrics.count("cache.memory_hits")
+            return result
+        if self.disk is not None:
+            result = self.disk.get(key)
+            if result is not None:
+                metrics.count("cache.disk_hits")
+                self.memory.put(key, result)
+                return result
+
+        metrics.count("cache.misses")
+        result = compute()
+        self.memory.put(key, result)
+        if self.disk is not None:
+            self.disk.put(key, result)
+        return result
+
+    def clear(self):
+        self.memory.clear()
+        if self.disk is not None:
+            self.disk.clear()
@@ -0,0 +1,195 @@
+"""Columnar (NumPy) version of the group and stats pipeline.
+
+Journeys are held as parallel arrays rather than tuples of datetime objects,
+so groupers and stats work on whole arrays at once. Needs numpy, which is an
+optional dependency (pip install anpr[columnar]).
+"""
+import datetime
+import itertools
+
+import numpy as np
+from psycopg2 import sql
+
+from anpr import groups
+from anpr import stats
+
+TIMESTAMP_COLUMN_INDEX = 1
+CLASS_COLUMN_INDEX = 2
+TOTAL_TIME_COLUMN_INDEX = 3
+
+EPOCH = datetime.datetime(1970, 1, 1)
+FETCH_CHUNK_ROWS = 100000
+
+_fetch_cursor_ids = itertools.count()
+
+
+class JourneyColumns(object):
+    '''
+    Journeys as arrays:
+    journey_id: int64
+    timestamp: int64 seconds since the epoch (of the timestamp as stored,
+        with no time zone conversion)
+    class_codes: integer index into classes
+    trip_time: float64 seconds
+    '''
+    def __init__(self, journey_id, timestamp, class_codes, classes, trip_time):
+        self.journey_id = journey_id
+        self.timestamp = timestamp
+        self.class_codes = class_codes
+        self.classes = classes
+        self.trip_time = trip_time
+
+    def __len__(self):
+        return len(self.journey_id)
+
+    @classmethod
+    def from_columns(cls, journey_ids, timestamps, veh_classes, trip_times):
+        '''
+        Build from sequences of ids, epoch seconds, class names and trip
+        times in seconds
+        '''
+        classes, class_codes = np.unique(
+            np.array(veh_classes, dtype=object).astype(str), return_inverse=True)
+        return cls(
+            np.array(journey_ids, dtype=np.int64),
+            np.array(timestamps, dtype=np.int64),
+            class_codes.astype(np.int64),
+            [str(c) for c in classes],
+            np.array(trip_times, dtype=np.float64))
+
+    @classmethod
+    def from_rows(cls, rows):
+        '''
+        Build from journeys rows, e.g. the output of a fine pass
+        '''
+        columns = ([], [], [], [])
+        for row in rows:
+            columns[0].append(row[0])
+            columns[1].append(
+                (row[TIMESTAMP_COLUMN_INDEX] - EPOCH) // datetime.timedelta(seconds=1))
+            columns[2].append(row[CLASS_COLUMN_INDEX])
+            columns[3].append(row[TOTAL_TIME_COLUMN_INDEX].total_seconds())
+        return cls.from_columns(*columns)
+
+    @classmethod
+    def fetch(cls, conn, where_clause, chunk_rows=FETCH_CHUNK_ROWS):
+        '''
+        Select the journeys matching where_clause straight into columns,
+        with the db doing the conversion to epoch seconds. The rows come
+        through a server-side cursor chunk_rows at a time, each chunk going
+        into arrays before the next is fetched, so the whole result is never
+        held as Python tuples at once.
+        '''
+        # Cast, as EXTRACT gives numeric (so Decimals) on newer Postgres.
+        query = sql.SQL(
+            "SELECT CAST(journey_id AS bigint), "
+            "CAST(EXTRACT(EPOCH FROM timestamp) AS bigint), class, "
+            "CAST(EXTRACT(EPOCH FROM total_trip_time) AS float8) "
+            "from journeys{};").format(where_clause)
+        class_index = {}
+        chunks = ([], [], [], [])
+        name = "anpr_columns_{}".format(next(_fetch_cursor_ids))
+        with conn.cursor(name=name) as cur:
+            cur.itersize = chunk_rows
+            cur.execute(query)
+            while True:
+                rows = cur.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                journey_ids, timestamps, veh_classes, trip_times = zip(*rows)
+                chunks[0].append(np.array(journey_ids, dtype=np.int64))
+                chunks[1].append(np.array(timestamps, dtype=np.int64))
+                chunks[2].append(np.array(
+                    [class_index.setdefault(str(c), len(class_index))
+                     for c in veh_classes], dtype=np.int64))
+                chunks[3].append(np.array(trip_times, dtype=np.float64))
+        if not chunks[0]:
+            return cls.from_columns([], [], [], [])
+        # Number the classes in sorted order, as from_columns() does.
+        classes = sorted(class_index)
+        recode = np.empty(len(classes), dtype=np.int64)
+        for code, veh_class in enumerate(classes):
+            recode[class_index[veh_class]] = code
+        return cls(
+            np.concatenate(chunks[0]), np.concatenate(chunks[1]),
+            recode[np.concatenate(chunks[2])], classes,
+            np.concatenate(chunks[3]))
+
+    def take(self, indices):
+        return JourneyColumns(
+            self.journey_id[indices], self.timestamp[indices],
+            self.class_codes[indices], self.classes,
+            self.trip_time[indices])
+
+    def class_mask(self, allowed_classes):
+        allowed_codes = [code for code, veh_class in enumerate(self.classes)
+                         if veh_class in allowed_classes]
+        return np.isin(self.class_codes, allowed_codes)
+
+    def time_mask(self, start=None, end=None):
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.timestamp >= (start - EPOCH) // datetime.timedelta(seconds=1)
+        if end is not None:
+            mask &= self.timestamp < (end - EPOCH) // datetime.timedelta(seconds=1)
+        return mask
+
+    def class_counts(self):
+        counts = np.bincount(self.class_codes, minlength=len(self.classes))
+        return {self.classes[code]: int(n)
+                for code, n in enumerate(counts) if n}
+
+    def trip_time_percentiles(self, percentiles):
+        return np.percentile(self.trip_time, percentiles)
+
+
+def can_group_and_stat(group_lst, stats_lst):
+    '''
+    Whether every group has column_keys() and every stat column_stats()
+    '''
+    return (all(type(group).column_keys is not groups.GroupBase.column_keys
+                for group in group_lst)
+            and all(type(stat).column_stats is not stats.BaseStats.column_stats
+                    for stat in stats_lst))
+
+
+def group_and_stat(columns, group_lst, stats_lst):
+    '''
+    Group the journeys and get the stats for each group, giving the same
+    (possibly nested) dict, or list of stats, as DataSearcher.combined()
+    '''
+    #as with DataSearcher, the last grouper gives the outermost key
+    groupers = list(reversed(group_lst))
+    if not groupers:
+        return _column_stats(columns, stats_lst)
+
+    result = {}
+    if not len(columns):
+        return result
+    keys = [grouper.column_keys(columns) for grouper in groupers]
+    codes = np.stack([code for code, _labels in keys])
+    unique_codes, group_ids = np.unique(codes, axis=1, return_inverse=True)
+    group_ids = group_ids.reshape(-1)
+    order = np.argsort(group_ids, kind="stable")
+    bounds = np.searchsorted(
+        group_ids[order], np.arange(unique_codes.shape[1] + 1))
+    for g in range(unique_codes.shape[1]):
+        group = columns.take(order[bounds[g]:bounds[g+1]])
+        path = [_label(code, labels)
+                for code, (_code, labels) in zip(unique_codes[:, g], keys)]
+        node = result
+        for key in path[:-1]:
+            node = node.setdefault(key, {})
+        node[path[-1]] = _column_stats(group, stats_lst)
+    return result
+
+
+def _label(code, labels):
+    if labels is None:
+        return int(code)
+    return labels[int(code)]
+
+
+def _column_stats(columns, stats_lst):
+    stat_lists = [stat.column_stats(columns) for stat in stats_lst]
+    return [stat for sublist in stat_lists for stat in sublist]
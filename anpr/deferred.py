@@ -0,0 +1,184 @@
+"""Deferring index maintenance and foreign key checks during big loads.
+
+Before the load, the non-unique indexes and foreign keys on captures, and
+the non-unique indexes on the trip index tables (see anpr.tripindex), are
+dropped, with their definitions saved to the deferred_ddl table. Afterwards
+they are recreated in one go, and the tables are analyzed. Keeping the
+definitions in the db means that if the load dies part way through, the next
+load (or restore) still knows what to put back.
+
+If a foreign key no longer holds, the constraint is put back NOT VALID where
+Postgres allows it, so new rows are still checked, and the offending rows
+are reported. On a partitioned captures table that isn't possible, so the
+definition is left in deferred_ddl to be retried once the data is fixed.
+"""
+import psycopg2 as psy
+from psycopg2 import sql
+
+DEFERRED_TABLE = "captures"
+# The trip index is written along with the captures, so its indexes are
+# just as much of a drag on the load.
+DEFERRED_TABLES = (DEFERRED_TABLE, "trips", "camera_pairs")
+
+DEFERRED_DDL_TABLE_SQL = (
+    "CREATE TABLE IF NOT EXISTS deferred_ddl ("
+    "name text PRIMARY KEY, "
+    "kind text NOT NULL, "
+    "table_name text NOT NULL, "
+    "definition text NOT NULL"
+    ");"
+)
+
+
+def pending(conn):
+    '''
+    Whether there are indexes or constraints waiting to be restored
+    '''
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('deferred_ddl') IS NOT NULL;")
+        exists, = cur.fetchone()
+        if not exists:
+            return False
+        cur.execute("SELECT count(*) FROM deferred_ddl;")
+        n, = cur.fetchone()
+    return n > 0
+
+
+def defer(conn, tables=DEFERRED_TABLES):
+    '''
+    Drop the tables' non-unique indexes and foreign keys, saving their
+    definitions for restore(). Tables that don't exist are skipped.
+    '''
+    if pending(conn):
+        # A previous load didn't get to restore them, they're still gone.
+        print("Indexes and constraints are already deferred")
+        return
+    with conn.cursor() as cur:
+        cur.execute(DEFERRED_DDL_TABLE_SQL)
+        for table in tables:
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (table,))
+            exists, = cur.fetchone()
+            if exists:
+                _defer_table(cur, table)
+    conn.commit()
+
+
+def _defer_table(cur, table):
+    cur.execute(
+        "SELECT index_class.relname, pg_get_indexdef(pg_index.indexrelid) "
+        "FROM pg_index "
+        "JOIN pg_class index_class ON index_class.oid = pg_index.indexrelid "
+        "WHERE pg_index.indrelid = %s::regclass "
+        "AND NOT pg_index.indisprimary AND NOT pg_index.indisunique;",
+        (table,))
+    indexes = cur.fetchall()
+    cur.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = %s::regclass AND contype = 'f';",
+        (table,))
+    foreign_keys = cur.fetchall()
+
+    for name, definition in foreign_keys:
+        cur.execute(
+            "INSERT INTO deferred_ddl (name, kind, table_name, definition) "
+            "VALUES (%s, 'foreign key', %s, %s);", (name, table, definition))
+        cur.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {};").format(
+            sql.Identifier(table), sql.Identifier(name)))
+    for name, definition in indexes:
+        cur.execute(
+            "INSERT INTO deferred_ddl (name, kind, table_name, definition) "
+            "VALUES (%s, 'index', %s, %s);", (name, table, definition))
+        cur.execute(sql.SQL("DROP INDEX {};").format(sql.Identifier(name)))
+    print("Deferred {} indexes and {} foreign keys on {}".format(
+        len(indexes), len(foreign_keys), table))
+
+
+def restore(conn):
+    '''
+    Recreate the deferred indexes and foreign keys, then analyze the tables.
+    Returns a list of problems with foreign keys that couldn't be validated.
+    '''
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT deferred_ddl.name, kind, table_name, definition, "
+            "relkind = 'p' FROM deferred_ddl "
+            "LEFT JOIN pg_class ON pg_class.oid = to_regclass(table_name) "
+            "ORDER BY kind DESC, table_name, name;")
+        deferred = cur.fetchall()
+    conn.commit()
+
+    problems = []
+    # Indexes first, they make checking the foreign keys quicker.
+    for name, kind, table, definition, partitioned in deferred:
+        if _already_there(conn, name, kind, table):
+            # The table was remade (e.g. by anpr create) since the load that
+            # deferred this, and came with its own.
+            print("{} {} already exists".format(kind.capitalize(), name))
+            with conn.cursor() as cur:
+                cur.execute("DELETE FROM deferred_ddl WHERE name = %s;", (name,))
+            conn.commit()
+            continue
+        if kind == "index":
+            print("Rebuilding index {}".format(name))
+            with conn.cursor() as cur:
+                cur.execute(definition)
+                cur.execute("DELETE FROM deferred_ddl WHERE name = %s;", (name,))
+            conn.commit()
+            continue
+
+        print("Validating foreign key {}".format(name))
+        add = sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+            sql.Identifier(table), sql.Identifier(name), sql.SQL(definition))
+        try:
+            with conn.cursor() as cur:
+                cur.execute(add)
+                cur.execute("DELETE FROM deferred_ddl WHERE name = %s;", (name,))
+            conn.commit()
+            continue
+        except psy.IntegrityError as e:
+            conn.rollback()
+            problem = "{} does not hold: {}".format(
+                name, str(e).strip().splitlines()[-1])
+
+        if partitioned:
+            problem += " (left deferred, fix the data and run anpr load again)"
+        else:
+            with conn.cursor() as cur:
+                cur.execute(sql.SQL("{} NOT VALID;").format(add))
+                cur.execute("DELETE FROM deferred_ddl WHERE name = %s;", (name,))
+            conn.commit()
+            problem += " (added NOT VALID, existing rows are unchecked)"
+        print(problem)
+        problems.append(problem)
+
+    # Planner statistics are way off after a big load.
+    tables = set(table for _name, _kind, table, _definition, partitioned
+                 in deferred if partitioned is not None)
+    with conn.cursor() as cur:
+        for table in sorted(tables | set([DEFERRED_TABLE])):
+            cur.execute(sql.SQL("ANALYZE {};").format(sql.Identifier(table)))
+        cur.execute("ANALYZE vehicles;")
+    conn.commit()
+    return problems
+
+
+def _already_there(conn, name, kind, table):
+    '''
+    Whether the deferred index or foreign key exists, or there is no longer
+    a table to put it on
+    '''
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s) IS NULL;", (table,))
+        table_gone, = cur.fetchone()
+        if table_gone:
+            return True
+        if kind == "index":
+            cur.execute("SELECT to_regclass(%s) IS NOT NULL;", (name,))
+        else:
+            cur.execute(
+                "SELECT EXISTS (SELECT 1 FROM pg_constraint "
+                "WHERE conrelid = to_regclass(%s) AND conname = %s);",
+                (table, name))
+        exists, = cur.fetchone()
+    conn.commit()
+    return exists
@@ -0,0 +1,297 @@
+"""Exporting journeys and captures to columnar files, for offline analysis.
+
+An export is a directory holding one raw binary file per column plus a
+meta.json describing them. Columns are written a chunk of rows at a time, so
+exports of any size can be streamed out of the db, and read back with
+np.memmap, so opening one costs nothing and only the pages that are used
+are read. Columns are one of:
+int64/float64: a plain array
+category: int32 codes, with the labels they stand for kept in meta.json
+string: the UTF-8 bytes of every value end to end, and an int64 array of
+    the n + 1 offsets where each value starts (and the last one ends)
+
+Journey exports can be read back as a columnar.JourneyColumns, without
+copying, or as rows for the fine passes; see anpr.FileSearcher. Needs numpy,
+which is an optional dependency (pip install anpr[columnar]).
+"""
+import datetime
+import json
+import os
+
+import numpy as np
+from psycopg2 import sql
+
+from anpr import columnar
+
+FORMAT_VERSION = 1
+META_FILE = "meta.json"
+DEFAULT_CHUNK_ROWS = 100000
+
+EPOCH = datetime.datetime(1970, 1, 1)
+_SECOND = datetime.timedelta(seconds=1)
+
+DTYPES = {
+    "int64": np.int64,
+    "float64": np.float64,
+    "category": np.int32,
+}
+
+# Timestamps are whole seconds since the epoch (of the timestamp as stored,
+# as in columnar.JourneyColumns); trip_time is in seconds.
+JOURNEY_COLUMNS = [
+    ("journey_id", "int64"),
+    ("timestamp", "int64"),
+    ("class", "category"),
+    ("trip_time", "float64"),
+    ("chain", "string"),
+    ("details", "string"),
+]
+# ts is in microseconds since the (UTC) epoch.
+CAPTURE_COLUMNS = [
+    ("camera", "category"),
+    ("vehicle", "int64"),
+    ("direction", "category"),
+    ("ts", "int64"),
+]
+
+
+class ColumnarWriter(object):
+    '''
+    Writes a table to an export directory a chunk at a time.
+    columns is a list of (name, kind) pairs, kind being one of int64,
+    float64, category or string.
+    '''
+    def __init__(self, directory, table, columns):
+        self.directory = directory
+        self.table = table
+        self.columns = columns
+        self.n_rows = 0
+        self._labels = {name: {} for name, kind in columns
+                        if kind == "category"}
+        self._string_ends = {name: 0 for name, kind in columns
+                             if kind == "string"}
+        os.makedirs(directory, exist_ok=True)
+        for name, kind in columns:
+            open(self._path(name), "wb").close()
+            if kind == "string":
+                with open(self._path(name, "offsets"), "wb") as outfile:
+                    np.zeros(1, dtype=np.int64).tofile(outfile)
+
+    def _path(self, name, part="values"):
+        return os.path.join(self.directory, "{}.{}".format(name, part))
+
+    def write_chunk(self, values):
+        '''
+        Append a chunk of rows, given as a dict of column name to the list
+        of that column's values
+        '''
+        n_rows = None
+        for name, kind in self.columns:
+            column = values[name]
+            if n_rows is None:
+                n_rows = len(column)
+            elif len(column) != n_rows:
+                raise ValueError("Column {} has {} values, expected {}".format(
+                    name, len(column), n_rows))
+
+            if kind == "string":
+                self._write_strings(name, column)
+                continue
+            if kind == "category":
+                labels = self._labels[name]
+                column = [labels.setdefault(label, len(labels))
+                          for label in column]
+            with open(self._path(name), "ab") as outfile:
+                np.asarray(column, dtype=DTYPES[kind]).tofile(outfile)
+        self.n_rows += n_rows or 0
+
+    def _write_strings(self, name, column):
+        encoded = [value.encode("utf-8") for value in column]
+        ends = np.cumsum([len(value) for value in encoded], dtype=np.int64)
+        ends += self._string_ends[name]
+        with open(self._path(name), "ab") as outfile:
+            outfile.write(b"".join(encoded))
+        with open(self._path(name, "offsets"), "ab") as outfile:
+            ends.tofile(outfile)
+        if len(ends):
+            self._string_ends[name] = int(ends[-1])
+
+    def close(self):
+        '''
+        Write out meta.json, which makes the export readable
+        '''
+        meta = {
+            "version": FORMAT_VERSION,
+            "table": self.table,
+            "rows": self.n_rows,
+            "columns": [
+                {"name": name, "kind": kind,
+                 "labels": sorted(self._labels[name],
+                                  key=self._labels[name].get)
+                 if kind == "category" else None}
+                for name, kind in self.columns],
+        }
+        with open(os.path.join(self.directory, META_FILE), "w") as outfile:
+            json.dump(meta, outfile, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc_info):
+        # A half written export is left without its meta.json.
+        if exc_type is None:
+            self.close()
+
+
+class StringColumn(object):
+    '''
+    A memory mapped string column; values are decoded as they are indexed
+    '''
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return bytes(self.data[self.offsets[i]:self.offsets[i + 1]]).decode(
+            "utf-8")
+
+
+class ColumnarFile(object):
+    '''
+    Read access to an export directory, with every column memory mapped
+    '''
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, META_FILE)) as infile:
+            self.meta = json.load(infile)
+        if self.meta["version"] != FORMAT_VERSION:
+            raise ValueError("{} is format version {}, expected {}".format(
+                directory, self.meta["version"], FORMAT_VERSION))
+        self.table = self.meta["table"]
+        self._columns = {column["name"]: column
+                         for column in self.meta["columns"]}
+
+    def __len__(self):
+        return self.meta["rows"]
+
+    def _map(self, path, dtype, length):
+        if not length:
+            # mmap can't map an empty file.
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode="r", shape=(length,))
+
+    def column(self, name):
+        '''
+        The named column: a read-only array (of codes, for a category
+        column), or a StringColumn
+        '''
+        kind = self._columns[name]["kind"]
+        path = os.path.join(self.directory, name + ".values")
+        if kind == "string":
+            offsets = self._map(
+                os.path.join(self.directory, name + ".offsets"), np.int64,
+                len(self) + 1)
+            data = self._map(path, np.uint8, int(offsets[-1]) if len(self) else 0)
+            return StringColumn(data, offsets)
+        return self._map(path, DTYPES[kind], len(self))
+
+    def labels(self, name):
+        '''
+        The labels of a category column, indexed by code
+        '''
+        return self._columns[name]["labels"]
+
+
+class JourneyFile(ColumnarFile):
+    def journey_columns(self):
+        '''
+        The journeys as a columnar.JourneyColumns, sharing the mapped memory
+        '''
+        return columnar.JourneyColumns(
+            self.column("journey_id"), self.column("timestamp"),
+            self.column("class"),
+            self.labels("class"), self.column("trip_time"))
+
+    def rows(self, indices=None):
+        '''
+        Yield journeys rows, in the same form that the fine passes, groups
+        and stats see from the db (less the sites), optionally only those
+        at the given indices
+        '''
+        journey_id = self.column("journey_id")
+        timestamp = self.column("timestamp")
+        class_codes = self.column("class")
+        classes = self.labels("class")
+        trip_time = self.column("trip_time")
+        chain = self.column("chain")
+        details = self.column("details")
+        if indices is None:
+            indices = range(len(self))
+        for i in indices:
+            start = EPOCH + datetime.timedelta(seconds=int(timestamp[i]))
+            total = datetime.timedelta(seconds=float(trip_time[i]))
+            yield (int(journey_id[i]), start, classes[class_codes[i]],
+                   total, chain[i], details[i], start + total)
+
+
+def write_journeys(rows, directory, chunk_rows=DEFAULT_CHUNK_ROWS):
+    '''
+    Write journeys rows (from the db, or a DataSearcher's fine passes) to an
+    export directory. Returns the number of rows written.
+    '''
+    with ColumnarWriter(directory, "journeys", JOURNEY_COLUMNS) as writer:
+        chunk = {name: [] for name, _kind in JOURNEY_COLUMNS}
+        for row in rows:
+            chunk["journey_id"].append(row[0])
+            chunk["timestamp"].append((row[1] - EPOCH) // _SECOND)
+            chunk["class"].append(row[2])
+            chunk["trip_time"].append(row[3].total_seconds())
+            chunk["chain"].append(row[4])
+            chunk["details"].append(row[5])
+            if len(chunk["journey_id"]) >= chunk_rows:
+                writer.write_chunk(chunk)
+                chunk = {name: [] for name, _kind in JOURNEY_COLUMNS}
+        writer.write_chunk(chunk)
+    return writer.n_rows
+
+
+def export_captures(conn, directory, chunk_rows=DEFAULT_CHUNK_ROWS):
+    '''
+    Stream the whole captures table to an export directory, in time order.
+    Returns the number of rows written.
+    '''
+    with conn.cursor(name="anpr_export_captures") as cur:
+        cur.itersize = chunk_rows
+        cur.execute(
+            "SELECT camera, vehicle, direction::text, "
+            "CAST(EXTRACT(EPOCH FROM ts) * 1000000 AS bigint) "
+            "FROM captures ORDER BY ts;")
+        with ColumnarWriter(directory, "captures", CAPTURE_COLUMNS) as writer:
+            while True:
+                rows = cur.fetchmany(chunk_rows)
+                if not rows:
+                    break
+                writer.write_chunk(dict(zip(
+                    [name for name, _kind in CAPTURE_COLUMNS], zip(*rows))))
+    conn.commit()
+    return writer.n_rows
+
+
+def export_journeys(conn, directory, where_clause=sql.SQL(""),
+                    chunk_rows=DEFAULT_CHUNK_ROWS):
+    '''
+    Stream the journeys (optionally those matching where_clause) to an export
+    directory. Returns the number of rows written.
+    '''
+    with conn.cursor(name="anpr_export_journeys") as cur:
+        cur.itersize = chunk_rows
+        cur.execute(sql.SQL(
+            "SELECT journey_id, timestamp, class, total_trip_time, chain, "
+            "trip_destinations_and_time FROM journeys{};").format(
+                where_clause))
+        n_rows = write_journeys(cur, directory, chunk_rows)
+    conn.commit()
+    return n_rows
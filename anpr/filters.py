@@ -3,7 +3,8 @@ from psycopg2 import sql
 
 import abc
 import re
-import datetime
+
+from anpr import routes
 
 TIMESTAMP_COLUMN_INDEX = 1
 CLASS_COLUMN_INDEX = 2
@@ -27,10 +28,51 @@ class FilterBase(object):
     def fine_pass(self, rows):
         '''
         Given some rows from the db return a filtered
-        (and possibly altered) list of rows
+        (and possibly altered) iterable of rows.
+        rows may be a one-shot iterator, so only make one pass over it
         '''
         return
 
+    def sqlite_coarse_pass(self):
+        '''
+        coarse_pass() for the embedded SQLite backend (see anpr.backends),
+        where it differs
+        '''
+        return self.coarse_pass()
+
+    def needs_fine_pass(self):
+        '''
+        Whether fine_pass() does anything that coarse_pass() doesn't.
+        If not, the rows from the db can be used as they are
+        '''
+        return True
+
+    def needs_column_fine_pass(self):
+        '''
+        needs_fine_pass() for a search over columns, where column_mask()
+        takes the place of coarse_pass() and may not be able to do as much
+        '''
+        return self.needs_fine_pass()
+
+    def column_mask(self, columns):
+        '''
+        The vectorized version of coarse_pass(), for a columnar.JourneyColumns
+        (e.g. from an export). Return a boolean array, one per journey, or
+        None to leave all the journeys to the fine pass
+        '''
+        if not self.needs_column_fine_pass():
+            raise NotImplementedError(
+                "{} has no column_mask()".format(type(self).__name__))
+        return None
+
+def needs_fine_pass(fil, columnar=False):
+    '''
+    fil.needs_fine_pass(), or with columnar fil.needs_column_fine_pass()
+    '''
+    if columnar:
+        return fil.needs_column_fine_pass()
+    return fil.needs_fine_pass()
+
 class SiteFilter(FilterBase):
 
     def __init__(self, route_regex):
@@ -41,7 +83,7 @@ class SiteFilter(FilterBase):
         '''
         Given a route regex extract any complete site names
         '''
-        #TODO check the db to ensure that these sites exist as tables
+        #TODO check the db to ensure that these sites exist
         return [groups[0] for groups in re.findall(r"(\d\d\D?_([NESW]|(OUT)|(IN)))", route_regex)]
 
     def coarse_pass(self):
@@ -49,11 +91,23 @@ class SiteFilter(FilterBase):
         At a minimum matching journeys must contain all the sites in the desired journey
         N.B. this won't check that the sites are visited in the right order that what fine_pass()
         is for
+        This is a single containment test, answered by the GIN index on sites
         '''
         #note for this class no site can be None, but it is useful to support
         #for derived classes
-        site_queries = [sql.SQL("SELECT * from {}").format(sql.Identifier("s"+site)) for site in self.sites if site is not None]
-        return sql.SQL("(journey_id in ({}))").format(sql.SQL(" INTERSECT ").join(site_queries))
+        sites = [site for site in self.sites if site is not None]
+        return sql.SQL("(sites @> CAST({} AS text[]))").format(sql.Literal(sites))
+
+    def sqlite_coarse_pass(self):
+        '''
+        SQLite has no arrays, sites are kept as text like ">01_N>02_S>"
+        '''
+        sites = [site for site in self.sites if site is not None]
+        if not sites:
+            return sql.SQL("1")
+        return sql.SQL("({})").format(sql.SQL(" AND ").join(
+            [sql.SQL("instr(sites, {}) > 0").format(sql.Literal(">" + site + ">"))
+             for site in sites]))
 
     def fine_pass(self, rows):
         '''
@@ -62,58 +116,19 @@ class SiteFilter(FilterBase):
         for any row that does extract the sub route(s) that match
         and change the start and end times to correspond to just the sub-route
         '''
-        row_lists = [self.extract_route(row, self.route_regex) for row in rows if re.search(self.route_regex, row[CHAIN_COLUMN_INDEX])]
-        #there could be multiple matches (and therefore output rows) per journey so extract_route
-        # returns a list of lists, flatten this list
-        return [x for rows in row_lists for x in rows]
-
-    def extract_route(self, row, route_regex):
-        '''
-        Assuming this row contains at least one matching sub match_route
-        Return the equivalent row for just that subroute, changing the times accordingly
-        '''
-        matched_chains = re.findall("("+route_regex +")", row[CHAIN_COLUMN_INDEX])
-        out_rows = []
-        for matched_chain in matched_chains:
-            if type(matched_chain) == tuple:
-                matched_chain = matched_chain[0]
-            first_site = matched_chain.split(">")[0]
-
-            #find how many sites into the chain the match starts
-            match_start = row[CHAIN_COLUMN_INDEX].find(matched_chain)
-            match_chain_index_start = row[CHAIN_COLUMN_INDEX][:match_start].count(">")
-
-            match_chain_index_end = match_chain_index_start + len(matched_chain.split(">")) - 1
-            # the chain with the times misses the first site in the CHAIN_COLUMN_INDEX
-            # add it back in
-            time_chain = (first_site + "(0.0)" + row[CHAIN_TIME_COLUMN_INDEX]).split(">")
-
-            start_time_offset = self.get_time_offset_from_time_chain(time_chain, match_chain_index_start)
-            end_time_offset = self.get_time_offset_from_time_chain(time_chain, match_chain_index_end)
-
-            start_time_offset = datetime.timedelta(minutes=start_time_offset)
-            end_time_offset = datetime.timedelta(minutes=end_time_offset)
-
-            start_time = row[TIMESTAMP_COLUMN_INDEX] + start_time_offset
-            end_time = row[TIMESTAMP_COLUMN_INDEX] + end_time_offset
-
-            new_time_chain = ">".join(time_chain[match_chain_index_start:(match_chain_index_end+1)])
-            new_row = (row[0], start_time, row[CLASS_COLUMN_INDEX], end_time-start_time, matched_chain, new_time_chain, end_time)
-            out_rows.append(new_row)
-        return out_rows
+        #there could be multiple matches (and therefore output rows) per journey so extract_routes
+        # returns a list of rows (empty if no match), flatten this lazily so rows can be streamed
+        return (x for row in rows for x in self.route_matcher.extract_routes(row))
 
-    def get_time_offset_from_time_chain(self, time_chain, chain_index):
+    @property
+    def route_matcher(self):
         '''
-        Given a time chain and an index to a given entry
-        parse the time differences assuming each entry is
-        in the format <site_name>(<time_offset>)
-        then return the total time offset up to the given index
-        return the time offset
+        The route_regex compiled into a RouteMatcher, built on first use
         '''
-        entry_regex = r"\d\d\D?_([NESW]|(OUT)|(IN))\((\d+(.\d+)?)\)"
-        time_offsets = [float(re.match(entry_regex, entry).group(4)) for entry in time_chain[:(chain_index+1)]]
-
-        return sum(time_offsets)
+        matcher = getattr(self, "_route_matcher", None)
+        if matcher is None or matcher.route_regex != self.route_regex:
+            matcher = self._route_matcher = routes.RouteMatcher(self.route_regex)
+        return matcher
 
 class StartEndViaFilter(SiteFilter):
     def __init__(self, start, end, via, indirect_allowed):
@@ -123,7 +138,7 @@ class StartEndViaFilter(SiteFilter):
     def make_route_regex(self, start, end, via, indirect_allowed):
         site_regex = r"(\d\d\D?_([NESW]|(OUT)|(IN))>)"
         if (start == end and via == []):
-            route_regex = r"{start}.*".format(start)
+            route_regex = r"{start}.*".format(start=start)
         elif not indirect_allowed:
             via_regex = ">".join(via)
             route_regex = start + ">" + via_regex + ">" + end
@@ -132,6 +147,75 @@ class StartEndViaFilter(SiteFilter):
             route_regex = start + ">" + via_regex + site_regex + "*" + end
         return route_regex
 
+class AnySiteFilter(FilterBase):
+    '''
+    Journeys that pass at least one of the sites, in any order, e.g. the
+    sites of the cameras in an area (see anpr.spatial)
+    '''
+    def __init__(self, sites):
+        self.sites = list(sites)
+
+    def coarse_pass(self):
+        '''
+        An overlap test, answered by the GIN index on sites
+        '''
+        return sql.SQL("(sites && CAST({} AS text[]))").format(sql.Literal(self.sites))
+
+    def sqlite_coarse_pass(self):
+        if not self.sites:
+            return sql.SQL("0")
+        return sql.SQL("({})").format(sql.SQL(" OR ").join(
+            [sql.SQL("instr(sites, {}) > 0").format(sql.Literal(">" + site + ">"))
+             for site in self.sites]))
+
+    def needs_fine_pass(self):
+        return False
+
+    def needs_column_fine_pass(self):
+        # The columns have no sites to test.
+        return True
+
+    def fine_pass(self, rows):
+        '''
+        Only needed where there was no coarse pass (e.g. over an export),
+        the rows are unchanged
+        '''
+        sites = frozenset(self.sites)
+        return (row for row in rows
+                if not sites.isdisjoint(row[CHAIN_COLUMN_INDEX].split(">")))
+
+class TimeRangeFilter(FilterBase):
+    '''
+    Journeys starting from start up to (but not including) end.
+    Either can be None for an open ended range
+    '''
+    def __init__(self, start=None, end=None):
+        self.start = start
+        self.end = end
+
+    def coarse_pass(self):
+        conditions = []
+        if self.start is not None:
+            conditions.append(sql.SQL("timestamp >= {}").format(sql.Literal(self.start)))
+        if self.end is not None:
+            conditions.append(sql.SQL("timestamp < {}").format(sql.Literal(self.end)))
+        if not conditions:
+            return sql.SQL("TRUE")
+        return sql.SQL("({})").format(sql.SQL(" AND ").join(conditions))
+
+    def column_mask(self, columns):
+        return columns.time_mask(self.start, self.end)
+
+    def fine_pass(self, rows):
+        '''
+        SQL does all the filtering we need
+        pass though unchanged
+        '''
+        return rows
+
+    def needs_fine_pass(self):
+        return False
+
 class ClassFilter(FilterBase):
     def __init__(self, allowed_classes):
         self.allowed_classes = allowed_classes
@@ -141,9 +225,15 @@ class ClassFilter(FilterBase):
         '''
         return sql.SQL("(class in {})").format(sql.Literal(tuple(self.allowed_classes)))
 
+    def column_mask(self, columns):
+        return columns.class_mask(self.allowed_classes)
+
     def fine_pass(self, rows):
         '''
         SQL does all the filtering we need
         pass though unchanged
         '''
         return rows
+
+    def needs_fine_pass(self):
+        return False
@@ -1,5 +1,9 @@
 import abc
 import collections
+import collections.abc
+
+from psycopg2 import sql
+
 TIMESTAMP_COLUMN_INDEX = 1
 CLASS_COLUMN_INDEX = 2
 TOTAL_TIME_COLUMN_INDEX = 3
@@ -13,11 +17,35 @@ class GroupBase(object):
     def group_rows(self, rows):
         return
 
+    def row_key(self, row):
+        '''
+        The group key for a single row. By default this goes through
+        group_rows(), which must then put each row in just one group
+        '''
+        key, = self.group_rows([row]).keys()
+        return key
+
+    def sql_key(self):
+        '''
+        An SQL expression over the journeys table that gives the same group
+        key as group_rows(), or None if there isn't one
+        '''
+        return None
+
+    def column_keys(self, columns):
+        '''
+        The vectorized version of group_rows(), for a columnar.JourneyColumns.
+        Return an integer array of group codes, one per journey, and a
+        sequence mapping codes to group keys (None if the codes are the keys)
+        '''
+        raise NotImplementedError
+
     def group(self, groups):
-        if isinstance(groups, list):
-            return self.group_rows(groups)
-        elif isinstance(groups, dict):
+        if isinstance(groups, dict):
             return {key:self.group(value) for key, value in groups.items()}
+        elif isinstance(groups, collections.abc.Iterable):
+            #a list of rows, or a stream of them
+            return self.group_rows(groups)
         raise Exception("Unknown group type:{}".format(type(groups)))
 
 
@@ -30,6 +58,16 @@ class GroupByHour(GroupBase):
             groups[start_time.hour].append(row)
         return groups
 
+    def row_key(self, row):
+        return row[TIMESTAMP_COLUMN_INDEX].hour
+
+    def sql_key(self):
+        return sql.SQL("CAST(EXTRACT(HOUR FROM {}) AS integer)").format(
+            sql.Identifier("timestamp"))
+
+    def column_keys(self, columns):
+        return columns.timestamp // 3600 % 24, None
+
 class GroupByClass(GroupBase):
     def group_rows(self, rows):
         groups = collections.defaultdict(list)
@@ -37,3 +75,12 @@ class GroupByClass(GroupBase):
             vehicle_class = row[CLASS_COLUMN_INDEX]
             groups[vehicle_class].append(row)
         return groups
+
+    def row_key(self, row):
+        return row[CLASS_COLUMN_INDEX]
+
+    def sql_key(self):
+        return sql.Identifier("class")
+
+    def column_keys(self, columns):
+        return columns.class_codes, columns.classes
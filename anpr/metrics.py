@@ -0,0 +1,241 @@
+"""Timings and counters for the load and search stages, and profiling hooks.
+
+Instrumented code records into the module level `metrics` registry, which
+does nothing until it is enabled. Its snapshot can be sent to any number of
+sinks: the log, a JSON lines file, or a Prometheus textfile (for the node
+exporter's textfile collector).
+
+    metrics.metrics.enabled = True
+    metrics.metrics.sinks.append(metrics.JsonFileSink("anpr_metrics.jsonl"))
+    ... load or search ...
+    metrics.metrics.report()
+"""
+import collections
+import contextlib
+import cProfile
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+import tracemalloc
+
+PROFILE_MODES = ("cprofile", "tracemalloc")
+TRACEMALLOC_TOP_N = 50
+
+logger = logging.getLogger(__name__)
+
+
+class Metrics(object):
+    '''
+    Safe to record into from several threads (e.g. the request threads of
+    anpr serve)
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.sinks = []
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = collections.Counter()
+            self.gauges = {}
+            # name -> [number of times timed, total seconds]
+            self.timers = {}
+
+    def count(self, name, n=1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] += n
+
+    def add_counts(self, counts):
+        '''
+        Add a {counter: n} dict, e.g. the counts made in a worker process
+        '''
+        if self.enabled:
+            with self._lock:
+                self.counters.update(counts)
+
+    def set_gauge(self, name, value):
+        if self.enabled:
+            with self._lock:
+                self.gauges[name] = value
+
+    def add_time(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def set_rates(self, elapsed, per_second):
+        '''
+        Set a "<counter>_per_second" gauge for each of the named counters,
+        over the elapsed seconds
+        '''
+        if not elapsed:
+            return
+        for name in per_second:
+            with self._lock:
+                n = self.counters[name]
+            self.set_gauge(name + "_per_second", n / elapsed)
+
+    def counted(self, rows, name):
+        '''
+        Pass rows through, counting them as they go
+        '''
+        if not self.enabled:
+            return rows
+        return self._counted(rows, name)
+
+    def _counted(self, rows, name):
+        n = 0
+        try:
+            for row in rows:
+                n += 1
+                yield row
+        finally:
+            self.count(name, n)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timers": {name: {"count": count, "seconds": seconds}
+                           for name, (count, seconds) in self.timers.items()},
+            }
+
+    def report(self):
+        '''
+        Send a snapshot to every sink
+        '''
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.emit(snapshot)
+
+
+metrics = Metrics()
+
+
+class LoggingSink(object):
+    def __init__(self, log=logger, level=logging.INFO):
+        self.log = log
+        self.level = level
+
+    def emit(self, snapshot):
+        for name, value in sorted(snapshot["counters"].items()):
+            self.log.log(self.level, "%s: %s", name, value)
+        for name, value in sorted(snapshot["gauges"].items()):
+            self.log.log(self.level, "%s: %.1f", name, value)
+        for name, timer in sorted(snapshot["timers"].items()):
+            self.log.log(
+                self.level, "%s: %.3fs over %d", name, timer["seconds"],
+                timer["count"])
+
+
+class JsonFileSink(object):
+    '''
+    Appends each snapshot to a file as a line of JSON
+    '''
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, snapshot):
+        record = dict(snapshot, time=time.time())
+        with open(self.path, "a") as outfile:
+            outfile.write(json.dumps(record, sort_keys=True) + "\n")
+
+
+class PrometheusFileSink(object):
+    '''
+    Writes the latest snapshot in the Prometheus text format, replacing the
+    file atomically so a collector never sees half of it
+    '''
+    def __init__(self, path, prefix="anpr"):
+        self.path = path
+        self.prefix = prefix
+
+    def _name(self, name, suffix=""):
+        return re.sub(r"[^a-zA-Z0-9_]", "_", "{}_{}{}".format(
+            self.prefix, name, suffix))
+
+    def emit(self, snapshot):
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            metric = self._name(name, "_total")
+            lines += ["# TYPE {} counter".format(metric),
+                      "{} {}".format(metric, value)]
+        for name, value in sorted(snapshot["gauges"].items()):
+            metric = self._name(name)
+            lines += ["# TYPE {} gauge".format(metric),
+                      "{} {}".format(metric, value)]
+        for name, timer in sorted(snapshot["timers"].items()):
+            metric = self._name(name, "_seconds")
+            lines += ["# TYPE {} summary".format(metric),
+                      "{}_sum {}".format(metric, timer["seconds"]),
+                      "{}_count {}".format(metric, timer["count"])]
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as outfile:
+            outfile.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+SINKS = {
+    "log": lambda path: LoggingSink(),
+    "json": JsonFileSink,
+    "prometheus": PrometheusFileSink,
+}
+
+
+@contextlib.contextmanager
+def profiling(mode, path):
+    '''
+    Profile everything run in the block, writing the results to path:
+    cprofile: pstats data, for python -m pstats or snakeviz
+    tracemalloc: the lines that allocated the most memory still in use at the
+        end, as text
+    None: don't profile
+    '''
+    if mode is None:
+        yield
+        return
+    if mode == "cprofile":
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            profile.dump_stats(path)
+    elif mode == "tracemalloc":
+        tracemalloc.start(25)
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            _current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(path, "w") as outfile:
+                outfile.write("Peak traced memory: {:.1f}MB\n".format(peak / 1e6))
+                for stat in snapshot.statistics("lineno")[:TRACEMALLOC_TOP_N]:
+                    outfile.write("{}\n".format(stat))
+    else:
+        raise ValueError("Unknown profile mode {!r}".format(mode))
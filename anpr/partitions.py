@@ -0,0 +1,174 @@
+"""Time partitioning of the captures table.
+
+`anpr create` can make captures a table range partitioned on ts, with one
+partition per day or per month. Partitions are created by the loader as it
+comes across captures that need them, and whole survey periods can later be
+detached from captures without touching the rest of the data.
+"""
+import datetime
+
+from psycopg2 import sql
+
+GRANULARITIES = ("day", "month")
+DEFAULT_GRANULARITY = "month"
+
+PARTITIONING_TABLE_SQL = (
+    "CREATE TABLE IF NOT EXISTS captures_partitioning ("
+    "id boolean PRIMARY KEY DEFAULT true CHECK (id), "
+    "granularity text NOT NULL"
+    ");"
+)
+
+
+def period_start(ts, granularity):
+    if granularity == "day":
+        return datetime.datetime(ts.year, ts.month, ts.day)
+    return datetime.datetime(ts.year, ts.month, 1)
+
+
+def next_period_start(start, granularity):
+    if granularity == "day":
+        return start + datetime.timedelta(days=1)
+    if start.month == 12:
+        return start.replace(year=start.year + 1, month=1)
+    return start.replace(month=start.month + 1)
+
+
+def partition_name(start, granularity):
+    if granularity == "day":
+        return "captures_{:%Y_%m_%d}".format(start)
+    return "captures_{:%Y_%m}".format(start)
+
+
+def create_partitioned_captures(cursor, granularity):
+    '''
+    Make the (empty) partitioned captures table, and record how it is
+    partitioned. Any existing captures table must already be gone.
+    '''
+    if granularity not in GRANULARITIES:
+        raise ValueError("Unknown partition granularity {!r}".format(
+            granularity))
+    # The partition key has to be part of the primary key.
+    cursor.execute(
+        "CREATE TABLE captures ("
+        "id serial, "
+        "camera varchar(10) NOT NULL REFERENCES cameras (id), "
+        "vehicle integer NOT NULL REFERENCES vehicles (id), "
+        "direction direction NOT NULL, "
+        "ts timestamptz NOT NULL, "
+        "PRIMARY KEY (id, ts)"
+        ") PARTITION BY RANGE (ts);"
+    )
+    cursor.execute("CREATE INDEX ON captures (camera, ts);")
+    cursor.execute("CREATE INDEX ON captures (vehicle);")
+    cursor.execute(PARTITIONING_TABLE_SQL)
+    cursor.execute(
+        "INSERT INTO captures_partitioning (granularity) VALUES (%s) "
+        "ON CONFLICT (id) DO UPDATE SET granularity = EXCLUDED.granularity;",
+        (granularity,))
+
+
+def get_granularity(conn):
+    '''
+    How captures is partitioned, or None if it isn't
+    '''
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('captures_partitioning') IS NOT NULL;")
+        exists, = cur.fetchone()
+        if not exists:
+            return None
+        cur.execute("SELECT granularity FROM captures_partitioning;")
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+class PartitionRouter(object):
+    '''
+    Makes sure that captures has a partition for every timestamp about to be
+    written to it, creating them (in the current transaction) as needed
+    '''
+    def __init__(self, conn, granularity):
+        self.conn = conn
+        self.granularity = granularity
+        self._known = set()
+
+    @classmethod
+    def for_connection(cls, conn):
+        '''
+        A router for the db, or None if captures isn't partitioned
+        '''
+        granularity = get_granularity(conn)
+        if granularity is None:
+            return None
+        return cls(conn, granularity)
+
+    def ensure(self, ts):
+        start = period_start(ts, self.granularity)
+        if start in self._known:
+            return
+        end = next_period_start(start, self.granularity)
+        name = partition_name(start, self.granularity)
+        with self.conn.cursor() as cur:
+            # A partition detached by detach_partitions_before() is still
+            # there under the same name, and CREATE TABLE IF NOT EXISTS
+            # would quietly leave captures without a partition for it.
+            cur.execute(
+                "SELECT EXISTS (SELECT 1 FROM pg_inherits "
+                "WHERE inhrelid = to_regclass(%s) "
+                "AND inhparent = 'captures'::regclass) "
+                "FROM pg_class WHERE oid = to_regclass(%s);", (name, name))
+            row = cur.fetchone()
+            if row is not None and not row[0]:
+                raise RuntimeError(
+                    "{} exists but is not a partition of captures (was it "
+                    "detached?). Attach it again with ALTER TABLE captures "
+                    "ATTACH PARTITION {} FOR VALUES FROM ('{}') TO ('{}'), or "
+                    "rename or drop it, before loading captures from {:%Y-%m-%d}"
+                    .format(name, name, start, end, start))
+            cur.execute(sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {} PARTITION OF captures "
+                "FOR VALUES FROM (%s) TO (%s);").format(sql.Identifier(name)),
+                (start, end))
+        self._known.add(start)
+
+    def ensure_trip(self, captures):
+        for _camera, _direction, ts in captures:
+            self.ensure(ts)
+
+
+def detach_partitions_before(conn, before):
+    '''
+    Detach every partition of captures that ends on or before the given
+    datetime. The partitions are left as standalone tables (which can be
+    archived or dropped), and are no longer seen through captures.
+    Returns the names of the detached partitions.
+    '''
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = 'captures'::regclass;")
+        partitions = cur.fetchall()
+
+    granularity = get_granularity(conn)
+    detached = []
+    with conn.cursor() as cur:
+        for name, in partitions:
+            start = _start_from_name(name, granularity)
+            if start is None:
+                continue
+            if next_period_start(start, granularity) <= before:
+                cur.execute(sql.SQL(
+                    "ALTER TABLE captures DETACH PARTITION {};").format(
+                        sql.Identifier(name)))
+                detached.append(name)
+    conn.commit()
+    return detached
+
+
+def _start_from_name(name, granularity):
+    formats = {"day": "captures_%Y_%m_%d", "month": "captures_%Y_%m"}
+    try:
+        return datetime.datetime.strptime(name, formats[granularity])
+    except (KeyError, ValueError):
+        return None
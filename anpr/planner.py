@@ -0,0 +1,137 @@
+"""Planning a search: which filters run where, and in what order.
+
+The coarse passes are combined where they can be (one class list, one time
+range, one sites containment test). Their order is left alone, as Postgres
+picks its plan by its own costs whatever order the ANDed terms come in; the
+db's row estimates for each are only fetched for explain(). Only the
+filters whose fine pass does anything run one, in the order they were
+given: fine passes can change the rows (e.g. SiteFilter cutting journeys
+down to sub-routes), so reordering them could change the results.
+"""
+import json
+
+from psycopg2 import sql
+
+from anpr import filters
+
+
+class _SitesCoarsePass(filters.SiteFilter):
+    # The sites containment test of several site filters, as one.
+    def __init__(self, sites):
+        self.sites = sites
+
+
+def combine_coarse_passes(filter_lst):
+    '''
+    The filters to build the where clause from, with the class, time range
+    and site filters each merged into one, and duplicates dropped
+    '''
+    combined = []
+    class_filters = []
+    starts, ends = [], []
+    sites = []
+    seen = set()
+    for fil in filter_lst:
+        if type(fil) is filters.ClassFilter:
+            class_filters.append(fil)
+        elif type(fil) is filters.TimeRangeFilter:
+            if fil.start is not None:
+                starts.append(fil.start)
+            if fil.end is not None:
+                ends.append(fil.end)
+        elif type(fil) in (filters.SiteFilter, filters.StartEndViaFilter):
+            sites += [site for site in fil.sites
+                      if site is not None and site not in sites]
+        else:
+            key = repr(fil.coarse_pass())
+            if key not in seen:
+                seen.add(key)
+                combined.append(fil)
+    if class_filters:
+        classes = [c for c in class_filters[0].allowed_classes
+                   if all(c in fil.allowed_classes for fil in class_filters)]
+        # An empty class list isn't valid SQL, leave them as they were.
+        combined += [filters.ClassFilter(classes)] if classes else class_filters
+    if starts or ends:
+        combined.append(filters.TimeRangeFilter(
+            max(starts) if starts else None, min(ends) if ends else None))
+    if sites:
+        combined.append(_SitesCoarsePass(sites))
+    return combined
+
+
+def estimate_rows(conn, where_clause):
+    '''
+    Postgres' estimate of how many journeys match the where clause
+    '''
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL(
+            "EXPLAIN (FORMAT JSON) SELECT * from journeys{};").format(where_clause))
+        plan, = cur.fetchone()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    return int(plan[0]["Plan"]["Plan Rows"])
+
+
+class QueryPlan(object):
+    '''
+    The plan for a list of filters. Making one doesn't touch the db.
+    With columnar, the fine passes are those needed after column_mask()
+    rather than the coarse passes.
+    '''
+    def __init__(self, filter_lst, backend, columnar=False):
+        self.filters = filter_lst
+        self.backend = backend
+        self.coarse = combine_coarse_passes(filter_lst)
+        self.estimates = [None] * len(self.coarse)
+        self.fine = [fil for fil in filter_lst
+                     if filters.needs_fine_pass(fil, columnar)]
+        self.skipped = [fil for fil in filter_lst
+                        if not filters.needs_fine_pass(fil, columnar)]
+
+    def estimate(self, conn):
+        '''
+        Get Postgres' estimated rows for each coarse pass, for describe()
+        '''
+        if not self.backend.embedded:
+            self.estimates = [estimate_rows(conn, self.where_clause([fil]))
+                              for fil in self.coarse]
+
+    def where_clause(self, coarse=None):
+        coarse = self.coarse if coarse is None else coarse
+        if not coarse:
+            #no filter means no WHERE
+            return sql.SQL("")
+        return sql.SQL(" where {}").format(sql.SQL(" AND ").join(
+            [self.backend.coarse_pass(fil) for fil in coarse]))
+
+    def describe(self, render):
+        '''
+        The plan as lines of text, with render() turning SQL into a string
+        '''
+        lines = ["Coarse pass (in the db):"]
+        if not self.coarse:
+            lines.append("  (none, every journey)")
+        for i, (fil, estimate) in enumerate(zip(self.coarse, self.estimates), 1):
+            lines.append("  {}. {}{}".format(
+                i, render(self.backend.coarse_pass(fil)),
+                "" if estimate is None else "  (est. {} rows)".format(estimate)))
+        return lines + self.describe_fine_passes()
+
+    def describe_fine_passes(self):
+        lines = ["Fine passes (in Python, in order):"]
+        if not self.fine:
+            lines.append("  (none)")
+        for i, fil in enumerate(self.fine, 1):
+            lines.append("  {}. {}".format(i, describe_filter(fil)))
+        if self.skipped:
+            lines.append("Skipped fine passes (done by the coarse pass): {}".format(
+                ", ".join(type(fil).__name__ for fil in self.skipped)))
+        return lines
+
+
+def describe_filter(fil):
+    route_regex = getattr(fil, "route_regex", None)
+    if route_regex is not None:
+        return "{}({!r})".format(type(fil).__name__, route_regex)
+    return type(fil).__name__
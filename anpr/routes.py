@@ -0,0 +1,89 @@
+"""Matching routes against journey chains.
+
+A chain is a string of sites like "01_N>02_S>05_E", and alongside it is the
+time taken to reach each site after the first, like ">02_S(1.5)>05_E(3.0)".
+"""
+import bisect
+import datetime
+import itertools
+import re
+
+TIMESTAMP_COLUMN_INDEX = 1
+CLASS_COLUMN_INDEX = 2
+TOTAL_TIME_COLUMN_INDEX = 3
+CHAIN_COLUMN_INDEX = 4
+CHAIN_TIME_COLUMN_INDEX = 5
+
+TIME_ENTRY_REGEX = re.compile(r"\d\d\D?_(?:[NESW]|OUT|IN)\((\d+(?:.\d+)?)\)")
+
+
+class ParsedChain(object):
+    '''
+    A journey's chain, tokenized once: where each site starts in the chain
+    string, and the cumulative time offset (in minutes) at each site
+    '''
+    def __init__(self, chain, time_chain):
+        self.chain = chain
+        self.separators = [i for i, c in enumerate(chain) if c == ">"]
+        # The time chain starts with a ">", and has no entry for the first
+        # site (which is where the offsets are measured from).
+        self.time_entries = time_chain.split(">")[1:]
+        offsets = [0.0] + [float(TIME_ENTRY_REGEX.match(entry).group(1))
+                           for entry in self.time_entries]
+        self.cumulative_offsets = list(itertools.accumulate(offsets))
+
+    def site_index(self, position):
+        '''
+        How many sites into the chain the given string position is
+        '''
+        return bisect.bisect_right(self.separators, position - 1)
+
+
+class RouteMatcher(object):
+    '''
+    A route regex, compiled once, that finds every sub-route of a journey
+    matching it in a single pass over the chain
+    '''
+    def __init__(self, route_regex):
+        self.route_regex = route_regex
+        self.pattern = re.compile("(" + route_regex + ")")
+
+    def extract_routes(self, row):
+        '''
+        Return a row for each sub-route of the journey that matches, with
+        the start and end times changed to correspond to just the sub-route.
+        An empty list if the journey doesn't match at all.
+        '''
+        chain = row[CHAIN_COLUMN_INDEX]
+        parsed = None
+        out_rows = []
+        for match in self.pattern.finditer(chain):
+            if parsed is None:
+                #only journeys that match need their times parsing
+                parsed = ParsedChain(chain, row[CHAIN_TIME_COLUMN_INDEX])
+            matched_chain = match.group(1)
+            first_site = matched_chain.split(">", 1)[0]
+
+            match_chain_index_start = parsed.site_index(match.start())
+            match_chain_index_end = (
+                match_chain_index_start + matched_chain.count(">"))
+
+            start_time_offset = datetime.timedelta(
+                minutes=parsed.cumulative_offsets[match_chain_index_start])
+            end_time_offset = datetime.timedelta(
+                minutes=parsed.cumulative_offsets[match_chain_index_end])
+            start_time = row[TIMESTAMP_COLUMN_INDEX] + start_time_offset
+            end_time = row[TIMESTAMP_COLUMN_INDEX] + end_time_offset
+
+            # The time entries start at the second site, so if the match
+            # starts at the first site put it back in.
+            time_entries = parsed.time_entries[
+                max(match_chain_index_start - 1, 0):match_chain_index_end]
+            if match_chain_index_start == 0:
+                time_entries = [first_site + "(0.0)"] + time_entries
+            new_time_chain = ">".join(time_entries)
+            out_rows.append((
+                row[0], start_time, row[CLASS_COLUMN_INDEX],
+                end_time - start_time, matched_chain, new_time_chain,
+                end_time))
+        return out_rows
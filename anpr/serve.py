@@ -0,0 +1,413 @@
+"""A long-running search service, for `anpr serve`.
+
+Serves the DataSearcher filter, group and stats API as JSON over HTTP, on a
+TCP port or a Unix socket, keeping what a one-off script would have to set
+up every time: db connections (a pool, for Postgres), filters with their
+route regexes already compiled, and a ResultCache of finished searches.
+
+POST /search takes a search spec like
+    {"filters": [{"type": "site", "route": "01_N>02_S"},
+                 {"type": "class", "classes": ["Car", "Taxi"]}],
+     "groups": ["class", "hour"],
+     "stats": ["time", "n", {"type": "percentile", "percentiles": [50, 90]}]}
+and streams back JSON lines: first {"stats": [stat headers]}, then a
+{"group": [keys, outermost first], "stats": [...]} line per group (or a
+single {"stats": [...]} line without groups). POST /explain gives the plan
+for a spec, GET /captures?start=...&end=...[&camera=...] streams captures
+as JSON lines, and GET /health and GET /metrics report on the service.
+"""
+import collections
+import datetime
+import decimal
+import functools
+import http.server
+import json
+import os
+import socketserver
+import threading
+import urllib.parse
+
+from anpr import cache
+from anpr import filters
+from anpr import groups
+from anpr import stats
+from anpr.metrics import metrics
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8080
+DEFAULT_POOL_SIZE = 8
+FILTER_CACHE_SIZE = 1024
+
+GROUPS = {
+    "hour": groups.GroupByHour,
+    "class": groups.GroupByClass,
+}
+STATS = {
+    "time": stats.TimeStats,
+    "n": stats.NStats,
+    "percentile": stats.PercentileStats,
+}
+
+
+class SpecError(ValueError):
+    '''
+    A search spec that can't be understood
+    '''
+
+
+def parse_time(text):
+    if text is None:
+        return None
+    try:
+        return datetime.datetime.fromisoformat(text)
+    except (TypeError, ValueError):
+        raise SpecError("Bad time {!r}, expected ISO 8601".format(text))
+
+
+def _options(spec, name):
+    # A spec item is either a name, or a dict with a "type" and options.
+    if isinstance(spec, str):
+        return spec, {}
+    if not isinstance(spec, dict) or "type" not in spec:
+        raise SpecError("Bad {} {!r}".format(name, spec))
+    options = dict(spec)
+    return options.pop("type"), options
+
+
+def _required(options, kind, *names):
+    try:
+        return [options[name] for name in names]
+    except KeyError as e:
+        raise SpecError("{} filter needs {}".format(kind, e))
+
+
+def _check_str(value, name):
+    if not isinstance(value, str):
+        raise SpecError("{} must be a string, was {!r}".format(name, value))
+    return value
+
+
+def _check_list(value, name, check_item=_check_str):
+    # A string is iterable too, but would be taken a character at a time.
+    if not isinstance(value, list):
+        raise SpecError("{} must be a list, was {!r}".format(name, value))
+    for item in value:
+        check_item(item, name + " item")
+    return value
+
+
+def _check_percentile(value, name):
+    if (isinstance(value, bool) or not isinstance(value, (int, float))
+            or not 0 <= value <= 100):
+        raise SpecError("{} must be a number from 0 to 100, was {!r}".format(
+            name, value))
+    return value
+
+
+@functools.lru_cache(FILTER_CACHE_SIZE)
+def _make_filter(spec_json):
+    # Cached on the spec, so the same filter objects (and the route
+    # matchers they compile) are shared by every search that uses them.
+    kind, options = _options(json.loads(spec_json), "filter")
+    if kind == "site":
+        route, = _required(options, kind, "route")
+        return filters.SiteFilter(_check_str(route, "route"))
+    if kind == "start_end_via":
+        start, end = _required(options, kind, "start", "end")
+        return filters.StartEndViaFilter(
+            _check_str(start, "start"), _check_str(end, "end"),
+            _check_list(options.get("via", []), "via"),
+            bool(options.get("indirect_allowed", False)))
+    if kind == "any_site":
+        sites, = _required(options, kind, "sites")
+        return filters.AnySiteFilter(_check_list(sites, "sites"))
+    if kind == "class":
+        classes, = _required(options, kind, "classes")
+        return filters.ClassFilter(_check_list(classes, "classes"))
+    if kind == "time":
+        return filters.TimeRangeFilter(
+            parse_time(options.get("start")), parse_time(options.get("end")))
+    raise SpecError("Unknown filter type {!r}".format(kind))
+
+
+def make_filter(spec):
+    fil = _make_filter(json.dumps(spec, sort_keys=True))
+    # Build the route matcher now, rather than in the first search.
+    if isinstance(fil, filters.SiteFilter):
+        fil.route_matcher
+    return fil
+
+
+def make_group(spec):
+    kind, _options_ = _options(spec, "group")
+    if kind not in GROUPS:
+        raise SpecError("Unknown group {!r}".format(kind))
+    return GROUPS[kind]()
+
+
+def make_stat(spec):
+    kind, options = _options(spec, "stat")
+    if kind not in STATS:
+        raise SpecError("Unknown stat {!r}".format(kind))
+    if "percentiles" in options:
+        _check_list(options["percentiles"], "percentiles", _check_percentile)
+    try:
+        return STATS[kind](**options)
+    except TypeError as e:
+        raise SpecError("Bad options for {} stat: {}".format(kind, e))
+
+
+def parse_search(spec):
+    '''
+    (filter_lst, group_lst, stats_lst) from a JSON search spec
+    '''
+    if not isinstance(spec, dict):
+        raise SpecError("A search spec must be a JSON object")
+    return ([make_filter(f) for f in spec.get("filters", [])],
+            [make_group(g) for g in spec.get("groups", [])],
+            [make_stat(s) for s in spec.get("stats", [])])
+
+
+def _json_default(value):
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if hasattr(value, "item"):
+        # numpy scalars, from the columnar code
+        return value.item()
+    raise TypeError("Can't encode {!r} as JSON".format(value))
+
+
+def json_line(obj):
+    return (json.dumps(obj, default=_json_default) + "\n").encode("utf-8")
+
+
+def result_lines(result, path=()):
+    '''
+    Yield a {"group": keys, "stats": stats} dict for each group of a
+    combined() result, or just {"stats": stats} if it wasn't grouped
+    '''
+    if isinstance(result, dict):
+        for key, value in result.items():
+            for line in result_lines(value, path + (key,)):
+                yield line
+    elif path:
+        yield {"group": list(path), "stats": result}
+    else:
+        yield {"stats": result}
+
+
+class SearchService(object):
+    '''
+    The state kept between requests, and the searches themselves.
+    searcher_class is DataSearcher, passed in to avoid a circular import.
+    With Postgres the searches share the connection_pool (see
+    anpr.make_pool()); otherwise each opens its own connection, and no more
+    than pool_size run at once.
+    '''
+    def __init__(self, searcher_class, dbname, backend, password=None,
+                 connection_pool=None, pool_size=DEFAULT_POOL_SIZE,
+                 result_cache=None, **searcher_kwargs):
+        self.searcher_class = searcher_class
+        self.dbname = dbname
+        self.backend = backend
+        self.password = password
+        self.connection_pool = connection_pool
+        self.result_cache = result_cache or cache.ResultCache()
+        self.searcher_kwargs = searcher_kwargs
+        #the pool raises an error rather than wait when it runs out of
+        #connections, so wait here instead
+        self.slots = threading.BoundedSemaphore(
+            connection_pool.maxconn if connection_pool is not None else pool_size)
+        self.started = datetime.datetime.now()
+        self.n_requests = collections.Counter()
+        self._requests_lock = threading.Lock()
+
+    def searcher(self, filter_lst=[], group_lst=[], stats_lst=[], **kwargs):
+        options = dict(self.searcher_kwargs, **kwargs)
+        if self.connection_pool is not None:
+            options["connection_pool"] = self.connection_pool
+        return self.searcher_class(
+            self.dbname, self.password, filter_lst, group_lst, stats_lst,
+            result_cache=self.result_cache, backend=self.backend, **options)
+
+    def search(self, spec):
+        '''
+        Yield the JSON lines for a search spec
+        '''
+        filter_lst, group_lst, stats_lst = parse_search(spec)
+        with self.slots, self.searcher(filter_lst, group_lst, stats_lst) as searcher:
+            with metrics.timer("serve.search"):
+                result = searcher.combined()
+            headers = searcher.stat_headers()
+        yield json_line({"stats": headers})
+        for line in result_lines(result):
+            yield json_line(line)
+
+    def explain(self, spec):
+        filter_lst, group_lst, stats_lst = parse_search(spec)
+        with self.slots, self.searcher(filter_lst, group_lst, stats_lst) as searcher:
+            return searcher.explain()
+
+    def captures(self, start, end, cameras=None):
+        '''
+        Yield the JSON lines for the captures from start up to end, as they
+        come from the db
+        '''
+        with self.slots, self.searcher(stream=True) as searcher:
+            for camera, vehicle, direction, ts in searcher.captures(
+                    start, end, cameras):
+                yield json_line([camera, vehicle, direction, ts])
+
+    def count_request(self, path):
+        with self._requests_lock:
+            self.n_requests[path] += 1
+
+    def health(self):
+        with self._requests_lock:
+            n_requests = dict(self.n_requests)
+        return {
+            "dbname": self.dbname,
+            "backend": self.backend.name,
+            "started": self.started,
+            "requests": n_requests,
+            "cached_filters": _make_filter.cache_info().currsize,
+        }
+
+    def close(self):
+        if self.connection_pool is not None:
+            self.connection_pool.closeall()
+
+
+class SearchRequestHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def service(self):
+        return self.server.service
+
+    def address_string(self):
+        # Unix socket clients have no address.
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        self.handle_errors(url.path, lambda: self.route_get(url.path, query))
+
+    def do_POST(self):
+        path = urllib.parse.urlsplit(self.path).path
+        self.handle_errors(path, lambda: self.route_post(path))
+
+    def route_get(self, path, query):
+        if path == "/health":
+            self.send_json(self.service.health())
+        elif path == "/metrics":
+            self.send_json(metrics.snapshot())
+        elif path == "/captures":
+            if "start" not in query or "end" not in query:
+                raise SpecError("/captures needs start and end")
+            cameras = query.get("camera")
+            self.send_lines(self.service.captures(
+                parse_time(query["start"][0]), parse_time(query["end"][0]),
+                cameras))
+        else:
+            self.send_json({"error": "Not found"}, 404)
+
+    def route_post(self, path):
+        if path == "/search":
+            self.send_lines(self.service.search(self.read_json()))
+        elif path == "/explain":
+            self.send_json({"plan": self.service.explain(self.read_json())})
+        else:
+            self.send_json({"error": "Not found"}, 404)
+
+    def handle_errors(self, path, handler):
+        self.service.count_request(path)
+        try:
+            handler()
+        except SpecError as e:
+            self.send_json({"error": str(e)}, 400)
+        except Exception as e:
+            self.log_error("%s failed: %r", path, e)
+            self.send_json({"error": str(e)}, 500)
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            return json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+        except ValueError as e:
+            raise SpecError("Bad JSON: {}".format(e))
+
+    def send_json(self, obj, status=200):
+        body = json_line(obj)
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_lines(self, lines):
+        '''
+        Send JSON lines with chunked encoding, as they are made. The first
+        line is made before anything is sent, so that a bad spec still gets
+        an error response.
+        '''
+        lines = iter(lines)
+        try:
+            first = next(lines, b"")
+        except Exception:
+            lines.close()
+            raise
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for line in _prepend(first, lines):
+                if line:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+            self.wfile.write(b"0\r\n\r\n")
+        except Exception as e:
+            # Too late for an error response, leave the response unfinished
+            # so the client can tell it's incomplete.
+            self.log_error("%s failed while streaming: %r", self.path, e)
+            self.close_connection = True
+        finally:
+            lines.close()
+
+
+def _prepend(first, rest):
+    yield first
+    for item in rest:
+        yield item
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+                              socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def make_server(service, host=DEFAULT_HOST, port=DEFAULT_PORT,
+                socket_path=None):
+    '''
+    An HTTP server for the service, on the Unix socket if a path is given,
+    otherwise on host and port
+    '''
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        server = ThreadingUnixHTTPServer(socket_path, SearchRequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), SearchRequestHandler)
+    server.service = service
+    return server
@@ -0,0 +1,77 @@
+"""Finding cameras by where they are, using the GiST indexes on cameras.
+
+The camera lists can be turned into site lists with camera_sites(), for
+filters.AnySiteFilter (journeys through an area) or SiteFilter. Distances
+are in metres, and points are (longitude, latitude) in WGS 84, as in the
+cameras KML file.
+"""
+from anpr import backends
+
+SRID = 4326
+
+CAMERAS_LOCATION_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS cameras_location_idx "
+    "ON cameras USING GIST (location);"
+)
+# Distances in metres are measured on the geography, which needs its own
+# index on the cast for ST_DWithin to use.
+CAMERAS_GEOGRAPHY_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS cameras_geography_idx "
+    "ON cameras USING GIST (CAST(location AS geography));"
+)
+
+
+def create_indexes(cursor):
+    cursor.execute(CAMERAS_LOCATION_INDEX_SQL)
+    cursor.execute(CAMERAS_GEOGRAPHY_INDEX_SQL)
+    cursor.execute("ANALYZE cameras;")
+
+
+def point_ewkt(longitude, latitude):
+    return "SRID={};POINT({:.6f} {:.6f})".format(SRID, longitude, latitude)
+
+
+def line_ewkt(path):
+    if len(path) < 2:
+        raise ValueError("A corridor needs at least two points")
+    return "SRID={};LINESTRING({})".format(SRID, ", ".join(
+        "{:.6f} {:.6f}".format(longitude, latitude)
+        for longitude, latitude in path))
+
+
+def cameras_within(conn, longitude, latitude, metres):
+    '''
+    The cameras within the given distance of a point, nearest first
+    '''
+    with conn.cursor() as cur:
+        cur.execute(
+            "WITH centre AS (SELECT CAST(ST_GeomFromEWKT(%s) AS geography) AS g) "
+            "SELECT id FROM cameras, centre "
+            "WHERE ST_DWithin(CAST(location AS geography), centre.g, %s) "
+            "ORDER BY ST_Distance(CAST(location AS geography), centre.g), id;",
+            (point_ewkt(longitude, latitude), metres))
+        return [camera for camera, in cur.fetchall()]
+
+
+def cameras_along(conn, path, metres):
+    '''
+    The cameras within the given distance of the line through the path's
+    (longitude, latitude) points, in the order they come along it
+    '''
+    with conn.cursor() as cur:
+        cur.execute(
+            "WITH corridor AS (SELECT ST_GeomFromEWKT(%s) AS line) "
+            "SELECT id FROM cameras, corridor "
+            "WHERE ST_DWithin(CAST(location AS geography), "
+            "CAST(corridor.line AS geography), %s) "
+            "ORDER BY ST_LineLocatePoint(corridor.line, location), id;",
+            (line_ewkt(path), metres))
+        return [camera for camera, in cur.fetchall()]
+
+
+def camera_sites(cameras, directions=backends.DIRECTIONS):
+    '''
+    The sites (e.g. "01_N") for the cameras, in each of the directions
+    '''
+    return ["{}_{}".format(camera, direction)
+            for camera in cameras for direction in directions]
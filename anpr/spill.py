@@ -0,0 +1,125 @@
+"""Grouping with a memory budget, spilling to temporary files.
+
+The groupers' group() keeps every row of every group in memory until the
+stats are done. SpillingGrouper instead holds at most memory_budget rows:
+past that, the buffered rows are written out to one of n_partitions
+temporary files, chosen by a hash of their group, and buffering starts
+again. Each file is then read back in turn, and its rows fed to streaming
+stats aggregators (see stats.BaseAggregator), which are finalized and
+dropped before the next file is read. Every row of a group goes to the same
+file, so only one file's aggregators are ever held at once.
+"""
+import collections
+import os
+import pickle
+import tempfile
+
+from anpr.metrics import metrics
+
+DEFAULT_MEMORY_BUDGET = 1000000
+DEFAULT_PARTITIONS = 64
+
+
+class SpillingGrouper(object):
+    '''
+    Groups rows by the groupers (the last grouper giving the outermost key,
+    as with DataSearcher), holding no more than memory_budget rows in memory.
+    The temporary files go in directory, or the default temporary directory.
+    '''
+    def __init__(self, groupers, memory_budget=DEFAULT_MEMORY_BUDGET,
+                 n_partitions=DEFAULT_PARTITIONS, directory=None):
+        if not groupers:
+            raise ValueError("SpillingGrouper needs at least one grouper")
+        self.groupers = list(reversed(groupers))
+        self.memory_budget = memory_budget
+        self.n_partitions = n_partitions
+        self.directory = directory
+
+    def key_path(self, row):
+        '''
+        The row's group keys, outermost first
+        '''
+        return tuple(grouper.row_key(row) for grouper in self.groupers)
+
+    def partitions(self, rows):
+        '''
+        Yield an iterable of (key path, list of rows) chunks for each
+        partition. All the chunks of a group are in the same partition, but
+        a group can have more than one chunk. If the rows fit in the budget
+        there is a single partition, with one chunk per group.
+        '''
+        buffered = collections.defaultdict(list)
+        n_buffered = 0
+        files = None
+        tmpdir = None
+        try:
+            for row in rows:
+                buffered[self.key_path(row)].append(row)
+                n_buffered += 1
+                if n_buffered >= self.memory_budget:
+                    if files is None:
+                        tmpdir = tempfile.mkdtemp(
+                            prefix="anpr_spill_", dir=self.directory)
+                        files = [open(os.path.join(tmpdir, str(i)), "w+b")
+                                 for i in range(self.n_partitions)]
+                    self._spill(buffered, files)
+                    buffered = collections.defaultdict(list)
+                    n_buffered = 0
+
+            if files is None:
+                yield buffered.items()
+                return
+            self._spill(buffered, files)
+            buffered = None
+            for spill_file in files:
+                spill_file.seek(0)
+                yield _read_chunks(spill_file)
+                # Only one file's worth of rows is needed at once.
+                spill_file.close()
+        finally:
+            if files is not None:
+                for spill_file in files:
+                    spill_file.close()
+                for i in range(self.n_partitions):
+                    os.remove(os.path.join(tmpdir, str(i)))
+                os.rmdir(tmpdir)
+
+    def _spill(self, buffered, files):
+        n_rows = 0
+        for key, chunk in buffered.items():
+            pickle.dump((key, chunk), files[hash(key) % self.n_partitions],
+                        pickle.HIGHEST_PROTOCOL)
+            n_rows += len(chunk)
+        metrics.count("group.spills")
+        metrics.count("group.spilled_rows", n_rows)
+
+    def aggregate(self, rows, aggregators, finalize):
+        '''
+        Feed each group's rows to a fresh list of aggregators from
+        aggregators(), and give {key: ... {key: finalize(aggregators)}},
+        nested as DataSearcher.group() would be
+        '''
+        result = {}
+        for partition in self.partitions(rows):
+            partial = {}
+            for key, chunk in partition:
+                group_aggregators = partial.get(key)
+                if group_aggregators is None:
+                    group_aggregators = partial[key] = aggregators()
+                for row in chunk:
+                    for agg in group_aggregators:
+                        agg.update(row)
+            for key, group_aggregators in partial.items():
+                node = result
+                for outer_key in key[:-1]:
+                    node = node.setdefault(outer_key, {})
+                node[key[-1]] = finalize(group_aggregators)
+        return result
+
+
+def _read_chunks(spill_file):
+    while True:
+        try:
+            yield pickle.load(spill_file)
+        except EOFError:
+            return
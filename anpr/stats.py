@@ -1,6 +1,11 @@
 import abc
+import collections
 import datetime
 
+from psycopg2 import sql
+
+from anpr import tdigest
+
 TIMESTAMP_COLUMN_INDEX = 1
 CLASS_COLUMN_INDEX = 2
 TOTAL_TIME_COLUMN_INDEX = 3
@@ -10,40 +15,270 @@ CHAIN_TIME_COLUMN_INDEX = 5
 class BaseStats(object):
     __metaclass__ = abc.ABCMeta
 
+    def aggregator(self):
+        '''
+        Return a new, empty BaseAggregator that computes these stats.
+        By default the rows are buffered and given to make_stats() on
+        finalize(), so stats written with just make_stats() still work
+        (though without the memory savings of streaming)
+        '''
+        return BufferedAggregator(self)
+
     @abc.abstractmethod
+    def stat_descriptions(self):
+        return
+
     def make_stats(self, rows):
+        '''
+        The stats for a list of rows. Subclasses override this, aggregator(),
+        or both
+        '''
+        if type(self).aggregator is BaseStats.aggregator:
+            raise NotImplementedError(
+                "{} needs make_stats() or aggregator()".format(type(self).__name__))
+        agg = self.aggregator()
+        for row in rows:
+            agg.update(row)
+        return agg.finalize()
+
+    def sql_group_keys(self):
+        '''
+        SQL expressions that the rows must additionally be grouped by for
+        sql_aggregates() to be computed (e.g. to count per class)
+        '''
+        return []
+
+    def sql_aggregates(self):
+        '''
+        SQL aggregate expressions over the journeys table giving partial
+        results for these stats, or None if they can't be done in SQL
+        '''
+        return None
+
+    def aggregator_from_sql(self, values):
+        '''
+        Make an aggregator from the values of sql_group_keys() followed by
+        sql_aggregates() for one group of rows
+        '''
+        raise NotImplementedError
+
+    def column_stats(self, columns):
+        '''
+        The vectorized version of make_stats(), for a columnar.JourneyColumns
+        '''
+        raise NotImplementedError
+
+
+class BaseAggregator(object):
+    '''
+    Running state for a BaseStats.
+    Rows are fed to update() one at a time, so each row is only seen once,
+    partial aggregates (e.g. from different groups or worker processes) can
+    be combined with merge(), and finalize() gives the stats.
+    '''
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def update(self, row):
         return
 
     @abc.abstractmethod
-    def stat_descriptions(self):
+    def merge(self, other):
+        '''
+        Fold another aggregator of the same type into this one,
+        returning this one
+        '''
+        return
+
+    @abc.abstractmethod
+    def finalize(self):
+        '''
+        Return the list of stats, in the order of stat_descriptions()
+        '''
         return
 
 
+class BufferedAggregator(BaseAggregator):
+    '''
+    The default aggregator, keeping the rows for the stats' make_stats()
+    '''
+    def __init__(self, stats):
+        self.stats = stats
+        self.rows = []
+
+    def update(self, row):
+        self.rows.append(row)
+
+    def merge(self, other):
+        self.rows.extend(other.rows)
+        return self
+
+    def finalize(self):
+        return self.stats.make_stats(self.rows)
+
+
+def merge_aggregates(left, right):
+    '''
+    Merge two lists of aggregators, or two (possibly nested) dicts of them
+    keyed by group, as made by DataSearcher.aggregate()
+    '''
+    if isinstance(left, dict):
+        merged = dict(left)
+        for key, value in right.items():
+            if key in merged:
+                merged[key] = merge_aggregates(merged[key], value)
+            else:
+                merged[key] = value
+        return merged
+    return [l.merge(r) for l, r in zip(left, right)]
+
+
 class TimeStats(BaseStats):
     '''
 
     '''
-    def make_stats(self, rows):
-        trip_times = [row[TOTAL_TIME_COLUMN_INDEX] for row in rows]
-        if len(trip_times): #avoid divide by zero error
-            average_trip_time = sum(trip_times, datetime.timedelta())/len(trip_times)
-        else:
-            average_trip_time = None
-        return [min(trip_times).seconds, max(trip_times).seconds, average_trip_time.seconds]
+    def aggregator(self):
+        return TimeAggregator()
+
+    def sql_aggregates(self):
+        trip_time = sql.Identifier("total_trip_time")
+        return [sql.SQL("count(*)")] + [
+            sql.SQL(func + "({})").format(trip_time)
+            for func in ("sum", "min", "max")]
+
+    def aggregator_from_sql(self, values):
+        n, total, min_trip_time, max_trip_time = values
+        agg = TimeAggregator()
+        if n:
+            agg.n = n
+            agg.total = total
+            agg.min = min_trip_time
+            agg.max = max_trip_time
+        return agg
 
+    def column_stats(self, columns):
+        trip_times = columns.trip_time
+        if not len(trip_times):
+            return [None, None, None]
+        #match timedelta.seconds
+        return [int(t // 1) % 86400 for t in
+                (trip_times.min(), trip_times.max(), trip_times.mean())]
 
     def stat_descriptions(self):
         return ["Min trip time(s)", "Max trip time(s)", "Avg. trip time"]
 
+class TimeAggregator(BaseAggregator):
+    def __init__(self):
+        self.n = 0
+        self.total = datetime.timedelta()
+        self.min = None
+        self.max = None
+
+    def update(self, row):
+        trip_time = row[TOTAL_TIME_COLUMN_INDEX]
+        self.n += 1
+        self.total += trip_time
+        if self.min is None or trip_time < self.min:
+            self.min = trip_time
+        if self.max is None or trip_time > self.max:
+            self.max = trip_time
+
+    def merge(self, other):
+        if other.n:
+            self.total += other.total
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+            self.n += other.n
+        return self
+
+    def finalize(self):
+        if not self.n: #avoid divide by zero error
+            return [None, None, None]
+        average_trip_time = self.total / self.n
+        return [self.min.seconds, self.max.seconds, average_trip_time.seconds]
+
+class PercentileStats(BaseStats):
+    '''
+    Trip time percentiles (in seconds), estimated with a t-digest so
+    memory use doesn't grow with the number of rows
+    '''
+    def __init__(self, percentiles=(50, 90, 95), compression=tdigest.DEFAULT_COMPRESSION):
+        self.percentiles = percentiles
+        self.compression = compression
+
+    def aggregator(self):
+        return PercentileAggregator(self.percentiles, self.compression)
+
+    def column_stats(self, columns):
+        #with all the trip times to hand, these are exact
+        if not len(columns):
+            return [None for p in self.percentiles]
+        return [int(round(t)) for t in
+                columns.trip_time_percentiles(self.percentiles)]
+
+    def stat_descriptions(self):
+        return ["Median trip time(s)" if p == 50
+                else "{}th percentile trip time(s)".format(p)
+                for p in self.percentiles]
+
+class PercentileAggregator(BaseAggregator):
+    def __init__(self, percentiles, compression):
+        self.percentiles = percentiles
+        self.digest = tdigest.TDigest(compression)
+
+    def update(self, row):
+        self.digest.add(row[TOTAL_TIME_COLUMN_INDEX].total_seconds())
+
+    def merge(self, other):
+        self.digest.merge(other.digest)
+        return self
+
+    def finalize(self):
+        if not len(self.digest):
+            return [None for p in self.percentiles]
+        return [int(round(self.digest.quantile(p / 100.0)))
+                for p in self.percentiles]
+
 class NStats(BaseStats):
-    def make_stats(self, rows):
-        n_journeys = len(rows)
-        veh_classes = [row[CLASS_COLUMN_INDEX] for row in rows]
+    def aggregator(self):
+        return NAggregator()
+
+    def sql_group_keys(self):
+        return [sql.Identifier("class")]
+
+    def sql_aggregates(self):
+        return [sql.SQL("count(*)")]
+
+    def aggregator_from_sql(self, values):
+        veh_class, n_class = values
+        agg = NAggregator()
+        agg.class_counts[veh_class] = n_class
+        return agg
+
+    def column_stats(self, columns):
+        n_journeys = len(columns)
         class_summary = {}
-        for veh_class in set(veh_classes):
-            n_class = len([c for c in veh_classes if veh_class == c])
+        for veh_class, n_class in columns.class_counts().items():
             class_summary[veh_class] = (n_class / n_journeys * 100, n_class)
         return [n_journeys, class_summary]
 
     def stat_descriptions(self):
         return ["No. journeys", "Journeys by class (percentage, No. journeys)"]
+
+class NAggregator(BaseAggregator):
+    def __init__(self):
+        self.class_counts = collections.Counter()
+
+    def update(self, row):
+        self.class_counts[row[CLASS_COLUMN_INDEX]] += 1
+
+    def merge(self, other):
+        self.class_counts.update(other.class_counts)
+        return self
+
+    def finalize(self):
+        n_journeys = sum(self.class_counts.values())
+        class_summary = {}
+        for veh_class, n_class in self.class_counts.items():
+            class_summary[veh_class] = (n_class / n_journeys * 100, n_class)
+        return [n_journeys, class_summary]
@@ -0,0 +1,89 @@
+"""Precomputed travel time summaries, built from the captures table.
+
+Two materialized views are kept:
+segment_times: for each pair of cameras a vehicle was seen at one after the
+    other, the number of such hops and their travel times, per hour and class
+od_counts: for each origin (first camera) and destination (last camera) of a
+    vehicle's trip, the number of trips and their trip times, per hour (of
+    the start of the trip) and class
+
+Times are kept as counts, sums, mins and maxes so that they can be combined
+over hours or classes when querying.
+"""
+
+SEGMENT_TIMES_SQL = (
+    "CREATE MATERIALIZED VIEW IF NOT EXISTS segment_times AS "
+    "SELECT hop.camera AS from_camera, hop.direction AS from_direction, "
+    "hop.next_camera AS to_camera, hop.next_direction AS to_direction, "
+    "date_trunc('hour', hop.ts) AS hour, vehicles.class, "
+    "count(*) AS n, sum(hop.seconds) AS total_seconds, "
+    "min(hop.seconds) AS min_seconds, max(hop.seconds) AS max_seconds "
+    "FROM ("
+        "SELECT vehicle, camera, direction, ts, "
+        "lead(camera) OVER w AS next_camera, "
+        "lead(direction) OVER w AS next_direction, "
+        "EXTRACT(EPOCH FROM lead(ts) OVER w - ts) AS seconds "
+        "FROM captures WINDOW w AS (PARTITION BY vehicle ORDER BY ts)"
+    ") AS hop JOIN vehicles ON vehicles.id = hop.vehicle "
+    "WHERE hop.next_camera IS NOT NULL "
+    "GROUP BY 1, 2, 3, 4, 5, 6;"
+)
+SEGMENT_TIMES_INDEX_SQL = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS segment_times_key ON segment_times "
+    "(from_camera, to_camera, hour, from_direction, to_direction, class);"
+)
+
+OD_COUNTS_SQL = (
+    "CREATE MATERIALIZED VIEW IF NOT EXISTS od_counts AS "
+    "SELECT trip.origin, trip.destination, "
+    "date_trunc('hour', trip.start_ts) AS hour, vehicles.class, "
+    "count(*) AS n, sum(trip.seconds) AS total_seconds, "
+    "min(trip.seconds) AS min_seconds, max(trip.seconds) AS max_seconds "
+    "FROM ("
+        "SELECT vehicle, "
+        "(array_agg(camera ORDER BY ts))[1] AS origin, "
+        "(array_agg(camera ORDER BY ts DESC))[1] AS destination, "
+        "min(ts) AS start_ts, "
+        "EXTRACT(EPOCH FROM max(ts) - min(ts)) AS seconds "
+        "FROM captures GROUP BY vehicle"
+    ") AS trip JOIN vehicles ON vehicles.id = trip.vehicle "
+    "GROUP BY 1, 2, 3, 4;"
+)
+OD_COUNTS_INDEX_SQL = (
+    "CREATE UNIQUE INDEX IF NOT EXISTS od_counts_key ON od_counts "
+    "(origin, destination, hour, class);"
+)
+
+SUMMARY_VIEWS = ("segment_times", "od_counts")
+
+
+def create_summaries(conn):
+    '''
+    Create (and populate) the summary views, if they don't already exist
+    '''
+    with conn.cursor() as cur:
+        for statement in (SEGMENT_TIMES_SQL, SEGMENT_TIMES_INDEX_SQL,
+                          OD_COUNTS_SQL, OD_COUNTS_INDEX_SQL):
+            cur.execute(statement)
+    conn.commit()
+
+
+def summaries_exist(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT count(*) FROM pg_matviews WHERE matviewname IN %s;",
+            (SUMMARY_VIEWS,))
+        n, = cur.fetchone()
+    return n == len(SUMMARY_VIEWS)
+
+
+def refresh_summaries(conn):
+    '''
+    Rebuild the summary views from the current captures. Done concurrently,
+    so queries against the old summaries can carry on meanwhile.
+    '''
+    with conn.cursor() as cur:
+        for view in SUMMARY_VIEWS:
+            cur.execute(
+                "REFRESH MATERIALIZED VIEW CONCURRENTLY {};".format(view))
+    conn.commit()
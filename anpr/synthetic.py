@@ -0,0 +1,175 @@
+"""Synthetic ANPR data, for benchmarking without real survey spreadsheets.
+
+Trips are random walks over a set of cameras. They can be written out as a
+workbook in the layout DataLoader expects, as a KML file of camera locations
+for `anpr create`, or straight into the journeys table.
+"""
+import datetime
+import io
+import random
+
+import openpyxl
+
+import anpr
+from anpr import backends
+from anpr import bulk
+from anpr import cache
+
+CLASSES = (
+    "Bus_Coach", "Car", "LGV<3.5T", "Motorcycle", "OGV1", "OGV2", "Other",
+    "Taxi")
+CLASS_WEIGHTS = (2, 70, 12, 2, 4, 3, 2, 5)
+DIRECTIONS = ("N", "S", "E", "W")
+SURVEY_START = datetime.datetime(2017, 6, 5)
+
+# Roughly central Cambridge, where the cameras get scattered about.
+CENTRE_LON = 0.1218
+CENTRE_LAT = 52.2053
+
+
+def camera_names(n_cameras):
+    return ["{:02d}".format(i) for i in range(1, n_cameras + 1)]
+
+
+class TripGenerator(object):
+    '''
+    Makes random trips: a start time, a vehicle class, and a chain of
+    (camera, direction, minutes since the previous camera) hops
+    '''
+    def __init__(self, n_cameras=97, min_chain=2, max_chain=8,
+                 survey_days=7, seed=0):
+        self.cameras = camera_names(n_cameras)
+        self.min_chain = min_chain
+        self.max_chain = max_chain
+        self.survey_seconds = survey_days * 24 * 3600
+        self.random = random.Random(seed)
+        self.class_pool = [veh_class for veh_class, weight
+                           in zip(CLASSES, CLASS_WEIGHTS)
+                           for _ in range(weight)]
+
+    def trip(self, start_camera):
+        rnd = self.random
+        timestamp = SURVEY_START + datetime.timedelta(
+            seconds=rnd.randrange(self.survey_seconds))
+        veh_class = rnd.choice(self.class_pool)
+        hops = [(start_camera, rnd.choice(DIRECTIONS), 0.0)]
+        for _ in range(rnd.randint(self.min_chain, self.max_chain) - 1):
+            hops.append((
+                rnd.choice(self.cameras), rnd.choice(DIRECTIONS),
+                round(rnd.uniform(0.5, 15.0), 1)))
+        return timestamp, veh_class, hops
+
+    def trips(self, n_trips):
+        '''
+        Yield (start camera, trip) for n_trips trips spread over the cameras
+        '''
+        for i in range(n_trips):
+            start_camera = self.cameras[i % len(self.cameras)]
+            yield start_camera, self.trip(start_camera)
+
+
+def format_chain(hops):
+    '''
+    The chain and trip details strings for a trip's hops, as they appear in
+    the spreadsheets, e.g. "01_N>02_S" and ">02_S(1.5)"
+    '''
+    chain = ">".join("{}_{}".format(camera, direction)
+                     for camera, direction, _mins in hops)
+    details = "".join(">{}_{}({})".format(camera, direction, mins)
+                      for camera, direction, mins in hops[1:])
+    return chain, details
+
+
+def write_workbook(path, n_trips, generator=None):
+    '''
+    Write a workbook with one sheet per camera, laid out as DataLoader
+    expects, holding n_trips trips in total
+    '''
+    generator = generator or TripGenerator()
+    wb = openpyxl.Workbook(write_only=True)
+    for title in anpr.UNINTERESTING_SHEETS:
+        wb.create_sheet(title).append(["Not camera data"])
+
+    rows_by_camera = {camera: [] for camera in generator.cameras}
+    for start_camera, (timestamp, veh_class, hops) in generator.trips(n_trips):
+        chain, details = format_chain(hops)
+        total_mins = sum(mins for _camera, _direction, mins in hops)
+        rows_by_camera[start_camera].append(
+            [timestamp, veh_class, total_mins, chain, details])
+
+    id_row, id_col = openpyxl.utils.cell.coordinate_to_tuple(
+        anpr.CAMERA_ID_CELL)
+    for camera in generator.cameras:
+        sheet = wb.create_sheet(camera)
+        for row_number in range(1, anpr.DATA_START_ROW):
+            row = [None] * anpr.DATA_END_COL
+            if row_number == id_row:
+                row[id_col - 1] = int(camera)
+            sheet.append(row)
+        padding = [None] * (anpr.DATA_START_COL - 1)
+        for row in rows_by_camera[camera]:
+            sheet.append(padding + row)
+    wb.save(path)
+
+
+def write_kml(path, n_cameras):
+    '''
+    Write a KML file placing n_cameras cameras, for `anpr create`
+    '''
+    rnd = random.Random(n_cameras)
+    placemarks = []
+    for camera in camera_names(n_cameras):
+        lon = CENTRE_LON + rnd.uniform(-0.05, 0.05)
+        lat = CENTRE_LAT + rnd.uniform(-0.03, 0.03)
+        placemarks.append(
+            "<Placemark><name>{}</name>"
+            "<ExtendedData><Data name=\"Description\">"
+            "<value>Synthetic camera {}</value></Data></ExtendedData>"
+            "<Point><coordinates>{:.6f},{:.6f},0</coordinates></Point>"
+            "</Placemark>".format(int(camera), camera, lon, lat))
+    with open(path, "w") as outfile:
+        outfile.write(
+            "<?xml version=\"1.0\" encoding=\"UTF-8\"?>"
+            "<kml xmlns=\"http://www.opengis.net/kml/2.2\"><Document>"
+            "<name>Synthetic cameras</name>{}</Document></kml>".format(
+                "".join(placemarks)))
+
+
+def journey_rows(n_trips, generator=None):
+    '''
+    Yield rows for the journeys table, without the journey_id
+    '''
+    generator = generator or TripGenerator()
+    for _start_camera, (timestamp, veh_class, hops) in generator.trips(n_trips):
+        chain, details = format_chain(hops)
+        trip_time = datetime.timedelta(
+            minutes=sum(mins for _camera, _direction, mins in hops))
+        sites = sorted(set(chain.split(">")))
+        yield (timestamp, veh_class, trip_time, chain, details,
+               timestamp + trip_time, sites)
+
+
+def populate_journeys(conn, n_trips, generator=None,
+                      backend=backends.POSTGRES):
+    '''
+    COPY n_trips synthetic journeys into an existing journeys table
+    '''
+    if backend.embedded:
+        backend.insert_journeys(conn, journey_rows(n_trips, generator))
+        return
+    buf = io.StringIO()
+    for (timestamp, veh_class, trip_time, chain, details, end_time,
+            sites) in journey_rows(n_trips, generator):
+        fields = (
+            timestamp, veh_class,
+            "{} seconds".format(trip_time.total_seconds()), chain, details,
+            end_time, "{" + ",".join(sites) + "}")
+        buf.write("\t".join(bulk.copy_text(f) for f in fields) + "\n")
+    buf.seek(0)
+    with conn.cursor() as cur:
+        cur.copy_expert(
+            "COPY journeys (timestamp, class, total_trip_time, chain, "
+            "trip_destinations_and_time, journey_end_time, sites) "
+            "FROM STDIN;", buf)
+        cache.bump_data_version(cur)
+    conn.commit()
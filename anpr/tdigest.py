@@ -0,0 +1,117 @@
+"""A merging t-digest, for estimating quantiles in bounded memory.
+
+Values are summarised as a sorted list of weighted centroids. Centroids near
+the median may hold many values, centroids near the tails only a few, so
+extreme quantiles stay accurate. The number of centroids is bounded by the
+compression parameter rather than by the number of values added, and two
+digests can be merged, so partial digests from different groups or worker
+processes can be combined.
+
+See Dunning & Ertl, "Computing Extremely Accurate Quantiles Using t-Digests".
+"""
+
+DEFAULT_COMPRESSION = 100
+
+
+class TDigest(object):
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.count = 0
+        self.min = None
+        self.max = None
+        # Sorted lists of [mean, weight].
+        self._centroids = []
+        # Values added since the last compress, not yet sorted.
+        self._buffer = []
+
+    def __len__(self):
+        return self.count
+
+    def add(self, value, weight=1):
+        self._buffer.append([value, weight])
+        self.count += weight
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        if len(self._buffer) >= 5 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        '''
+        Fold another digest into this one, returning this one
+        '''
+        if not other.count:
+            return self
+        self._buffer.extend([list(c) for c in other._centroids])
+        self._buffer.extend([list(c) for c in other._buffer])
+        self.count += other.count
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+        self._compress()
+        return self
+
+    def _compress(self):
+        if not self._buffer:
+            return
+        points = sorted(self._centroids + self._buffer)
+        self._buffer = []
+        total = float(self.count)
+
+        centroids = []
+        cur_mean, cur_weight = points[0]
+        weight_so_far = 0
+        for mean, weight in points[1:]:
+            # A centroid may grow up to a size that shrinks towards the
+            # tails of the distribution (the k2 scale function).
+            q = (weight_so_far + (cur_weight + weight) / 2.0) / total
+            limit = 4 * total * q * (1 - q) / self.compression
+            if cur_weight + weight <= max(1, limit):
+                cur_weight += weight
+                cur_mean += (mean - cur_mean) * weight / cur_weight
+            else:
+                centroids.append([cur_mean, cur_weight])
+                weight_so_far += cur_weight
+                cur_mean, cur_weight = mean, weight
+        centroids.append([cur_mean, cur_weight])
+        self._centroids = centroids
+
+    def quantile(self, q):
+        '''
+        Estimate the value at quantile q (0 <= q <= 1). None if empty.
+        '''
+        if not 0 <= q <= 1:
+            raise ValueError("Quantile must be between 0 and 1, was {}".format(q))
+        self._compress()
+        if not self._centroids:
+            return None
+        if len(self._centroids) == 1:
+            return self._centroids[0][0]
+
+        target = q * self.count
+        # Treat each centroid's mean as sitting at the middle of its weight,
+        # and interpolate linearly between neighbouring centres. Beyond the
+        # first and last centres, interpolate to the exact min and max.
+        prev_mean, prev_centre = self.min, 0.0
+        cumulative = 0.0
+        for mean, weight in self._centroids:
+            centre = cumulative + weight / 2.0
+            if target < centre:
+                return _interpolate(
+                    target, prev_centre, centre, prev_mean, mean)
+            prev_mean, prev_centre = mean, centre
+            cumulative += weight
+        return _interpolate(
+            target, prev_centre, float(self.count), prev_mean, self.max)
+
+    def __getstate__(self):
+        self._compress()
+        return self.__dict__
+
+
+def _interpolate(x, x0, x1, y0, y1):
+    if x1 <= x0:
+        return y1
+    return y0 + (y1 - y0) * (x - x0) / (x1 - x0)
@@ -0,0 +1,285 @@
+"""Per-vehicle trip index, and camera pair postings for route lookups.
+
+Two tables can be kept alongside captures, made by `anpr create
+--trip-index` or `anpr index` (which fills them from captures), and then
+written by the loader as it goes:
+trips: one row per vehicle, its cameras and directions in the order they
+    were passed, and the offset of each capture in seconds from the first
+camera_pairs: for each vehicle, every (from camera, to camera) pair it
+    passed in that order, not necessarily one straight after the other,
+    with the shortest time it took between them
+
+So "vehicles that passed A then B within T" is a single range scan of the
+camera_pairs index, taking time in proportion to the number of vehicles
+found rather than the size of captures.
+
+Both are derived from captures, so have no foreign keys: the index entries
+for a batch of bulk loaded trips can then be written before the trips are.
+
+The index is opt-in because of what it costs to load: a trip past k cameras
+has k(k - 1)/2 camera pairs, so a 30 camera trip writes 435 camera_pairs
+rows alongside its 30 captures.
+"""
+import datetime
+import io
+import math
+
+from psycopg2 import sql
+
+from anpr import bulk
+
+TRIP_INDEX_BATCH_SIZE = 10000
+
+TRIPS_TABLE_SQL = (
+    "CREATE TABLE IF NOT EXISTS trips ("
+    "vehicle integer PRIMARY KEY, "
+    "start_ts timestamptz NOT NULL, "
+    "cameras varchar(10)[] NOT NULL, "
+    "directions direction[] NOT NULL, "
+    "offsets integer[] NOT NULL"
+    ");"
+)
+CAMERA_PAIRS_TABLE_SQL = (
+    "CREATE TABLE IF NOT EXISTS camera_pairs ("
+    "from_camera varchar(10) NOT NULL, "
+    "to_camera varchar(10) NOT NULL, "
+    "vehicle integer NOT NULL, "
+    "gap_seconds integer NOT NULL"
+    ");"
+)
+CAMERA_PAIRS_INDEX_SQL = (
+    "CREATE INDEX IF NOT EXISTS camera_pairs_gap ON camera_pairs "
+    "(from_camera, to_camera, gap_seconds, vehicle);"
+)
+
+# Rebuilding from captures; the pairs are made from the trips' (rounded)
+# offsets, so that they come out the same as when made by TripIndexWriter.
+BUILD_TRIPS_SQL = (
+    "INSERT INTO trips (vehicle, start_ts, cameras, directions, offsets) "
+    "SELECT vehicle, min(ts), "
+    "array_agg(camera ORDER BY ts, id), "
+    "array_agg(direction ORDER BY ts, id), "
+    "array_agg(CAST(floor(EXTRACT(EPOCH FROM ts - start_ts) + 0.5) AS integer) "
+    "ORDER BY ts, id) "
+    "FROM (SELECT *, min(ts) OVER (PARTITION BY vehicle) AS start_ts "
+    "FROM captures) AS c GROUP BY vehicle;"
+)
+BUILD_CAMERA_PAIRS_SQL = (
+    "INSERT INTO camera_pairs (from_camera, to_camera, vehicle, gap_seconds) "
+    "SELECT a.camera, b.camera, trips.vehicle, min(b.secs - a.secs) "
+    "FROM trips, "
+    "unnest(trips.cameras, trips.offsets) WITH ORDINALITY AS a(camera, secs, i), "
+    "unnest(trips.cameras, trips.offsets) WITH ORDINALITY AS b(camera, secs, i) "
+    "WHERE b.i > a.i GROUP BY 1, 2, 3;"
+)
+
+
+def create_tables(cursor):
+    cursor.execute(TRIPS_TABLE_SQL)
+    cursor.execute(CAMERA_PAIRS_TABLE_SQL)
+    cursor.execute(CAMERA_PAIRS_INDEX_SQL)
+
+
+def index_exists(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass('camera_pairs') IS NOT NULL;")
+        exists, = cur.fetchone()
+    return exists
+
+
+def require_index(conn):
+    if not index_exists(conn):
+        raise RuntimeError(
+            "There is no trip index, make one with anpr index")
+
+
+def rebuild(conn):
+    '''
+    Remake the trip index from everything in captures
+    '''
+    with conn.cursor() as cur:
+        create_tables(cur)
+        cur.execute("TRUNCATE camera_pairs, trips;")
+        cur.execute(BUILD_TRIPS_SQL)
+        cur.execute(BUILD_CAMERA_PAIRS_SQL)
+        cur.execute("ANALYZE trips;")
+        cur.execute("ANALYZE camera_pairs;")
+    conn.commit()
+
+
+def trip_offsets(captures):
+    '''
+    The seconds from the first capture to each capture, to the nearest second
+    '''
+    start = captures[0][2]
+    return [int(math.floor((ts - start).total_seconds() + 0.5))
+            for _camera, _direction, ts in captures]
+
+
+def camera_pairs(cameras, offsets):
+    '''
+    {(from camera, to camera): shortest gap in seconds} for every pair of
+    cameras passed in that order
+    '''
+    pairs = {}
+    for i, from_camera in enumerate(cameras):
+        for j in range(i + 1, len(cameras)):
+            key = (from_camera, cameras[j])
+            gap = offsets[j] - offsets[i]
+            if key not in pairs or gap < pairs[key]:
+                pairs[key] = gap
+    return pairs
+
+
+def _array_text(values):
+    # A Postgres array literal, with every element quoted.
+    return "{" + ",".join(
+        '"{}"'.format(str(v).replace("\\", "\\\\").replace('"', '\\"'))
+        for v in values) + "}"
+
+
+class TripIndexWriter(object):
+    '''
+    Buffers the index entries for trips as they are loaded, and writes them
+    with COPY every batch_size trips (and on flush()). Nothing is committed;
+    that is left to the caller, along with the trips themselves.
+    '''
+    def __init__(self, conn, batch_size=TRIP_INDEX_BATCH_SIZE):
+        self.conn = conn
+        self.batch_size = batch_size
+        self._reset()
+
+    @classmethod
+    def for_connection(cls, conn):
+        '''
+        A writer for the db, or None if it has no trip index
+        '''
+        if not index_exists(conn):
+            return None
+        return cls(conn)
+
+    def _reset(self):
+        self._trips = io.StringIO()
+        self._pairs = io.StringIO()
+        self._pending = 0
+
+    def add_trip(self, vehicle_id, captures):
+        cameras = [camera for camera, _direction, _ts in captures]
+        offsets = trip_offsets(captures)
+        self._trips.write("\t".join([
+            str(vehicle_id), bulk.copy_text(captures[0][2]),
+            bulk.copy_text(_array_text(cameras)),
+            bulk.copy_text(_array_text(
+                [direction for _camera, direction, _ts in captures])),
+            bulk.copy_text(_array_text(offsets))]) + "\n")
+        for (from_camera, to_camera), gap in camera_pairs(
+                cameras, offsets).items():
+            self._pairs.write("{}\t{}\t{}\t{}\n".format(
+                bulk.copy_text(from_camera), bulk.copy_text(to_camera),
+                vehicle_id, gap))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        self._trips.seek(0)
+        self._pairs.seek(0)
+        with self.conn.cursor() as cur:
+            cur.copy_expert(
+                "COPY trips (vehicle, start_ts, cameras, directions, offsets) "
+                "FROM STDIN;", self._trips)
+            cur.copy_expert(
+                "COPY camera_pairs (from_camera, to_camera, vehicle, "
+                "gap_seconds) FROM STDIN;", self._pairs)
+        self._reset()
+
+
+def vehicles_between(conn, from_camera, to_camera, within=None):
+    '''
+    {vehicle: shortest gap in seconds} for the vehicles that passed
+    from_camera and later to_camera, within the given timedelta if any
+    '''
+    require_index(conn)
+    condition = sql.SQL("")
+    if within is not None:
+        condition = sql.SQL(" AND gap_seconds <= {}").format(
+            sql.Literal(int(within.total_seconds())))
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL(
+            "SELECT vehicle, gap_seconds FROM camera_pairs "
+            "WHERE from_camera = %s AND to_camera = %s{};").format(condition),
+            (from_camera, to_camera))
+        return dict(cur.fetchall())
+
+
+def _passes_in_order(cameras, offsets, route, within_seconds):
+    '''
+    Whether the trip passes the route's cameras in order, and (if
+    within_seconds isn't None) does so in no more than that time
+    '''
+    for start, camera in enumerate(cameras):
+        if camera != route[0]:
+            continue
+        # Taking the earliest match for each camera after this start gives
+        # the quickest way through the route from it.
+        position = start
+        for next_camera in route[1:]:
+            try:
+                position = cameras.index(next_camera, position + 1)
+            except ValueError:
+                return False
+        if within_seconds is None or offsets[position] - offsets[start] <= within_seconds:
+            return True
+    return False
+
+
+def vehicles_passing(conn, route, within=None):
+    '''
+    The vehicles that passed each camera of the route in order (not
+    necessarily one straight after the other), the whole route taking no
+    more than the given timedelta if any.
+    Candidates come from intersecting the postings of each consecutive pair
+    of cameras; only they have their trips checked.
+    '''
+    if len(route) < 2:
+        raise ValueError("A route needs at least two cameras")
+    require_index(conn)
+    within_seconds = None if within is None else int(within.total_seconds())
+    condition = sql.SQL("")
+    if within_seconds is not None:
+        condition = sql.SQL(" AND gap_seconds <= {}").format(
+            sql.Literal(within_seconds))
+    postings = sql.SQL(" INTERSECT ").join([
+        sql.SQL(
+            "SELECT vehicle FROM camera_pairs "
+            "WHERE from_camera = {} AND to_camera = {}{}").format(
+                sql.Literal(from_camera), sql.Literal(to_camera), condition)
+        for from_camera, to_camera in zip(route, route[1:])])
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL(
+            "SELECT vehicle, cameras, offsets FROM trips "
+            "WHERE vehicle IN ({});").format(postings))
+        rows = cur.fetchall()
+    if len(route) == 2:
+        return sorted(vehicle for vehicle, _cameras, _offsets in rows)
+    return sorted(vehicle for vehicle, cameras, offsets in rows
+                  if _passes_in_order(cameras, offsets, route, within_seconds))
+
+
+def get_trip(conn, vehicle):
+    '''
+    A vehicle's [(camera, direction, ts)] captures, from the trip index
+    '''
+    require_index(conn)
+    with conn.cursor() as cur:
+        cur.execute(
+            "SELECT start_ts, cameras, directions::text[], offsets FROM trips "
+            "WHERE vehicle = %s;", (vehicle,))
+        row = cur.fetchone()
+    if row is None:
+        return None
+    start_ts, cameras, directions, offsets = row
+    return [(camera, direction, start_ts + datetime.timedelta(seconds=offset))
+            for camera, direction, offset in zip(cameras, directions, offsets)]
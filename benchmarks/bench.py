@@ -0,0 +1,243 @@
+"""Benchmarks for loading and querying, on synthetic data at several scales.
+
+The offline benchmarks (spreadsheet parsing, route matching, grouping and
+stats) need no database. Given --dbname, the load and query benchmarks are run
+too, and with --sqlite they are run against the embedded SQLite backend.
+They drop and recreate the tables, so only point this at a scratch
+database (with PostGIS installed). Needs anpr installed (pip install -e .).
+
+    python benchmarks/bench.py --scales 1000,10000,100000 --memory
+    python benchmarks/bench.py --dbname anpr_bench --user me --password pw
+
+Peak memory is only measured with --memory, as tracing allocations slows
+everything down a lot; don't compare times from runs with and without it.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+import types
+
+import anpr
+from anpr import backends
+from anpr import filters
+from anpr import groups
+from anpr import partitions
+from anpr import stats
+from anpr import synthetic
+
+ROUTE_REGEX = r"01_N>(\d\d\D?_([NESW]|(OUT)|(IN))>)*05_S"
+
+
+TRACE_MEMORY = False
+
+
+def measure(fn, *args, **kwargs):
+    '''
+    Run fn, returning its result, the wall time and the peak memory it
+    allocated (in bytes, as seen by tracemalloc; None if not tracing)
+    '''
+    if TRACE_MEMORY:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        # The loader reports progress per sheet, which would drown the
+        # results.
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = fn(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        peak = None
+        if TRACE_MEMORY:
+            _current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def report(results, name, scale, n_rows, elapsed, peak):
+    rate = n_rows / elapsed if elapsed else 0.0
+    print("{:<28} {:>9} {:>10} {:>9.3f}s {:>12.0f}/s {:>11}".format(
+        name, scale, n_rows, elapsed, rate,
+        "-" if peak is None else "{:.1f}MB".format(peak / 1e6)))
+    results.append({
+        "benchmark": name, "scale": scale, "rows": n_rows,
+        "seconds": elapsed, "rows_per_second": rate, "peak_bytes": peak})
+
+
+def parse_workbook(path, cells=False):
+    loader = anpr.DataLoader(path, db_connection=None)
+    parse = loader.parse_sheet_cells if cells else loader.parse_sheet
+    return sum(sum(1 for _trip in parse(sheet))
+               for sheet in loader.camera_sheets())
+
+
+def bench_offline(results, scale, args, workdir):
+    generator = synthetic.TripGenerator(
+        n_cameras=args.cameras, max_chain=args.max_chain)
+    path = os.path.join(workdir, "synthetic_{}.xlsx".format(scale))
+    synthetic.write_workbook(path, scale, generator)
+    n_trips, elapsed, peak = measure(parse_workbook, path, cells=True)
+    report(results, "parse workbook (cells)", scale, n_trips, elapsed, peak)
+    n_trips, elapsed, peak = measure(parse_workbook, path)
+    report(results, "parse workbook", scale, n_trips, elapsed, peak)
+
+    # The row parsing on its own, without reading the workbook.
+    values = []
+    for start_camera, (timestamp, veh_class, hops) in generator.trips(scale):
+        chain, details = synthetic.format_chain(hops)
+        values.append((timestamp, veh_class, 0.0, chain, details))
+    cells = [tuple(types.SimpleNamespace(value=value, column=column, row=1)
+                   for column, value in enumerate(row)) for row in values]
+    _result, elapsed, peak = measure(
+        lambda: [anpr.parse_chain(row, "01") for row in cells])
+    report(results, "parse_chain (cells)", scale, scale, elapsed, peak)
+    _result, elapsed, peak = measure(
+        lambda: [anpr.parse_chain_values(row, "01", 1) for row in values])
+    report(results, "parse_chain_values", scale, scale, elapsed, peak)
+
+    rows = [(i,) + row for i, row in enumerate(synthetic.journey_rows(
+        scale, synthetic.TripGenerator(
+            n_cameras=args.cameras, max_chain=args.max_chain)))]
+    site_filter = filters.SiteFilter(ROUTE_REGEX)
+    matched, elapsed, peak = measure(
+        lambda: list(site_filter.fine_pass(rows)))
+    report(results, "SiteFilter.fine_pass", scale, len(rows), elapsed, peak)
+
+    group_lst = [groups.GroupByHour(), groups.GroupByClass()]
+    stats_lst = [stats.TimeStats(), stats.NStats(), stats.PercentileStats()]
+    searcher = anpr.DataSearcher.__new__(anpr.DataSearcher)
+    searcher.stats = stats_lst
+    searcher.group = anpr.compose([group.group for group in group_lst])
+    _result, elapsed, peak = measure(
+        lambda: searcher.apply_stats(searcher.group(rows)))
+    report(results, "group + stats", scale, len(rows), elapsed, peak)
+
+
+def bench_db(results, scale, args, workdir):
+    db_args = types.SimpleNamespace(
+        dbname=args.dbname, user=args.user, password=args.password,
+        backend=backends.POSTGRES.name,
+        cameras=os.path.join(workdir, "cameras.kml"),
+        partition=partitions.DEFAULT_GRANULARITY, trip_index=False)
+    synthetic.write_kml(db_args.cameras, args.cameras)
+    path = os.path.join(workdir, "synthetic_{}.xlsx".format(scale))
+
+    for bulk_load in (False, True):
+        anpr.do_create_command(db_args)
+        conn = anpr.make_connection(db_args)
+        loader = anpr.DataLoader(path, conn, bulk_load=bulk_load)
+        _result, elapsed, peak = measure(loader.load)
+        conn.close()
+        report(results, "load ({})".format("COPY" if bulk_load else "INSERT"),
+               scale, scale, elapsed, peak)
+
+    conn = anpr.make_connection(db_args)
+    with conn.cursor() as cur:
+        cur.execute("DROP TABLE IF EXISTS journeys CASCADE;")
+    conn.commit()
+    anpr.make_journeys_table(args.dbname, args.password)
+    synthetic.populate_journeys(conn, scale, synthetic.TripGenerator(
+        n_cameras=args.cameras, max_chain=args.max_chain))
+    with conn.cursor() as cur:
+        cur.execute("ANALYZE journeys;")
+    conn.commit()
+    conn.close()
+
+    bench_queries(results, scale, args.dbname, args.password)
+
+
+def query_specs():
+    return [
+        ("query by hour+class", [filters.ClassFilter(["Car", "Taxi"])],
+         [groups.GroupByHour(), groups.GroupByClass()],
+         [stats.TimeStats(), stats.NStats()]),
+        ("query route", [filters.SiteFilter(ROUTE_REGEX)],
+         [groups.GroupByHour()], [stats.TimeStats()]),
+    ]
+
+
+def bench_queries(results, scale, dbname, password,
+                  backend=backends.POSTGRES):
+    suffix = "" if backend is backends.POSTGRES else " ({})".format(
+        backend.name)
+    for name, filter_lst, group_lst, stats_lst in query_specs():
+        searcher = anpr.DataSearcher(
+            dbname, password, filter_lst, group_lst, stats_lst,
+            backend=backend)
+        _result, elapsed, peak = measure(searcher.combined)
+        report(results, name + suffix, scale, scale, elapsed, peak)
+        searcher.close()
+
+
+def bench_sqlite(results, scale, args, workdir):
+    backend = backends.SQLITE
+    dbname = os.path.join(workdir, "bench_{}.sqlite".format(scale))
+    generator = synthetic.TripGenerator(
+        n_cameras=args.cameras, max_chain=args.max_chain)
+    conn = backend.connect(dbname)
+    backend.create_schema(conn, [
+        (camera, "", 0.0, 0.0) for camera in generator.cameras])
+    path = os.path.join(workdir, "synthetic_{}.xlsx".format(scale))
+    loader = anpr.DataLoader(path, conn, backend=backend)
+    _result, elapsed, peak = measure(loader.load)
+    report(results, "load (sqlite)", scale, scale, elapsed, peak)
+
+    synthetic.populate_journeys(conn, scale, generator, backend=backend)
+    conn.execute("ANALYZE;")
+    conn.close()
+    bench_queries(results, scale, dbname, None, backend=backend)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark anpr on synthetic data")
+    parser.add_argument(
+        "--scales", default="1000,10000,100000",
+        help="comma separated numbers of trips to benchmark with")
+    parser.add_argument(
+        "--cameras", type=int, default=anpr.CAMERA_END,
+        help="number of cameras (sheets per workbook)")
+    parser.add_argument(
+        "--max-chain", type=int, default=8,
+        help="maximum number of cameras in a trip")
+    parser.add_argument(
+        "--dbname", help="scratch database for the load and query benchmarks")
+    parser.add_argument("--user", help="the username used to access the db")
+    parser.add_argument("--password", help="password to the database")
+    parser.add_argument(
+        "--sqlite", action="store_true",
+        help="also run the load and query benchmarks on the embedded sqlite "
+        "backend")
+    parser.add_argument(
+        "--memory", action="store_true",
+        help="measure peak memory (slows everything down)")
+    parser.add_argument(
+        "--json", help="also write the results to this file as JSON")
+    return parser.parse_args()
+
+
+def main():
+    global TRACE_MEMORY
+    args = parse_args()
+    TRACE_MEMORY = args.memory
+    results = []
+    print("{:<28} {:>9} {:>10} {:>10} {:>14} {:>11}".format(
+        "benchmark", "scale", "rows", "time", "throughput", "peak mem"))
+    with tempfile.TemporaryDirectory() as workdir:
+        for scale in [int(s) for s in args.scales.split(",")]:
+            bench_offline(results, scale, args, workdir)
+            if args.dbname:
+                bench_db(results, scale, args, workdir)
+            if args.sqlite:
+                bench_sqlite(results, scale, args, workdir)
+    if args.json:
+        with open(args.json, "w") as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
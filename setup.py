@@ -26,11 +26,15 @@ setup(
     packages=packages,
 
     install_requires=[
-        'openpyxl',
+        'openpyxl >= 2.6',
         'psycopg2 >= 2.7',
         'fastkml'
     ],
 
+    extras_require={
+        'columnar': ['numpy'],
+    },
+
     entry_points={
         'console_scripts': [
             'anpr = anpr:main'
@@ -0,0 +1,93 @@
+import os
+
+from anpr import cache
+from anpr import filters
+
+
+def test_lru_evicts_least_recently_used():
+    lru = cache.LRUCache(max_entries=2)
+    lru.put("a", 1)
+    lru.put("b", 2)
+    assert lru.get("a") == 1
+    lru.put("c", 3)
+    assert lru.get("b") is None
+    assert lru.get("a") == 1
+    assert lru.get("c") == 3
+    lru.clear()
+    assert lru.get("a") is None
+
+
+def test_disk_cache_evicts_oldest(tmpdir):
+    disk = cache.DiskCache(str(tmpdir), max_bytes=10 ** 9)
+    for i, key in enumerate(["a", "b", "c"]):
+        disk.put(key, list(range(100)))
+        os.utime(disk._path(key), (1000 + i, 1000 + i))
+    size = os.path.getsize(disk._path("a"))
+    disk.max_bytes = 2 * size
+    disk.evict()
+    assert disk.get("a") is None
+    assert disk.get("b") == disk.get("c") == list(range(100))
+    disk.clear()
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_disk_cache_bad_entry(tmpdir):
+    disk = cache.DiskCache(str(tmpdir))
+    with open(disk._path("a"), "wb") as outfile:
+        outfile.write(b"not a pickle")
+    assert disk.get("a") is None
+
+
+def compute(value):
+    calls = []
+    def inner():
+        calls.append(value)
+        return value
+    return inner, calls
+
+
+def test_result_cache_hits(tmpdir):
+    results = cache.ResultCache(directory=str(tmpdir))
+    first, first_calls = compute(["result"])
+    assert results.get_or_compute("db", "spec", 1, first) == ["result"]
+    assert results.get_or_compute("db", "spec", 1, first) == ["result"]
+    assert len(first_calls) == 1
+    # A new ResultCache, e.g. in another process, finds it on disk.
+    results = cache.ResultCache(directory=str(tmpdir))
+    assert results.get_or_compute("db", "spec", 1, first) == ["result"]
+    assert len(first_calls) == 1
+
+
+def test_result_cache_new_data_version():
+    results = cache.ResultCache()
+    old, old_calls = compute(["old"])
+    new, new_calls = compute(["new"])
+    results.get_or_compute("db", "spec", 1, old)
+    results.get_or_compute("db", "other spec", 1, old)
+    assert results.get_or_compute("db", "spec", 2, new) == ["new"]
+    assert len(new_calls) == 1
+    # The memory tier was cleared of the old version's results.
+    assert results.memory.get(cache.fingerprint("db", "other spec", 1)) is None
+    assert results.memory.get(cache.fingerprint("db", "spec", 2)) == ["new"]
+    assert len(old_calls) == 2
+
+
+def test_result_cache_other_db():
+    results = cache.ResultCache()
+    first, first_calls = compute(["first"])
+    other, other_calls = compute(["other"])
+    results.get_or_compute("db", "spec", 1, first)
+    # A different db, on a different data version, isn't a change of data.
+    assert results.get_or_compute("other db", "spec", 5, other) == ["other"]
+    assert results.get_or_compute("db", "spec", 1, first) == ["first"]
+    assert results.get_or_compute("other db", "spec", 5, other) == ["other"]
+    assert len(first_calls) == len(other_calls) == 1
+
+
+def test_spec_key():
+    assert (cache.spec_key(filters.ClassFilter(["Car"])) ==
+            cache.spec_key(filters.ClassFilter(["Car"])))
+    assert (cache.spec_key(filters.ClassFilter(["Car"])) !=
+            cache.spec_key(filters.ClassFilter(["Taxi"])))
+    assert (cache.spec_key(filters.SiteFilter("01_N>02_S")) !=
+            cache.spec_key(filters.StartEndViaFilter("01_N", "02_S", [], False)))
@@ -0,0 +1,140 @@
+import datetime
+
+import pytest
+
+from anpr import backends
+from anpr import partitions
+
+
+class FakeConnection(object):
+    '''
+    Enough of a psycopg2 connection for the partition code: answers the
+    catalog queries from the partitions it is given, and records the rest
+    '''
+    def __init__(self, attached=(), detached=(), granularity="month"):
+        self.attached = set(attached)
+        self.detached = set(detached)
+        self.granularity = granularity
+        self.executed = []
+        self.commits = 0
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def commit(self):
+        self.commits += 1
+
+
+class FakeCursor(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.result = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def execute(self, query, params=None):
+        conn = self.conn
+        if not isinstance(query, str):
+            # Rendered without a server, as for SQLite.
+            query, _params = backends.SQLITE.render(query)
+        if "FROM pg_class WHERE oid = to_regclass" in query:
+            name = params[0]
+            if name in conn.attached:
+                self.result = [(True,)]
+            elif name in conn.detached:
+                self.result = [(False,)]
+            else:
+                self.result = []
+        elif "to_regclass('captures_partitioning')" in query:
+            self.result = [(conn.granularity is not None,)]
+        elif query.startswith("SELECT granularity"):
+            self.result = [(conn.granularity,)]
+        elif query.startswith("SELECT child.relname"):
+            self.result = [(name,) for name in sorted(conn.attached)]
+        else:
+            conn.executed.append((query, params))
+
+    def fetchone(self):
+        return self.result[0] if self.result else None
+
+    def fetchall(self):
+        return self.result
+
+
+def ts(*args):
+    return datetime.datetime(*args)
+
+
+@pytest.mark.parametrize("granularity, when, start, after, name", [
+    ("day", ts(2017, 6, 1, 13, 5), ts(2017, 6, 1), ts(2017, 6, 2),
+     "captures_2017_06_01"),
+    ("day", ts(2017, 12, 31, 23, 59), ts(2017, 12, 31), ts(2018, 1, 1),
+     "captures_2017_12_31"),
+    ("month", ts(2017, 6, 30, 23, 59), ts(2017, 6, 1), ts(2017, 7, 1),
+     "captures_2017_06"),
+    ("month", ts(2017, 12, 3), ts(2017, 12, 1), ts(2018, 1, 1),
+     "captures_2017_12"),
+])
+def test_periods(granularity, when, start, after, name):
+    assert partitions.period_start(when, granularity) == start
+    assert partitions.next_period_start(start, granularity) == after
+    assert partitions.partition_name(start, granularity) == name
+    assert partitions._start_from_name(name, granularity) == start
+
+
+def test_start_from_other_names():
+    assert partitions._start_from_name("captures_2017_06", "day") is None
+    assert partitions._start_from_name("captures_default", "month") is None
+    assert partitions._start_from_name("captures_2017_06", None) is None
+
+
+def test_router_creates_each_partition_once():
+    conn = FakeConnection()
+    router = partitions.PartitionRouter.for_connection(conn)
+    router.ensure_trip([("1", "N", ts(2017, 6, 1, 8)),
+                        ("2", "S", ts(2017, 6, 30, 9)),
+                        ("3", "E", ts(2017, 7, 1, 0))])
+    router.ensure(ts(2017, 6, 15))
+    created = [(query.split('"')[1], params) for query, params in conn.executed]
+    assert created == [
+        ("captures_2017_06", (ts(2017, 6, 1), ts(2017, 7, 1))),
+        ("captures_2017_07", (ts(2017, 7, 1), ts(2017, 8, 1))),
+    ]
+
+
+def test_router_existing_partition():
+    conn = FakeConnection(attached=["captures_2017_06"])
+    partitions.PartitionRouter(conn, "month").ensure(ts(2017, 6, 3))
+    # CREATE TABLE IF NOT EXISTS, which leaves it be.
+    assert len(conn.executed) == 1
+
+
+def test_router_refuses_detached_partition():
+    conn = FakeConnection(detached=["captures_2017_06_03"], granularity="day")
+    router = partitions.PartitionRouter(conn, "day")
+    with pytest.raises(RuntimeError, match="captures_2017_06_03 exists but"):
+        router.ensure(ts(2017, 6, 3, 12))
+    assert conn.executed == []
+    router.ensure(ts(2017, 6, 4, 12))
+    assert len(conn.executed) == 1
+
+
+def test_router_unpartitioned():
+    assert partitions.PartitionRouter.for_connection(
+        FakeConnection(granularity=None)) is None
+
+
+def test_detach_before():
+    conn = FakeConnection(attached=["captures_2017_05", "captures_2017_06",
+                                    "captures_2017_07", "captures_other"])
+    detached = partitions.detach_partitions_before(conn, ts(2017, 7, 1))
+    assert detached == ["captures_2017_05", "captures_2017_06"]
+    assert [query for query, _params in conn.executed] == [
+        'ALTER TABLE captures DETACH PARTITION "captures_2017_05";',
+        'ALTER TABLE captures DETACH PARTITION "captures_2017_06";',
+    ]
+    assert conn.commits == 1
@@ -0,0 +1,84 @@
+import datetime
+
+from anpr import backends
+from anpr import filters
+from anpr import planner
+
+T0 = datetime.datetime(2017, 6, 1)
+HOUR = datetime.timedelta(hours=1)
+
+
+def render(query):
+    return backends.SQLITE.as_string(None, query)
+
+
+def test_merge_class_filters():
+    coarse = planner.combine_coarse_passes([
+        filters.ClassFilter(["Car", "Taxi", "Bus_Coach"]),
+        filters.ClassFilter(["Taxi", "Car"]),
+    ])
+    merged, = coarse
+    assert merged.allowed_classes == ["Car", "Taxi"]
+
+
+def test_disjoint_class_filters():
+    # Nothing matches, but an empty list isn't valid SQL.
+    car, taxi = filters.ClassFilter(["Car"]), filters.ClassFilter(["Taxi"])
+    assert planner.combine_coarse_passes([car, taxi]) == [car, taxi]
+
+
+def test_merge_time_ranges():
+    merged, = planner.combine_coarse_passes([
+        filters.TimeRangeFilter(T0, T0 + 5 * HOUR),
+        filters.TimeRangeFilter(T0 + HOUR, None),
+        filters.TimeRangeFilter(None, T0 + 3 * HOUR),
+    ])
+    assert (merged.start, merged.end) == (T0 + HOUR, T0 + 3 * HOUR)
+
+
+def test_merge_sites():
+    merged, = planner.combine_coarse_passes([
+        filters.SiteFilter("01_N>02_S"),
+        filters.StartEndViaFilter("02_S", "03_E", ["04_W"], False),
+    ])
+    assert merged.sites == ["01_N", "02_S", "03_E", "04_W"]
+
+
+def test_duplicates_dropped():
+    first, second = (filters.AnySiteFilter(["01_N", "02_S"]) for i in range(2))
+    other = filters.AnySiteFilter(["03_E"])
+    assert planner.combine_coarse_passes([first, other, second]) == [first, other]
+
+
+def test_fine_passes_keep_their_order():
+    site = filters.SiteFilter("01_N>02_S")
+    any_site = filters.AnySiteFilter(["03_E"])
+    cls = filters.ClassFilter(["Car"])
+    via = filters.StartEndViaFilter("01_N", "03_E", [], True)
+    plan = planner.QueryPlan([via, cls, any_site, site], backends.SQLITE)
+    assert plan.fine == [via, site]
+    assert plan.skipped == [cls, any_site]
+    # Over columns, AnySiteFilter has no column_mask() to do its work.
+    plan = planner.QueryPlan([via, cls, any_site, site], backends.SQLITE,
+                             columnar=True)
+    assert plan.fine == [via, any_site, site]
+    assert plan.skipped == [cls]
+
+
+def test_describe():
+    plan = planner.QueryPlan([filters.ClassFilter(["Car"]),
+                              filters.SiteFilter("01_N>02_S")], backends.SQLITE)
+    lines = plan.describe(render)
+    assert lines[0] == "Coarse pass (in the db):"
+    assert lines[1] == "  1. (class in (?)) ['Car']"
+    assert "  1. SiteFilter('01_N>02_S')" in lines
+    assert lines[-1] == ("Skipped fine passes (done by the coarse pass): "
+                         "ClassFilter")
+
+
+def test_no_filters():
+    plan = planner.QueryPlan([], backends.SQLITE)
+    assert render(plan.where_clause()) == ""
+    assert plan.describe(render) == [
+        "Coarse pass (in the db):", "  (none, every journey)",
+        "Fine passes (in Python, in order):", "  (none)"]
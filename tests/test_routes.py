@@ -0,0 +1,121 @@
+import datetime
+import random
+import re
+
+from anpr import filters
+from anpr import routes
+
+START = datetime.datetime(2017, 6, 1, 8, 0)
+SITES = ["{:02d}_{}".format(n, d) for n in range(1, 7) for d in "NESW"]
+
+
+def make_row(sites, gaps, journey_id=1):
+    '''
+    A journeys row through the sites, with gaps minutes between each
+    '''
+    chain = ">".join(sites)
+    time_chain = "".join(">{}({})".format(site, gap)
+                         for site, gap in zip(sites[1:], gaps))
+    total = datetime.timedelta(minutes=sum(gaps))
+    return (journey_id, START, "Car", total, chain, time_chain, START + total)
+
+
+def old_extract_route(row, route_regex):
+    '''
+    SiteFilter.extract_route() from before RouteMatcher, to compare against
+    '''
+    entry_regex = r"\d\d\D?_([NESW]|(OUT)|(IN))\((\d+(.\d+)?)\)"
+    def offset(time_chain, chain_index):
+        return sum(float(re.match(entry_regex, entry).group(4))
+                   for entry in time_chain[:(chain_index+1)])
+
+    chain = row[routes.CHAIN_COLUMN_INDEX]
+    if not re.search(route_regex, chain):
+        return []
+    out_rows = []
+    for matched_chain in re.findall("(" + route_regex + ")", chain):
+        if type(matched_chain) == tuple:
+            matched_chain = matched_chain[0]
+        first_site = matched_chain.split(">")[0]
+        match_start = chain.find(matched_chain)
+        index_start = chain[:match_start].count(">")
+        index_end = index_start + len(matched_chain.split(">")) - 1
+        time_chain = (first_site + "(0.0)" +
+                      row[routes.CHAIN_TIME_COLUMN_INDEX]).split(">")
+        start_time = START + datetime.timedelta(minutes=offset(time_chain, index_start))
+        end_time = START + datetime.timedelta(minutes=offset(time_chain, index_end))
+        out_rows.append((
+            row[0], start_time, row[routes.CLASS_COLUMN_INDEX],
+            end_time - start_time, matched_chain,
+            ">".join(time_chain[index_start:(index_end+1)]), end_time))
+    return out_rows
+
+
+def test_single_match():
+    row = make_row(["01_N", "02_S", "03_E", "04_W"], [1.5, 2.0, 3.25])
+    matched, = routes.RouteMatcher("02_S>03_E").extract_routes(row)
+    assert matched[1] == START + datetime.timedelta(minutes=1.5)
+    assert matched[3] == datetime.timedelta(minutes=2.0)
+    assert matched[4] == "02_S>03_E"
+    assert matched[5] == "02_S(1.5)>03_E(2.0)"
+    assert matched == old_extract_route(row, "02_S>03_E")[0]
+
+
+def test_match_from_first_site():
+    row = make_row(["01_N", "02_S", "03_E"], [1.0, 2.0])
+    matched, = routes.RouteMatcher("01_N>02_S").extract_routes(row)
+    assert matched[1] == START
+    assert matched[5] == "01_N(0.0)>02_S(1.0)"
+
+
+def test_no_match():
+    row = make_row(["01_N", "02_S"], [1.0])
+    assert routes.RouteMatcher("02_S>01_N").extract_routes(row) == []
+
+
+def test_same_as_old_extract_route():
+    rand = random.Random(8)
+    filter_lst = [
+        filters.SiteFilter("02_S>03_E"),
+        filters.StartEndViaFilter("01_N", "05_W", ["03_E"], True),
+        filters.StartEndViaFilter("02_S", "04_N", [], True),
+        filters.StartEndViaFilter("03_E", "03_E", [], False),
+    ]
+    for journey_id in range(500):
+        # No site is passed twice, so no sub-route can repeat.
+        sites = rand.sample(SITES, rand.randint(2, 10))
+        for _ in range(rand.randint(0, 3)):
+            sites.insert(rand.randrange(len(sites) + 1),
+                         rand.choice(["01_N", "02_S", "03_E", "04_N", "05_W"]))
+        sites = [site for i, site in enumerate(sites) if site not in sites[:i]]
+        if len(sites) < 2:
+            continue
+        row = make_row(sites, [rand.randint(1, 400) / 4.0
+                               for site in sites[1:]], journey_id)
+        for fil in filter_lst:
+            assert (fil.route_matcher.extract_routes(row) ==
+                    old_extract_route(row, fil.route_regex))
+
+
+def test_repeated_sub_route():
+    # The old code found each repeat with str.find, so gave them all the
+    # times of the first; each repeat now gets its own.
+    row = make_row(["01_N", "02_S", "03_E", "01_N", "02_S"], [1.0, 2.0, 4.0, 8.0])
+    first, second = routes.RouteMatcher("01_N>02_S").extract_routes(row)
+    assert first[1] == START
+    assert first[3] == datetime.timedelta(minutes=1.0)
+    assert second[1] == START + datetime.timedelta(minutes=7.0)
+    assert second[3] == datetime.timedelta(minutes=8.0)
+    assert second[5] == "01_N(4.0)>02_S(8.0)"
+
+    old_first, old_second = old_extract_route(row, "01_N>02_S")
+    assert old_first == first
+    assert old_second == old_first
+
+
+def test_fine_pass():
+    rows = [make_row(["01_N", "02_S", "03_E"], [1.0, 2.0], 1),
+            make_row(["03_E", "02_S"], [1.0], 2),
+            make_row(["02_S", "03_E", "02_S", "03_E"], [1.0, 2.0, 3.0], 3)]
+    fil = filters.SiteFilter("02_S>03_E")
+    assert [row[0] for row in fil.fine_pass(iter(rows))] == [1, 3, 3]
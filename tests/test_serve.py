@@ -0,0 +1,79 @@
+import datetime
+
+import pytest
+
+from anpr import filters
+from anpr import groups
+from anpr import serve
+from anpr import stats
+
+
+def test_parse_search():
+    filter_lst, group_lst, stats_lst = serve.parse_search({
+        "filters": [{"type": "site", "route": "01_N>02_S"},
+                    {"type": "class", "classes": ["Car", "Taxi"]},
+                    {"type": "time", "start": "2017-06-01T08:00"}],
+        "groups": ["class", "hour"],
+        "stats": ["n", {"type": "percentile", "percentiles": [50, 90]}]})
+    site, cls, time = filter_lst
+    assert isinstance(site, filters.SiteFilter)
+    assert site.route_regex == "01_N>02_S"
+    assert cls.allowed_classes == ["Car", "Taxi"]
+    assert time.start == datetime.datetime(2017, 6, 1, 8, 0)
+    assert time.end is None
+    assert [type(g) for g in group_lst] == [groups.GroupByClass, groups.GroupByHour]
+    assert isinstance(stats_lst[0], stats.NStats)
+    assert stats_lst[1].percentiles == [50, 90]
+
+
+def test_same_spec_same_filter():
+    # Key order doesn't matter to the filter cache.
+    first = serve.make_filter({"type": "any_site", "sites": ["01_N", "02_S"]})
+    second = serve.make_filter({"sites": ["01_N", "02_S"], "type": "any_site"})
+    assert first is second
+
+
+def test_start_end_via():
+    fil = serve.make_filter({"type": "start_end_via", "start": "01_N",
+                             "end": "03_E", "via": ["02_S"]})
+    assert fil.sites == ["01_N", "03_E", "02_S"]
+
+
+@pytest.mark.parametrize("spec", [
+    [],
+    {"filters": [{"type": "nope"}]},
+    {"filters": [{"route": "01_N"}]},
+    {"filters": [{"type": "site"}]},
+    {"filters": [{"type": "site", "route": 1}]},
+    {"filters": [{"type": "class", "classes": "Car"}]},
+    {"filters": [{"type": "class", "classes": ["Car", 2]}]},
+    {"filters": [{"type": "any_site", "sites": None}]},
+    {"filters": [{"type": "start_end_via", "start": "01_N", "end": "02_S",
+                  "via": "03_E"}]},
+    {"filters": [{"type": "time", "start": "yesterday"}]},
+    {"groups": ["day"]},
+    {"stats": ["mean"]},
+    {"stats": [{"type": "n", "bins": 3}]},
+    {"stats": [{"type": "percentile", "percentiles": 50}]},
+    {"stats": [{"type": "percentile", "percentiles": [50, 101]}]},
+    {"stats": [{"type": "percentile", "percentiles": [True]}]},
+])
+def test_bad_spec(spec):
+    with pytest.raises(serve.SpecError):
+        serve.parse_search(spec)
+
+
+def test_result_lines():
+    assert list(serve.result_lines([1, 2])) == [{"stats": [1, 2]}]
+    result = {"Car": {8: [1], 9: [2]}, "Taxi": {8: [3]}}
+    assert list(serve.result_lines(result)) == [
+        {"group": ["Car", 8], "stats": [1]},
+        {"group": ["Car", 9], "stats": [2]},
+        {"group": ["Taxi", 8], "stats": [3]},
+    ]
+
+
+def test_json_line():
+    line = serve.json_line({"start": datetime.datetime(2017, 6, 1, 8, 0),
+                            "time": datetime.timedelta(minutes=2)})
+    assert line == b'{"start": "2017-06-01T08:00:00", "time": 120.0}\n'
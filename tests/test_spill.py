@@ -0,0 +1,77 @@
+import datetime
+import os
+import random
+
+import pytest
+
+import anpr
+from anpr import groups
+from anpr import spill
+from anpr import stats
+
+START = datetime.datetime(2017, 6, 1)
+CLASSES = ["Car", "Taxi", "Bus_Coach", "OGV1", "LGV<3.5T"]
+
+
+def make_rows(n, seed=22):
+    rand = random.Random(seed)
+    rows = []
+    for journey_id in range(n):
+        start = START + datetime.timedelta(seconds=rand.randrange(86400))
+        trip_time = datetime.timedelta(seconds=rand.randrange(60, 7200))
+        rows.append((journey_id, start, rand.choice(CLASSES), trip_time,
+                     "01_N>02_S", ">02_S(1.0)", start + trip_time))
+    return rows
+
+
+def in_memory(rows, group_lst, stats_lst):
+    '''
+    What DataSearcher gives without a memory_budget
+    '''
+    def apply_stats(grouped):
+        if isinstance(grouped, dict):
+            return {key: apply_stats(value) for key, value in grouped.items()}
+        return [stat for s in stats_lst for stat in s.make_stats(grouped)]
+    return apply_stats(anpr.compose([group.group for group in group_lst])(rows))
+
+
+def spilled(rows, group_lst, stats_lst, memory_budget, directory):
+    grouper = spill.SpillingGrouper(
+        group_lst, memory_budget, n_partitions=4, directory=directory)
+    return grouper.aggregate(
+        iter(rows), lambda: [s.aggregator() for s in stats_lst],
+        lambda aggregators: [stat for agg in aggregators
+                             for stat in agg.finalize()])
+
+
+@pytest.mark.parametrize("memory_budget", [1, 97, 1000, 10000])
+@pytest.mark.parametrize("group_lst", [
+    [groups.GroupByClass()],
+    [groups.GroupByHour(), groups.GroupByClass()],
+])
+def test_same_as_in_memory(tmpdir, memory_budget, group_lst):
+    rows = make_rows(2000)
+    stats_lst = [stats.NStats(), stats.TimeStats(),
+                 stats.PercentileStats(compression=1000)]
+    expected = in_memory(rows, group_lst, stats_lst)
+    assert spilled(rows, group_lst, stats_lst, memory_budget, str(tmpdir)) == expected
+    # The spill files are all cleaned up.
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_cleans_up_on_error(tmpdir):
+    def rows():
+        for row in make_rows(100):
+            yield row
+        raise RuntimeError("db went away")
+    grouper = spill.SpillingGrouper(
+        [groups.GroupByClass()], 10, n_partitions=4, directory=str(tmpdir))
+    with pytest.raises(RuntimeError):
+        grouper.aggregate(rows(), lambda: [stats.NStats().aggregator()],
+                          lambda aggregators: aggregators[0].finalize())
+    assert os.listdir(str(tmpdir)) == []
+
+
+def test_needs_a_grouper():
+    with pytest.raises(ValueError):
+        spill.SpillingGrouper([])
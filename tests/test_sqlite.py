@@ -0,0 +1,92 @@
+import datetime
+import sqlite3
+
+import pytest
+from psycopg2 import sql
+
+from anpr import backends
+from anpr import filters
+
+START = datetime.datetime(2017, 6, 1, 8, 0)
+
+
+def test_render_literals():
+    query = sql.SQL("SELECT * FROM journeys WHERE class in {} AND timestamp >= {}"
+                    " AND total_trip_time < {} AND chain = {}").format(
+        sql.Literal(("Car", "Taxi")), sql.Literal(START),
+        sql.Literal(datetime.timedelta(minutes=5)), sql.Literal("01_N"))
+    text, params = backends.SQLITE.render(query)
+    assert text == ("SELECT * FROM journeys WHERE class in (?, ?) AND "
+                    "timestamp >= ? AND total_trip_time < ? AND chain = ?")
+    assert params == ["Car", "Taxi", "2017-06-01 08:00:00", 300.0, "01_N"]
+
+
+def test_render_identifiers():
+    query = sql.SQL("SELECT {} FROM {}").format(
+        sql.Identifier("journeys", "class"), sql.Identifier('odd "name"'))
+    assert backends.SQLITE.render(query) == (
+        'SELECT "journeys"."class" FROM "odd ""name"""', [])
+
+
+def test_render_unknown():
+    with pytest.raises(TypeError):
+        backends.SQLITE.render(sql.Placeholder("x"))
+
+
+def test_sqlite_value():
+    assert backends.sqlite_value(START) == "2017-06-01 08:00:00"
+    assert (backends.sqlite_value(START.replace(microsecond=5)) ==
+            "2017-06-01 08:00:00.000005")
+    assert backends.sqlite_value(datetime.timedelta(seconds=90.5)) == 90.5
+    assert backends.sqlite_value("01_N") == "01_N"
+    assert backends.sqlite_value(None) is None
+
+
+def test_stdlib_converters_left_alone():
+    conn = sqlite3.connect(":memory:", detect_types=sqlite3.PARSE_DECLTYPES)
+    conn.execute("CREATE TABLE t (ts timestamp)")
+    conn.execute("INSERT INTO t VALUES ('2017-06-01 08:00:00')")
+    ts, = conn.execute("SELECT ts FROM t").fetchone()
+    # The stdlib's own converter, not anpr's.
+    assert ts == START
+
+
+def make_db():
+    conn = backends.SQLITE.connect(":memory:")
+    backends.SQLITE.create_schema(conn)
+    backends.SQLITE.insert_journeys(conn, [
+        (START, "Car", datetime.timedelta(minutes=2), "01_N>02_S",
+         ">02_S(2.0)", START + datetime.timedelta(minutes=2), ["01_N", "02_S"]),
+        (START + datetime.timedelta(hours=2), "Taxi",
+         datetime.timedelta(seconds=30.5), "02_S>03_E", ">03_E(0.5)",
+         START + datetime.timedelta(hours=2, seconds=30.5), ["02_S", "03_E"]),
+    ])
+    return conn
+
+
+def test_journeys_round_trip():
+    conn = make_db()
+    first, second = conn.execute(
+        "SELECT * FROM journeys ORDER BY journey_id").fetchall()
+    assert first == (1, START, "Car", datetime.timedelta(minutes=2), "01_N>02_S",
+                     ">02_S(2.0)", START + datetime.timedelta(minutes=2),
+                     ["01_N", "02_S"])
+    assert second[3] == datetime.timedelta(seconds=30.5)
+    assert second[6] == START + datetime.timedelta(hours=2, seconds=30.5)
+
+
+@pytest.mark.parametrize("fil, expected", [
+    (filters.TimeRangeFilter(START + datetime.timedelta(hours=1)), [2]),
+    (filters.TimeRangeFilter(None, START + datetime.timedelta(hours=1)), [1]),
+    (filters.ClassFilter(["Taxi", "Bus_Coach"]), [2]),
+    (filters.AnySiteFilter(["02_S"]), [1, 2]),
+    (filters.AnySiteFilter(["03_E", "04_W"]), [2]),
+    (filters.AnySiteFilter([]), []),
+])
+def test_coarse_passes(fil, expected):
+    conn = make_db()
+    cur = conn.cursor()
+    backends.SQLITE.execute(cur, sql.SQL(
+        "SELECT journey_id FROM journeys WHERE {} ORDER BY journey_id").format(
+            backends.SQLITE.coarse_pass(fil)))
+    assert [journey_id for journey_id, in cur.fetchall()] == expected
@@ -0,0 +1,77 @@
+import pickle
+import random
+
+import pytest
+
+from anpr import tdigest
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    position = q * (len(values) - 1)
+    below = int(position)
+    above = min(below + 1, len(values) - 1)
+    return values[below] + (values[above] - values[below]) * (position - below)
+
+
+def check_quantiles(digest, values):
+    spread = max(values) - min(values)
+    for q in (0.01, 0.1, 0.25, 0.5, 0.75, 0.9, 0.99):
+        # Closer in the tails, where the centroids are smaller.
+        tolerance = 0.01 if q in (0.01, 0.99) else 0.02
+        assert abs(digest.quantile(q) - exact_quantile(values, q)) <= tolerance * spread
+
+
+@pytest.mark.parametrize("distribution", ["uniform", "exponential", "sorted"])
+def test_quantiles(distribution):
+    rand = random.Random(1)
+    if distribution == "exponential":
+        values = [rand.expovariate(1 / 600.0) for i in range(20000)]
+    else:
+        values = [rand.uniform(0, 3600) for i in range(20000)]
+    if distribution == "sorted":
+        values.sort()
+    digest = tdigest.TDigest()
+    for value in values:
+        digest.add(value)
+    assert len(digest) == len(values)
+    check_quantiles(digest, values)
+    assert digest.quantile(0) == min(values)
+    assert digest.quantile(1) == max(values)
+    # The values are summarised by far fewer centroids.
+    digest.quantile(0.5)
+    assert len(digest._centroids) < len(values) / 20
+
+
+def test_merge():
+    rand = random.Random(2)
+    values = [rand.gauss(900, 200) for i in range(30000)]
+    digests = [tdigest.TDigest() for i in range(4)]
+    for i, value in enumerate(values):
+        digests[i % 4].add(value)
+    merged = digests[0]
+    for digest in digests[1:]:
+        merged.merge(digest)
+    assert len(merged) == len(values)
+    check_quantiles(merged, values)
+    assert merged.quantile(0) == min(values)
+    assert merged.quantile(1) == max(values)
+
+
+def test_pickle():
+    digest = tdigest.TDigest()
+    for value in range(1000):
+        digest.add(value)
+    copy = pickle.loads(pickle.dumps(digest))
+    assert copy.quantile(0.5) == digest.quantile(0.5)
+
+
+def test_small_and_empty():
+    digest = tdigest.TDigest()
+    assert digest.quantile(0.5) is None
+    digest.merge(tdigest.TDigest())
+    assert len(digest) == 0
+    digest.add(42.0)
+    assert digest.quantile(0.1) == digest.quantile(0.9) == 42.0
+    with pytest.raises(ValueError):
+        digest.quantile(1.5)